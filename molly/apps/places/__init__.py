@@ -1,13 +1,159 @@
+import threading, time
 from math import atan2, degrees
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
 from django.contrib.gis.geos import Point
 
+from molly.utils.misc import OrderedDict
+
 from models import EntityType, Entity, Identifier
 
+def get_identifier_cache_size():
+    """
+    @return: The number of (scheme, value) to entity mappings to keep in
+             memory in each process
+    """
+    return getattr(settings, 'PLACES_IDENTIFIER_CACHE_SIZE', 10000)
+
+class IdentifierCache(object):
+    """
+    A least-recently-used cache of which entity each identifier belongs to,
+    so that looking up an entity by a popular identifier is a primary key
+    lookup rather than a join through its identifiers.
+    
+    Importers call @C{invalidate_identifier_cache} when they finish, which
+    bumps a version number in the Django cache, so that every process clears
+    its own cache the next time it is used.
+    """
+    
+    VERSION_KEY = 'molly.places.identifiers.version'
+    
+    # The version is only changed by imports, so is kept for as long as
+    # memcached allows
+    VERSION_TIMEOUT = 30 * 86400
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.version = None
+        self._pks = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _check_version(self):
+        version = cache.get(self.VERSION_KEY)
+        if version != self.version:
+            self._pks.clear()
+            self.version = version
+    
+    def get_many(self, scheme, values):
+        """
+        @return: The primary keys of the entities with each of the values
+                 which are cached
+        @rtype: {str: int}
+        """
+        pks = {}
+        with self._lock:
+            self._check_version()
+            for value in values:
+                try:
+                    pk = self._pks.pop((scheme, value))
+                except KeyError:
+                    continue
+                # Re-insert it, so it's now the most recently used
+                self._pks[scheme, value] = pks[value] = pk
+        return pks
+    
+    def put_many(self, scheme, pks):
+        """
+        @param pks: The primary key of the entity with each value
+        @type pks: {str: int}
+        """
+        with self._lock:
+            for value, pk in pks.items():
+                self._pks.pop((scheme, value), None)
+                self._pks[scheme, value] = pk
+            while len(self._pks) > self.max_size:
+                self._pks.popitem(last=False)
+    
+    def discard(self, scheme, value):
+        with self._lock:
+            self._pks.pop((scheme, value), None)
+    
+    def invalidate(self):
+        with self._lock:
+            try:
+                cache.incr(self.VERSION_KEY)
+            except ValueError:
+                # Starting from the time means that if the version was
+                # evicted, it doesn't go back to one some process has seen
+                cache.set(self.VERSION_KEY, int(time.time()),
+                          self.VERSION_TIMEOUT)
+            self._pks.clear()
+
+identifier_cache = IdentifierCache(get_identifier_cache_size())
+
+def invalidate_identifier_cache():
+    """
+    Forgets which entities identifiers belong to, in every process. Importers
+    call this once they have finished.
+    """
+    identifier_cache.invalidate()
+
+def get_entities(scheme, values):
+    """
+    Looks up the entities with any of a number of identifiers in the same
+    scheme, in at most two queries however many there are
+    
+    @param scheme: The identifier scheme, such as 'crs' or 'atco'
+    @type scheme: str
+    @param values: The identifiers to look up
+    @type values: [str]
+    @return: The entity with each identifier, leaving out those which no
+             entity has. If more than one entity has the same identifier, the
+             first to be imported is used.
+    @rtype: {str: Entity}
+    """
+    values = set(values)
+    pks = identifier_cache.get_many(scheme, values)
+    
+    uncached = values - set(pks)
+    if uncached:
+        found = {}
+        for value, pk in Entity._identifiers.through.objects.filter(
+                identifier__scheme=scheme,
+                identifier__value__in=uncached).values_list(
+                'identifier__value', 'entity').order_by('-entity'):
+            found[value] = pk
+        identifier_cache.put_many(scheme, found)
+        pks.update(found)
+    
+    entities = Entity.objects.in_bulk(pks.values())
+    result = {}
+    for value, pk in pks.items():
+        if pk in entities:
+            result[value] = entities[pk]
+        else:
+            # It has since been deleted
+            identifier_cache.discard(scheme, value)
+    return result
+
 def get_entity(scheme, value):
-    return get_object_or_404(Entity,
-                             _identifiers__scheme=scheme,
-                             _identifiers__value=value)
+    """
+    @return: The entity with an identifier
+    @rtype: Entity
+    @raise Http404: If there is no such entity
+    """
+    pk = identifier_cache.get_many(scheme, [value]).get(value)
+    if pk is not None:
+        try:
+            return Entity.objects.get(pk=pk)
+        except Entity.DoesNotExist:
+            identifier_cache.discard(scheme, value)
+    entity = get_object_or_404(Entity,
+                               _identifiers__scheme=scheme,
+                               _identifiers__value=value)
+    identifier_cache.put_many(scheme, {value: entity.pk})
+    return entity
 
 def get_point(request, entity):
     if entity and entity.location:
@@ -0,0 +1,152 @@
+"""
+Map layers showing every entity of a type, one slippy map tile at a time.
+
+Each tile is divided in to a grid, and the entities in each cell of the grid
+are counted by the database, so a tile never has more features than the grid
+has cells, however many entities there are. Tiles are cached until an
+importer changes the entities of their type.
+"""
+
+import time
+
+import simplejson
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from molly.maps.osm.draw import get_tile_geo
+from molly.apps.places.models import Entity
+
+def get_layer_grid_size():
+    """
+    @return: The number of cells along each side of a tile that entities are
+             clustered in to
+    """
+    return getattr(settings, 'PLACES_LAYER_GRID_SIZE', 8)
+
+def get_layer_cache_timeout():
+    """
+    @return: How long to cache a tile for, in seconds. Tiles are invalidated
+             when their entities are imported, so this can be long.
+    """
+    return getattr(settings, 'PLACES_LAYER_CACHE_TIMEOUT', 7 * 86400)
+
+def _version_key(slug):
+    return 'molly.places.layers.%s.version' % slug
+
+def get_layer_version(slug):
+    """
+    @return: The version of the layer for an entity type, which changes each
+             time its entities are imported
+    @rtype: int
+    """
+    version = cache.get(_version_key(slug))
+    if version is None:
+        # Starting from the time means that if the version is ever evicted,
+        # tiles cached under the old version aren't picked up again
+        version = int(time.time())
+        cache.add(_version_key(slug), version, get_layer_cache_timeout())
+        version = cache.get(_version_key(slug), version)
+    return version
+
+def invalidate_layers(entity_types):
+    """
+    Marks the cached tiles of the layers for some entity types, and the types
+    they are subtypes of, as out of date. Importers call this once they have
+    finished.
+
+    @type entity_types: [EntityType]
+    """
+    slugs = set()
+    for entity_type in entity_types:
+        slugs.add(entity_type.slug)
+        slugs.update(t.slug for t in entity_type.subtype_of_completion.all())
+    for slug in slugs:
+        try:
+            cache.incr(_version_key(slug))
+        except ValueError:
+            cache.set(_version_key(slug), int(time.time()),
+                      get_layer_cache_timeout())
+
+def cluster_tile(entity_type, zoom, xtile, ytile, grid_size=None):
+    """
+    Counts the entities of a type in each cell of a grid over a tile
+
+    @type entity_type: EntityType
+    @return: The number of entities in each cell, their average location, and
+             the primary key of one of them, as (count, longitude, latitude,
+             pk)
+    @rtype: [(int, float, float, int)]
+    """
+    grid_size = grid_size or get_layer_grid_size()
+    west, north = get_tile_geo(xtile, ytile, zoom)
+    east, south = get_tile_geo(xtile + 1, ytile + 1, zoom)
+
+    qn = connection.ops.quote_name
+    types = Entity._meta.get_field('all_types_completion')
+    # The position of each entity within the tile, in cells, from the
+    # spherical mercator projection tiles are drawn in
+    cell_x = "floor(((ST_X(e.location) + 180) / 360 * %%s - %%s) * %d)" \
+             % grid_size
+    cell_y = "floor(((1 - ln(tan(radians(ST_Y(e.location))) " \
+             "+ 1 / cos(radians(ST_Y(e.location)))) / pi()) / 2 * %%s - %%s) " \
+             "* %d)" % grid_size
+    sql = """
+        SELECT %(cell_x)s AS cell_x, %(cell_y)s AS cell_y, count(*),
+               avg(ST_X(e.location)), avg(ST_Y(e.location)), min(e.id)
+          FROM %(entity)s e
+          JOIN %(types)s t ON t.%(entity_id)s = e.id
+         WHERE t.%(type_id)s = %%s
+           AND e.location && ST_SetSRID(ST_MakeBox2D(ST_Point(%%s, %%s),
+                                                     ST_Point(%%s, %%s)), 4326)
+           AND ST_X(e.location) >= %%s AND ST_X(e.location) < %%s
+           AND ST_Y(e.location) > %%s AND ST_Y(e.location) <= %%s
+         GROUP BY cell_x, cell_y""" % {
+        'cell_x': cell_x,
+        'cell_y': cell_y,
+        'entity': qn(Entity._meta.db_table),
+        'types': qn(types.m2m_db_table()),
+        'entity_id': qn(types.m2m_column_name()),
+        'type_id': qn(types.m2m_reverse_name()),
+    }
+    cursor = connection.cursor()
+    cursor.execute(sql, [2 ** zoom, xtile, 2 ** zoom, ytile, entity_type.pk,
+                         west, south, east, north,
+                         west, east, south, north])
+    return [(count, lon, lat, pk)
+            for cell_x, cell_y, count, lon, lat, pk in cursor.fetchall()]
+
+def get_layer_tile(entity_type, zoom, xtile, ytile):
+    """
+    @return: A GeoJSON feature collection of the clusters of entities of a
+             type in a tile. Clusters of one entity have its title and URL,
+             and larger ones how many entities they contain.
+    @rtype: str
+    """
+    key = 'molly.places.layers.%s.%d.%d.%d.%d' % (
+        entity_type.slug, get_layer_version(entity_type.slug),
+        zoom, xtile, ytile)
+    tile = cache.get(key)
+    if tile is not None:
+        return tile
+
+    clusters = cluster_tile(entity_type, zoom, xtile, ytile)
+    entities = dict((pk, (title, url)) for pk, title, url in
+                    Entity.objects.filter(pk__in=[pk for count, lon, lat, pk
+                                                  in clusters if count == 1])
+                                  .values_list('pk', 'title', 'absolute_url'))
+    features = []
+    for count, lon, lat, pk in clusters:
+        properties = {'count': count}
+        if count == 1:
+            properties['title'], properties['url'] = entities[pk]
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': properties,
+        })
+    tile = simplejson.dumps({'type': 'FeatureCollection',
+                             'features': features})
+    cache.set(key, tile, get_layer_cache_timeout())
+    return tile
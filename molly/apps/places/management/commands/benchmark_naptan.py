@@ -0,0 +1,111 @@
+import os.path, time, zipfile
+from optparse import make_option
+from StringIO import StringIO
+from xml.sax import make_parser
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Only the parsers are imported, so nothing is written to the database
+from molly.apps.places.providers.naptan import NaptanContentHandler, iter_stop_points
+
+EXTRACT = os.path.join(os.path.dirname(__file__), '..', '..', 'testdata',
+                       'naptan-extract.xml')
+
+def parse_with_sax(f, areas, callback):
+    parser = make_parser()
+    parser.setContentHandler(NaptanContentHandler(callback, areas))
+    parser.parse(f)
+
+def parse_with_lxml(f, areas, callback):
+    for meta, revision in iter_stop_points(f, areas):
+        callback(meta, revision)
+
+PARSERS = (('sax', parse_with_sax), ('lxml', parse_with_lxml))
+
+class Command(BaseCommand):
+    args = '[NaPTAN.xml or NaPTANxml.zip]'
+    help = "Times reading the stop points in a NaPTAN document with the " \
+           "lxml parser the importer uses, against the SAX handler it " \
+           "replaced, and checks that both read the same stop points. " \
+           "Nothing is imported. Without a document, the extract the tests " \
+           "use is repeated to make one."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--runs',
+            action='store',
+            dest='runs',
+            type='int',
+            default=3,
+            help='The number of times to parse the document with each parser'),
+        make_option('-c', '--copies',
+            action='store',
+            dest='copies',
+            type='int',
+            default=5000,
+            help='How many times to repeat the stop points in the extract, '
+                 'when no document is given'),
+        make_option('-a', '--areas',
+            action='store',
+            dest='areas',
+            default=None,
+            help='Comma-separated ATCO area codes to read stop points from'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Only one document can be given")
+        get_document = self.get_document(args[0] if args else None,
+                                         options['copies'])
+        areas = options['areas'].split(',') if options['areas'] else None
+
+        count = self.check(get_document, areas)
+        self.stdout.write("Both parsers read the same %d stop points\n" % count)
+
+        best = {}
+        for name, parse in PARSERS:
+            timings = []
+            for i in range(options['runs']):
+                f = get_document()
+                start = time.time()
+                parse(f, areas, lambda meta, revision: None)
+                timings.append(time.time() - start)
+            best[name] = min(timings)
+            self.stdout.write("%s: best %.2fs, %.0f stop points/s\n" % (
+                name, best[name], count / best[name]))
+        self.stdout.write("lxml is %.1fx as fast as SAX\n" % (
+            best['sax'] / best['lxml']))
+
+    def check(self, get_document, areas):
+        """
+        @return: How many stop points the parsers read
+        @raise CommandError: If they read different stop points
+        """
+        stop_points = dict((name, []) for name, parse in PARSERS)
+        for name, parse in PARSERS:
+            parse(get_document(), areas,
+                  lambda meta, revision: stop_points[name].append(
+                      (dict(meta), revision)))
+        if stop_points['sax'] != stop_points['lxml']:
+            raise CommandError("The parsers read different stop points")
+        return len(stop_points['lxml'])
+
+    def get_document(self, filename, copies):
+        """
+        @return: A function which opens the document to parse, for each run
+        """
+        if filename is None:
+            extract = open(EXTRACT).read()
+            start = extract.index('<StopPoints>') + len('<StopPoints>')
+            end = extract.index('</StopPoints>')
+            document = extract[:start] + extract[start:end] * copies \
+                     + extract[end:]
+            return lambda: StringIO(document)
+        elif zipfile.is_zipfile(filename):
+            archive = zipfile.ZipFile(filename)
+            names = [name for name in archive.namelist()
+                     if name.lower().endswith('.xml')]
+            if not names:
+                raise CommandError("%s has no XML document in it" % filename)
+            return lambda: archive.open(names[0])
+        else:
+            return lambda: open(filename)
@@ -0,0 +1,197 @@
+import bz2, os, random, re, time
+from optparse import make_option
+from xml.sax import handler, make_parser
+
+import simplejson
+from django.core.management.base import BaseCommand, CommandError
+
+from molly.maps.management.commands.benchmark_maps import get_peak_rss
+from molly.apps.places.providers.nodestore import NodeStore, NODE_STORES
+
+class DictNodeStore(NodeStore):
+    """
+    Keeps nodes as the OSM importer used to, in a dictionary of tuples keyed
+    by their identifiers, for comparison
+    """
+
+    def __init__(self, directory=None):
+        super(DictNodeStore, self).__init__(directory)
+        self.nodes = {}
+
+    def add(self, id, lon, lat):
+        self.nodes['N%d' % id] = lon, lat
+
+    def get(self, id):
+        return self.nodes.get('N%d' % id)
+
+    def __len__(self):
+        return len(self.nodes)
+
+STORES = dict(NODE_STORES, dict=DictNodeStore)
+
+EXTRACT = os.path.join(os.path.dirname(__file__), '..', '..', 'testdata',
+                       'osm-extract.osm')
+
+NODE_ID = re.compile(r'(<node id=")(\d+)')
+
+class NodeHandler(handler.ContentHandler):
+    """
+    Adds the nodes in an OpenStreetMap extract to a store, as the importer
+    does
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def startElement(self, name, attrs):
+        if name == 'node':
+            self.store.add(int(attrs['id']), float(attrs['lon']),
+                           float(attrs['lat']))
+
+def feed_extract(parser, copies):
+    """
+    Feeds the nodes of the extract the tests use to a parser, repeated with
+    their ids moved along each time so that they stay in order, a copy at a
+    time so that the whole document is never in memory
+    """
+    extract = open(EXTRACT).read()
+    start, end = extract.index('<node '), extract.index('<way ')
+    nodes = extract[start:end]
+    span = max(int(id) for prefix, id in NODE_ID.findall(nodes)) + 1
+    parser.feed(extract[:start])
+    for i in xrange(copies):
+        offset = i * span
+        parser.feed(NODE_ID.sub(
+            lambda match: match.group(1) + str(int(match.group(2)) + offset),
+            nodes))
+    parser.feed(extract[end:])
+    parser.close()
+
+def synthetic_nodes(count):
+    """
+    @return: Made-up nodes in England, which are always the same for the same
+             count, with increasing ids (with gaps) and co-ordinates to seven
+             decimal places, as they are in an extract
+    """
+    rand = random.Random(count)
+    id = 0
+    for i in xrange(count):
+        id += rand.randint(1, 20)
+        yield (id, float('%.7f' % rand.uniform(-5.7, 1.8)),
+               float('%.7f' % rand.uniform(49.9, 55.8)))
+
+class Command(BaseCommand):
+    args = '[extract.osm or extract.osm.bz2]'
+    help = "Measures how much memory and time each way of keeping node " \
+           "locations (see molly.apps.places.providers.nodestore) takes " \
+           "for the nodes in an OpenStreetMap extract. Without an extract, " \
+           "the nodes of the extract the tests use are repeated, or " \
+           "made-up nodes are used if --nodes is given. 'dict' is how the " \
+           "OSM importer used to keep them. Each store is measured in its " \
+           "own process, so that their peak memory use can be compared."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--nodes',
+            action='store',
+            dest='nodes',
+            type='int',
+            default=None,
+            help='The number of made-up nodes to store, instead of the nodes '
+                 'of the test extract'),
+        make_option('-c', '--copies',
+            action='store',
+            dest='copies',
+            type='int',
+            default=2000,
+            help='How many times to repeat the nodes of the test extract, '
+                 'when no extract is given'),
+        make_option('-s', '--stores',
+            action='store',
+            dest='stores',
+            default='dict,array,mmap,sqlite',
+            help='Comma-separated stores to measure, of %s' % ', '.join(
+                sorted(STORES))),
+        make_option('-l', '--lookups',
+            action='store',
+            dest='lookups',
+            type='int',
+            default=100000,
+            help='The number of nodes to look up, as ways do'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Only one extract can be given")
+        stores = options['stores'].split(',')
+        for name in stores:
+            if name not in STORES:
+                raise CommandError("Unknown store %r" % name)
+
+        for name in stores:
+            result = self.measure_in_child(name, args[0] if args else None,
+                                           options)
+            self.stdout.write(
+                "%s: %d nodes, peak RSS +%.1fMB (%.1f bytes/node), "
+                "adding %.2fs, %d lookups %.2fs\n" % (
+                    name, result['nodes'], result['rss_kb'] / 1024.0,
+                    result['rss_kb'] * 1024.0 / max(result['nodes'], 1),
+                    result['add_s'], result['lookups'], result['lookup_s']))
+
+    def measure_in_child(self, name, filename, options):
+        """
+        Measures a store in a forked process, as a process's peak memory use
+        never goes down
+        """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                result = self.measure(name, filename, options)
+                os.write(w, simplejson.dumps(result))
+            finally:
+                os._exit(0)
+        os.close(w)
+        f = os.fdopen(r)
+        data = f.read()
+        f.close()
+        os.waitpid(pid, 0)
+        if not data:
+            raise CommandError("Measuring %s failed" % name)
+        return simplejson.loads(data)
+
+    def measure(self, name, filename, options):
+        store = STORES[name]()
+        before = get_peak_rss()
+
+        start = time.time()
+        parser = make_parser()
+        parser.setContentHandler(NodeHandler(store))
+        if filename is not None:
+            f = bz2.BZ2File(filename) if filename.endswith('.bz2') \
+                else open(filename)
+            parser.parse(f)
+        elif options['nodes']:
+            for id, lon, lat in synthetic_nodes(options['nodes']):
+                store.add(id, lon, lat)
+        else:
+            feed_extract(parser, options['copies'])
+        add_s = time.time() - start
+        count = len(store)
+
+        # Look up nodes which are stored, and some which aren't
+        rand = random.Random(0)
+        start = time.time()
+        for i in xrange(options['lookups']):
+            store.get(rand.randint(0, 20 * max(count, 1)))
+        lookup_s = time.time() - start
+
+        result = {
+            'nodes': count,
+            'rss_kb': get_peak_rss() - before,
+            'add_s': add_s,
+            'lookups': options['lookups'],
+            'lookup_s': lookup_s,
+        }
+        store.close()
+        return result
@@ -83,6 +83,11 @@ class Entity(models.Model):
     identifier_scheme = models.CharField(max_length=32)
     identifier_value = models.CharField(max_length=256)
     
+    # The version of the entity last imported, as given by its source (such
+    # as a revision number), so importers can skip records which haven't
+    # changed
+    import_stamp = models.CharField(max_length=64, blank=True)
+    
     @property
     def identifiers(self):
         try:
@@ -5,7 +5,10 @@ from django.contrib.gis.geos import Point, LineString
 from django.conf import settings
 
 from molly.apps.places.providers import BaseMapsProvider
-from molly.apps.places.models import Source, Entity, EntityType
+from molly.apps.places.providers.bulk import EntityRecord, EntitySync
+from molly.apps.places.models import Source, EntityType
+from molly.apps.places import invalidate_identifier_cache
+from molly.apps.places.layers import invalidate_layers
 from molly.conf.settings import batch
 
 class BBCTPEGResolver(etree.Resolver):
@@ -55,53 +58,43 @@ class BBCTPEGPlacesProvider(BaseMapsProvider):
         parser.resolvers.add(BBCTPEGResolver())
         xml = etree.parse(urllib.urlopen(self._tpeg_url), parser=parser)
         
-        entities, seen = {}, set()
-        for entity in Entity.objects.filter(source=source):
-            if 'bbc-tpeg' in entity.identifiers:
-                entities[entity.identifiers['bbc-tpeg']] = entity
-        
+        # Messages which are no longer in the feed are deleted
+        sync = EntitySync(source, 'bbc-tpeg', delete_missing=True)
         for message in xml.getroot().findall('tpeg_message'):
             id = message.find('road_traffic_message').attrib['message_id']
             road_traffic_message = message.find('road_traffic_message')
             
-            try:
-                entity = entities[id]
-            except KeyError:
-                entity = Entity()
-                entities[id] = entity
-            
-            entity.source = source
-            entity.title = message.find('summary').text
-            entity.primary_type = entity_type
-            
             locs = map(self._wgs84_to_point, road_traffic_message.findall('location_container/location_coordinates/WGS84'))
             if len(locs) > 1:
-                entity.geometry = LineString(*locs)
+                geometry = LineString(*locs)
             elif len(locs) == 1:
-                entity.geometry = locs[0]
+                geometry = locs[0]
             else:
                 continue
-            entity.location = Point(
-                sum(p.x for p in locs)/len(locs), 
-                sum(p.y for p in locs)/len(locs), 
-                srid=4326,
-            )
-            
-            entity.metadata['bbc_tpeg'] = {
-                'xml': etree.tostring(message),
-                'severity': road_traffic_message.attrib['severity_factor'],
-                'generated': road_traffic_message.attrib['message_generation_time'],
-                'version': int(road_traffic_message.attrib['version_number']),
-            }
             
-            entity.save(identifiers={'bbc-tpeg': id})
-            entity.all_types = [entity_type]
-            entity.update_all_types_completion()
-            seen.add(entity.pk)
+            sync.add(EntityRecord(
+                identifiers = {'bbc-tpeg': id},
+                title = message.find('summary').text,
+                primary_type = entity_type,
+                location = Point(
+                    sum(p.x for p in locs)/len(locs), 
+                    sum(p.y for p in locs)/len(locs), 
+                    srid=4326,
+                ),
+                geometry = geometry,
+                metadata = {
+                    'bbc_tpeg': {
+                        'xml': etree.tostring(message),
+                        'severity': road_traffic_message.attrib['severity_factor'],
+                        'generated': road_traffic_message.attrib['message_generation_time'],
+                        'version': int(road_traffic_message.attrib['version_number']),
+                    },
+                },
+            ))
+        sync.finish()
         
-        for entity in Entity.objects.filter(source=source):
-            if not entity.pk in seen:
-                entity.delete()
+        invalidate_layers([entity_type])
+        invalidate_identifier_cache()
     
     def _wgs84_to_point(self, elem):
         attrib = elem.attrib
@@ -0,0 +1,503 @@
+"""
+Bulk synchronisation of entities from an import, for providers which import
+many thousands of entities at a time.
+
+Rather than saving each entity (which costs around ten queries with its
+identifiers and types), a provider hands records to an @C{EntitySync}, which
+collects them in to batches. Each batch is compared against the entities
+already imported from the same source, matched by their primary identifier,
+and only the entities which are new or have changed are written, using a
+handful of multi-row statements per batch however large it is.
+
+Where a source gives each record a revision, it can be passed as the record's
+stamp. An importer can then load every stamp once with @C{get_stamps}, and
+@C{skip} the records whose stamp hasn't changed without building or comparing
+them at all.
+
+This uses PostgreSQL's multi-row INSERT ... RETURNING and UPDATE ... FROM
+(VALUES ...), and so needs PostGIS, which Molly requires anyway.
+"""
+
+import simplejson
+
+from django.db import connection, transaction
+
+from molly.apps.places.models import Entity, Identifier
+
+# The number of records to compare and write at a time
+BATCH_SIZE = 1000
+
+class EntityRecord(object):
+    """
+    An entity as an importer has found it
+    """
+
+    def __init__(self, identifiers, title, primary_type, all_types=None,
+                 location=None, geometry=None, metadata=None, stamp=''):
+        """
+        @param identifiers: The identifiers of the entity, including its
+                            primary identifier, as passed to @C{Entity.save}
+        @type identifiers: {str: str or [str]}
+        @param title: The title of the entity, or a function returning it,
+                      for titles which are expensive to work out. Such a
+                      function is only called if the entity is new or has
+                      otherwise changed.
+        @type title: unicode or callable
+        @type primary_type: EntityType
+        @param all_types: The types of the entity, which defaults to just its
+                          primary type
+        @type all_types: [EntityType]
+        @param location: The location of the entity, in any SRID
+        @type location: Point
+        @param geometry: The shape of the entity, which defaults to its
+                         location
+        @type geometry: GEOSGeometry
+        @param metadata: Metadata to set on the entity. Any other metadata
+                         the entity already has is kept.
+        @type metadata: dict
+        @param stamp: The version of the entity as given by the source, such
+                      as a revision number, which is stored with the entity
+        @type stamp: str
+        """
+        self.identifiers, self.title = identifiers, title
+        self.primary_type = primary_type
+        self.all_types = all_types or [primary_type]
+        self.location = location
+        self.geometry = location if geometry is None else geometry
+        self.metadata = metadata or {}
+        self.stamp = stamp
+
+def _to_wgs84(geometry):
+    if geometry is None:
+        return None
+    if geometry.srid is None:
+        geometry.srid = 4326
+    if geometry.srid == 4326:
+        return geometry
+    return geometry.transform(4326, clone=True)
+
+def _same_geometry(a, b):
+    if a is None or b is None:
+        return a is b
+    return a.geom_type == b.geom_type and a.equals_exact(b, 1e-9)
+
+def _identifier_set(identifiers):
+    pairs = set()
+    for scheme, value in identifiers.items():
+        if getattr(value, '__iter__', False) and not isinstance(value, basestring):
+            pairs.update((scheme, v) for v in value)
+        else:
+            pairs.add((scheme, value))
+    return pairs
+
+class EntitySync(object):
+    """
+    Brings the entities from a source in to line with the records given to it
+    by an importer.
+
+    Records are added with @C{add}, or all at once with @C{sync}, and are
+    written in batches as they come in. Call @C{finish} once every record has
+    been added.
+    """
+
+    def __init__(self, source, scheme, delete_missing=False,
+                 batch_size=BATCH_SIZE):
+        """
+        @param source: The source the entities are imported from
+        @type source: Source
+        @param scheme: The identifier scheme records are matched to entities
+                       by, which every record must have an identifier in
+        @type scheme: str
+        @param delete_missing: Whether to delete the entities from this source
+                               which weren't in the import
+        @type delete_missing: bool
+        """
+        self.source, self.scheme = source, scheme
+        self.delete_missing, self.batch_size = delete_missing, batch_size
+        self.counts = dict.fromkeys(('created', 'modified', 'unchanged',
+                                     'deleted'), 0)
+        self._batch = {}
+        self._seen, self._kept, self._removed = set(), [], set()
+        self._completions = {}
+
+        qn = connection.ops.quote_name
+        self._tables = {
+            'entity': qn(Entity._meta.db_table),
+            'identifier': qn(Identifier._meta.db_table),
+        }
+        for name in ('_identifiers', 'all_types', 'all_types_completion'):
+            field = Entity._meta.get_field(name)
+            self._tables[name] = (qn(field.m2m_db_table()),
+                                  qn(field.m2m_column_name()),
+                                  qn(field.m2m_reverse_name()))
+
+    def add(self, record):
+        """
+        Adds a record to the import, writing the current batch if it is full
+
+        @type record: EntityRecord
+        """
+        self._batch[record.identifiers[self.scheme]] = record
+        self._removed.discard(record.identifiers[self.scheme])
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def keep(self, value):
+        """
+        Marks the entity with a primary identifier as still existing, without
+        changing it, so that it isn't deleted
+        """
+        if self.delete_missing:
+            self._kept.append(value)
+
+    def remove(self, value):
+        """
+        Marks the entity with a primary identifier, if there is one, as gone
+        from the source, for importers which are told what has been deleted
+        rather than working it out. It is deleted when the import finishes.
+        """
+        self._batch.pop(value, None)
+        self._removed.add(value)
+
+    def skip(self, value):
+        """
+        Counts the entity with a primary identifier as unchanged, as its stamp
+        hasn't changed, without looking at it
+        """
+        self.counts['unchanged'] += 1
+        self.keep(value)
+
+    def get_stamps(self, primary_types=None):
+        """
+        Loads the stamp of every entity from this source in one query, so that
+        an importer can tell which records have changed (and, by taking the
+        records it has seen away from these, which entities have gone)
+
+        @param primary_types: If given, only entities with one of these
+                              primary types are loaded
+        @type primary_types: [EntityType]
+        @return: The primary key and stamp of each entity, by primary
+                 identifier. Entities imported before they had stamps have
+                 an empty one.
+        @rtype: {str: (int, str)}
+        """
+        entities = Entity._identifiers.through.objects.filter(
+            entity__source=self.source, identifier__scheme=self.scheme)
+        if primary_types is not None:
+            entities = entities.filter(entity__primary_type__in=primary_types)
+        stamps = {}
+        for value, pk, stamp in entities.values_list(
+                'identifier__value', 'entity', 'entity__import_stamp') \
+                .order_by('-entity').iterator():
+            # Ordered so that the oldest of any duplicates wins, as in
+            # _find_entities
+            stamps[value] = (pk, stamp)
+        return stamps
+
+    def delete(self, pks):
+        """
+        Deletes entities which an importer has found have gone from the
+        source, in batches
+
+        @type pks: [int]
+        """
+        pks = list(pks)
+        for i in range(0, len(pks), self.batch_size):
+            self._delete_entities(pks[i:i+self.batch_size])
+        self.counts['deleted'] += len(pks)
+        transaction.commit_unless_managed()
+
+    def sync(self, records):
+        """
+        Adds every record, and finishes the import
+
+        @return: The number of entities created, modified, left unchanged and
+                 deleted
+        @rtype: dict
+        """
+        for record in records:
+            self.add(record)
+        return self.finish()
+
+    def finish(self):
+        """
+        Writes any records left over and deletes the entities which were
+        removed or, if asked to, which weren't in the import
+
+        @return: The number of entities created, modified, left unchanged and
+                 deleted
+        @rtype: dict
+        """
+        self.flush()
+        removed = list(self._removed)
+        for i in range(0, len(removed), self.batch_size):
+            self.delete(self._find_entities(
+                removed[i:i+self.batch_size]).values())
+        if self.delete_missing:
+            for i in range(0, len(self._kept), self.batch_size):
+                self._seen.update(
+                    self._find_entities(self._kept[i:i+self.batch_size]).values())
+            self.delete(pk for pk in Entity.objects.filter(source=self.source)
+                                            .values_list('pk', flat=True).iterator()
+                        if pk not in self._seen)
+        return self.counts
+
+    def flush(self):
+        """
+        Compares the current batch against the existing entities, and writes
+        any which are new or have changed
+        """
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, {}
+
+        pks = self._find_entities(batch.keys())
+        existing = dict((row[0], row[1:]) for row in
+                        Entity.objects.filter(pk__in=pks.values()).values_list(
+                            'pk', 'title', 'primary_type', 'location', 'geometry',
+                            '_metadata', 'import_stamp'))
+        identifiers = self._get_m2m('_identifiers', pks.values(),
+                                    Identifier.objects.values_list('pk', 'scheme', 'value'))
+        all_types = self._get_m2m('all_types', pks.values())
+
+        inserts, updates, new_identifiers, new_types = [], [], {}, {}
+        for value, record in batch.items():
+            record.location = _to_wgs84(record.location)
+            record.geometry = _to_wgs84(record.geometry)
+            types = self._get_completion(record.all_types)
+            record.metadata['types'] = sorted(t.slug for t in types)
+            type_pks = set(t.pk for t in record.all_types)
+            identifier_set = _identifier_set(record.identifiers)
+
+            pk = pks.get(value)
+            if pk is None:
+                inserts.append(record)
+                continue
+            self._seen.add(pk)
+
+            title, primary_type, location, geometry, metadata, stamp = existing[pk]
+            metadata = simplejson.loads(metadata)
+            unchanged = (callable(record.title) or record.title == title) \
+                    and record.primary_type.pk == primary_type \
+                    and record.stamp == stamp \
+                    and _same_geometry(record.location, location) \
+                    and _same_geometry(record.geometry, geometry) \
+                    and all(metadata.get(k) == v
+                            for k, v in record.metadata.items())
+            if identifier_set != set(identifiers.get(pk, {}).values()):
+                # The identifiers decide the entity's URL, so it is updated
+                # too
+                new_identifiers[pk] = identifier_set
+                unchanged = False
+            if not unchanged:
+                metadata.update(record.metadata)
+                record.metadata = metadata
+                updates.append((pk, record))
+            if type_pks != all_types.get(pk, set()):
+                new_types[pk] = (type_pks, types)
+                unchanged = False
+            self.counts['unchanged' if unchanged else 'modified'] += 1
+
+        for pk, record in zip(self._insert_entities(inserts), inserts):
+            self._seen.add(pk)
+            new_identifiers[pk] = _identifier_set(record.identifiers)
+            new_types[pk] = (set(t.pk for t in record.all_types),
+                             self._get_completion(record.all_types))
+        self.counts['created'] += len(inserts)
+        self._update_entities(updates)
+        self._replace_identifiers(new_identifiers, identifiers)
+        self._replace_types(new_types)
+        transaction.commit_unless_managed()
+
+    def _find_entities(self, values):
+        """
+        @return: The primary key of the entity from this source with each of
+                 these primary identifiers. Any duplicates are deleted.
+        @rtype: {str: int}
+        """
+        pks, duplicates = {}, []
+        for value, pk in Entity._identifiers.through.objects.filter(
+                entity__source=self.source,
+                identifier__scheme=self.scheme,
+                identifier__value__in=values).values_list(
+                'identifier__value', 'entity').order_by('entity'):
+            if value in pks:
+                duplicates.append(pk)
+            else:
+                pks[value] = pk
+        if duplicates:
+            self._delete_entities(duplicates)
+        return pks
+
+    def _get_m2m(self, name, pks, related=None):
+        """
+        @param related: If given, the related objects are looked up in this
+                        values_list query, and returned by primary key
+        @return: The related objects (or primary keys) of each entity
+        @rtype: {int: set} or {int: dict}
+        """
+        if not pks:
+            return {}
+        table, column, reverse = self._tables[name]
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s, %s FROM %s WHERE %s IN (%s)" % (
+            column, reverse, table, column, ', '.join(['%s'] * len(pks))),
+            list(pks))
+        rows = cursor.fetchall()
+        if related is None:
+            result = {}
+            for pk, related_pk in rows:
+                result.setdefault(pk, set()).add(related_pk)
+            return result
+        objects = dict((row[0], row[1:]) for row in
+                       related.filter(pk__in=[r for e, r in rows]))
+        result = {}
+        for pk, related_pk in rows:
+            result.setdefault(pk, {})[related_pk] = objects[related_pk]
+        return result
+
+    def _get_completion(self, entity_types):
+        """
+        @return: The types an entity of these types is also of
+        @rtype: set
+        """
+        completion = set()
+        for entity_type in entity_types:
+            if entity_type.pk not in self._completions:
+                self._completions[entity_type.pk] = set(
+                    entity_type.subtype_of_completion.all())
+            completion |= self._completions[entity_type.pk]
+        return completion
+
+    def _get_row(self, record):
+        """
+        @return: The title, primary type, location, geometry, metadata,
+                 absolute URL, primary identifier and stamp of a record, ready
+                 to be written
+        """
+        entity = Entity()
+        absolute_url = entity._get_absolute_url(record.identifiers)
+        title = record.title() if callable(record.title) else record.title
+        return [
+            title,
+            record.primary_type.pk,
+            record.location.hexewkb if record.location is not None else None,
+            record.geometry.hexewkb if record.geometry is not None else None,
+            simplejson.dumps(record.metadata),
+            absolute_url,
+            entity.identifier_scheme,
+            entity.identifier_value,
+            record.stamp,
+        ]
+
+    def _insert_entities(self, records):
+        """
+        @return: The primary keys of the new entities, in the same order
+        @rtype: [int]
+        """
+        if not records:
+            return []
+        values, params = [], []
+        for record in records:
+            values.append("(%s, %s, %s, ST_GeomFromEWKB(decode(%s, 'hex')), "
+                          "ST_GeomFromEWKB(decode(%s, 'hex')), %s, %s, "
+                          "false, false, %s, %s, %s)")
+            params += [self.source.pk] + self._get_row(record)
+        cursor = connection.cursor()
+        # PostgreSQL returns the rows in the order they were inserted
+        cursor.execute("""
+            INSERT INTO %s (source_id, title, primary_type_id, location,
+                            geometry, _metadata, absolute_url, is_sublocation,
+                            is_stack, identifier_scheme, identifier_value,
+                            import_stamp)
+            VALUES %s RETURNING id""" % (self._tables['entity'],
+                                         ', '.join(values)), params)
+        return [row[0] for row in cursor.fetchall()]
+
+    def _update_entities(self, updates):
+        if not updates:
+            return
+        values, params = [], []
+        for pk, record in updates:
+            values.append("(%s::integer, %s::text, %s::integer, %s::text, "
+                          "%s::text, %s::text, %s::text, %s::text, %s::text, "
+                          "%s::text)")
+            params += [pk] + self._get_row(record)
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE %s AS e
+               SET title = v.title, primary_type_id = v.primary_type_id,
+                   location = ST_GeomFromEWKB(decode(v.location, 'hex')),
+                   geometry = ST_GeomFromEWKB(decode(v.geometry, 'hex')),
+                   _metadata = v._metadata, absolute_url = v.absolute_url,
+                   identifier_scheme = v.identifier_scheme,
+                   identifier_value = v.identifier_value,
+                   import_stamp = v.import_stamp
+              FROM (VALUES %s) AS v(id, title, primary_type_id, location,
+                                    geometry, _metadata, absolute_url,
+                                    identifier_scheme, identifier_value,
+                                    import_stamp)
+             WHERE e.id = v.id""" % (self._tables['entity'],
+                                      ', '.join(values)), params)
+
+    def _insert_m2m(self, name, rows):
+        if not rows:
+            return
+        table, column, reverse = self._tables[name]
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO %s (%s, %s) VALUES %s" % (
+            table, column, reverse, ', '.join(['(%s, %s)'] * len(rows))),
+            [value for row in rows for value in row])
+
+    def _delete_m2m(self, name, pks):
+        table, column, reverse = self._tables[name]
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s) RETURNING %s" % (
+            table, column, ', '.join(['%s'] * len(pks)), reverse), list(pks))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _replace_identifiers(self, new_identifiers, old_identifiers):
+        """
+        Replaces the identifiers of entities, reusing those they already have
+        """
+        if not new_identifiers:
+            return
+        rows, removed, added = [], [], []
+        for pk, identifier_set in new_identifiers.items():
+            old = old_identifiers.get(pk, {})
+            removed += [identifier_pk for identifier_pk, identifier
+                        in old.items() if identifier not in identifier_set]
+            added += [(pk, identifier) for identifier in identifier_set
+                      if identifier not in old.values()]
+        if removed:
+            Identifier.objects.filter(pk__in=removed).delete()
+        if added:
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO %s (scheme, value) VALUES %s "
+                           "RETURNING id" % (self._tables['identifier'],
+                                             ', '.join(['(%s, %s)'] * len(added))),
+                           [v for pk, identifier in added for v in identifier])
+            self._insert_m2m('_identifiers', [
+                (pk, row[0]) for (pk, identifier), row
+                in zip(added, cursor.fetchall())])
+
+    def _replace_types(self, new_types):
+        if not new_types:
+            return
+        self._delete_m2m('all_types', new_types.keys())
+        self._delete_m2m('all_types_completion', new_types.keys())
+        self._insert_m2m('all_types', [
+            (pk, type_pk) for pk, (type_pks, completion) in new_types.items()
+            for type_pk in type_pks])
+        self._insert_m2m('all_types_completion', [
+            (pk, t.pk) for pk, (type_pks, completion) in new_types.items()
+            for t in completion])
+
+    def _delete_entities(self, pks):
+        """
+        Deletes entities, along with their identifiers
+        """
+        identifier_pks = self._delete_m2m('_identifiers', pks)
+        if identifier_pks:
+            Identifier.objects.filter(pk__in=identifier_pks).delete()
+        Entity.objects.filter(pk__in=pks).delete()
@@ -1,101 +1,244 @@
-import ftplib, os, urllib, zipfile, tempfile, random, re, csv
+import ftplib, os, urllib, zipfile, tempfile, random, re, csv, hashlib
 
 from collections import defaultdict
 from StringIO import StringIO
 
-from xml.sax import ContentHandler, make_parser
+from xml.sax import ContentHandler
+
+from lxml import etree
 
 from django.contrib.gis.geos import Point
 
 from molly.apps.places.providers import BaseMapsProvider
+from molly.apps.places.providers.bulk import EntityRecord, EntitySync
 from molly.apps.places.models import EntityType, Entity, Source
+from molly.apps.places import invalidate_identifier_cache
+from molly.apps.places.layers import invalidate_layers
 from molly.conf.settings import batch
 
-class NaptanContentHandler(ContentHandler):
-
-    meta_names = {
-        ('AtcoCode',): 'atco-code',
-        ('NaptanCode',): 'naptan-code',
-        ('PlateCode',): 'plate-code',
-        ('Descriptor','CommonName'): 'common-name',
-        ('Descriptor','Indicator'): 'indicator',
-        ('Descriptor','Street'): 'street',
-        ('Place','NptgLocalityRef'): 'locality-ref',
-        ('Place','Location','Translation','Longitude'): 'longitude',
-        ('Place','Location','Translation','Latitude'): 'latitude',
-        ('AdministrativeAreaRef',): 'area',
-        ('StopClassification', 'StopType'): 'stop-type',
-    }
-
-    @staticmethod
-    def naptan_dial(c):
-        """
-        Convert a alphabetical NaPTAN code in the database to the numerical code
-        used on bus stops
-        """
-        return unicode(min(9, (ord(c)-91)//3))
+# The fields of a stop point which are imported, by their path from the
+# StopPoint element
+STOP_POINT_FIELDS = {
+    ('AtcoCode',): 'atco-code',
+    ('NaptanCode',): 'naptan-code',
+    ('PlateCode',): 'plate-code',
+    ('Descriptor','CommonName'): 'common-name',
+    ('Descriptor','Indicator'): 'indicator',
+    ('Descriptor','Street'): 'street',
+    ('Place','NptgLocalityRef'): 'locality-ref',
+    ('Place','Location','Translation','Longitude'): 'longitude',
+    ('Place','Location','Translation','Latitude'): 'latitude',
+    ('AdministrativeAreaRef',): 'area',
+    ('StopClassification', 'StopType'): 'stop-type',
+}
+
+def in_areas(atco, areas):
+    """
+    @param areas: ATCO area codes, or None for every area
+    @type areas: [str]
+    @return: Whether a stop is in one of the areas
+    """
+    if areas is None:
+        return True
+    for area in areas:
+        if atco.startswith(area):
+            return True
+    return False
+
+def _is_active(attrs):
+    return attrs.get('Status', 'active') != 'inactive' \
+       and attrs.get('Modification') != 'delete'
+
+def _get_revision(attrs):
+    return (attrs.get('RevisionNumber', ''),
+            attrs.get('ModificationDateTime', ''))
+
+def _get_field_tree(ns):
+    """
+    @return: STOP_POINT_FIELDS as a tree of the element names in a namespace,
+             whose leaves are the names of fields
+    @rtype: dict
+    """
+    tree = {}
+    for path, key in STOP_POINT_FIELDS.items():
+        node = tree
+        for name in path[:-1]:
+            node = node.setdefault(ns + name, {})
+        node[ns + path[-1]] = key
+    return tree
+
+def _read_fields(elem, tree, meta):
+    for child in elem:
+        node = tree.get(child.tag)
+        if node is None:
+            continue
+        elif isinstance(node, dict):
+            _read_fields(child, node, meta)
+        elif child.text:
+            meta[node] = child.text
+
+def iter_stop_points(f, areas=None):
+    """
+    Parses the stop points in a NaPTAN document with lxml, only looking at
+    those which are in use and in the areas being imported. Each stop point
+    is thrown away once it has been read, so the document is never held in
+    memory.
+
+    @param f: The NaPTAN document, which can be read straight from its
+              archive
+    @type f: file
+    @param areas: ATCO area codes to import stops from, or None for every area
+    @type areas: [str]
+    @return: The fields of each stop point, and its RevisionNumber and
+             ModificationDateTime
+    @rtype: iterator of (defaultdict, (str, str))
+    """
+    tree = None
+    for event, elem in etree.iterparse(f, tag='{*}StopPoint'):
+        if tree is None:
+            # NaPTAN's namespace, if the document uses it
+            ns = elem.tag[:-len('StopPoint')]
+            tree, atco_path = _get_field_tree(ns), ns + 'AtcoCode'
+
+        atco = elem.findtext(atco_path) or ''
+        if _is_active(elem.attrib) and in_areas(atco, areas):
+            meta = defaultdict(str)
+            _read_fields(elem, tree, meta)
+            meta['atco-code'] = atco
+            yield meta, _get_revision(elem.attrib)
+
+        # Throw away this stop point, and those before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-    def __init__(self, entity_types, source, nptg_localities = None, areas=None):
+class NaptanContentHandler(ContentHandler):
+    """
+    Parses the stop points in a NaPTAN document with SAX, passing the same
+    stop points as @C{iter_stop_points} to a function. This is several times
+    slower, and is kept only to check and benchmark @C{iter_stop_points}
+    against.
+    """
+
+    def __init__(self, callback, areas=None):
         self.name_stack = []
-        self.entity_types, self.source = entity_types, source
-        self.entities = set()
-        self.nptg_localities = {} if nptg_localities is None else nptg_localities
-        self.areas = areas
+        self.callback, self.areas = callback, areas
+        self.meta = defaultdict(str)
 
     def startElement(self, name, attrs):
         self.name_stack.append(name)
 
         if name == 'StopPoint':
             self.meta = defaultdict(str)
+            self.revision = _get_revision(attrs)
+            self.active = _is_active(attrs)
 
     def endElement(self, name):
         self.name_stack.pop()
 
         if name == 'StopPoint':
-            try:
-                entity_type = self.entity_types[self.meta['stop-type']]
-            except KeyError:
-                pass
-            else:
-                entity = self.add_stop(self.meta, entity_type, self.source)
-                if entity:
-                    self.entities.add(entity)
-
-    def endDocument(self):
-        pass
+            if self.active and in_areas(self.meta['atco-code'], self.areas):
+                self.callback(self.meta, self.revision)
+            # Text outside stop points (such as in stop areas, whose fields
+            # can have the same paths) mustn't end up in the last one
+            self.meta = defaultdict(str)
 
     def characters(self, text):
         top = tuple(self.name_stack[3:])
 
         try:
-            self.meta[self.meta_names[top]] += text
+            self.meta[STOP_POINT_FIELDS[top]] += text
         except KeyError:
             pass
 
-    def add_stop(self, meta, entity_type, source):
-        
-        # Check this entity is in an area
-        if self.areas != None:
-            in_area = False
-            for area in self.areas:
-                if meta['atco-code'].startswith(area):
-                    in_area = True
-            if not in_area:
-                return
+class NaptanImporter(object):
+    """
+    Imports the stop points read from a NaPTAN document
+    """
+
+    @staticmethod
+    def naptan_dial(c):
+        """
+        Convert a alphabetical NaPTAN code in the database to the numerical code
+        used on bus stops
+        """
+        return unicode(min(9, (ord(c)-91)//3))
+
+    def __init__(self, entity_types, source, nptg_localities = None, areas=None):
+        self.entity_types, self.source = entity_types, source
+        self.sync = EntitySync(source, 'atco')
+        self.nptg_localities = {} if nptg_localities is None else nptg_localities
+        self.areas = areas
         
-        # See if we're updating an existing object, or creating a new one
+        # The stops already imported from the areas being imported (rail
+        # stations are imported separately). Those which aren't seen in this
+        # import have gone, and are deleted at the end.
+        stop_types = [entity_type for stop_type, entity_type
+                      in entity_types.items() if isinstance(stop_type, basestring)]
+        self.stamps = dict((atco, stamp) for atco, stamp
+                           in self.sync.get_stamps(stop_types).iteritems()
+                           if in_areas(atco, areas))
+        self.seen = set()
+
+    def import_stop_points(self, stop_points):
+        """
+        Imports every stop point, and deletes the stops which have gone
+
+        @param stop_points: The stop points in the areas being imported, as
+                            given by @C{iter_stop_points}
+        @return: The number of stops created, modified, left unchanged and
+                 deleted
+        @rtype: dict
+        """
+        for meta, revision in stop_points:
+            self.add_stop_point(meta, revision)
+        return self.finish()
+
+    def add_stop_point(self, meta, revision):
+        atco = meta['atco-code']
         try:
-            entity = Entity.objects.get(source=source,
-                                        _identifiers__scheme='atco',
-                                        _identifiers__value=meta['atco-code'])
-        except Entity.DoesNotExist:
-            entity = Entity(source=source)
-        except Entity.MultipleObjectsReturned:
-            # Handle clashes
-            Entity.objects.filter(source=source,
-                                 _identifiers__scheme='atco',
-                                 _identifiers__value=meta['atco-code']).delete()
-            entity = Entity(source=source)
+            entity_type = self.entity_types[meta['stop-type']]
+        except KeyError:
+            return
+        
+        stamp = self.get_stamp(meta, revision)
+        if stamp and self.stamps.get(atco, (None, None))[1] == stamp:
+            # Not revised since the last import
+            self.seen.add(atco)
+            self.sync.skip(atco)
+            return
+        
+        record = self.add_stop(meta, entity_type, self.source)
+        if record:
+            record.stamp = stamp
+            self.seen.add(atco)
+            self.sync.add(record)
+
+    def finish(self):
+        self.sync.finish()
+        self.sync.delete(pk for atco, (pk, stamp) in self.stamps.iteritems()
+                         if atco not in self.seen)
+        return self.sync.counts
+
+    def get_stamp(self, meta, revision):
+        """
+        @param revision: The RevisionNumber and ModificationDateTime of the
+                         stop
+        @return: A stamp which changes whenever the stop is revised, or the
+                 name of its locality (which is part of its title) changes,
+                 or an empty string if the record doesn't say when it was
+                 revised
+        @rtype: str
+        """
+        if not any(revision):
+            return ''
+        stamp = '%s@%s' % revision
+        locality = self.nptg_localities.get(meta['locality-ref'])
+        if locality:
+            stamp += '/' + hashlib.md5(locality).hexdigest()[:8]
+        return stamp
+
+    def add_stop(self, meta, entity_type, source):
         
         common_name, indicator, locality, street = [meta.get(k) for k in
                     ('common-name', 'indicator', 'locality-ref', 'street')]
@@ -130,15 +273,6 @@ class NaptanContentHandler(ContentHandler):
         if locality != None:
             title += ', ' + locality
         
-        entity.title = title
-        entity.primary_type = entity_type
-
-        if not entity.metadata:
-            entity.metadata = {}
-        entity.metadata['naptan'] = meta
-        entity.location = Point(float(meta['longitude']), float(meta['latitude']), srid=4326)
-        entity.geometry = entity.location
-
         identifiers = {
             'atco': meta['atco-code'],
         }
@@ -150,12 +284,13 @@ class NaptanContentHandler(ContentHandler):
         if indicator != None and re.match('Stop [A-Z]\d\d?', indicator):
             identifiers['stop'] = indicator[5:]
 
-        entity.save(identifiers=identifiers)
-        entity.all_types.add(entity_type)
-        
-        entity.update_all_types_completion()
-
-        return entity
+        return EntityRecord(
+            identifiers = identifiers,
+            title = title,
+            primary_type = entity_type,
+            location = Point(float(meta['longitude']), float(meta['latitude']), srid=4326),
+            metadata = {'naptan': meta},
+        )
 
 
 class NaptanMapsProvider(BaseMapsProvider):
@@ -225,6 +360,8 @@ class NaptanMapsProvider(BaseMapsProvider):
         elif self._method == 'ftp':
             self._import_from_ftp()
         
+        invalidate_layers(self._entity_types.values())
+        invalidate_identifier_cache()
         return metadata
     
     def _connect_to_ftp(self):
@@ -313,7 +450,8 @@ class NaptanMapsProvider(BaseMapsProvider):
                     f = archive.open('NaPTAN%d.xml' % int(area))
                 else:
                     f = StringIO(archive.read('NaPTAN%d.xml' % int(area)))
-                self._import_from_pipe(f, localities)
+                # Each file only has the stops in its own area
+                self._import_from_pipe(f, localities, areas=[area])
                 archive.close()
                 os.unlink(filename)
 
@@ -357,9 +495,8 @@ class NaptanMapsProvider(BaseMapsProvider):
         os.unlink(filename)
 
     def _import_from_pipe(self, pipe_r, localities, areas=None):
-        parser = make_parser()
-        parser.setContentHandler(NaptanContentHandler(self._entity_types, self._source, localities, areas))
-        parser.parse(pipe_r)
+        importer = NaptanImporter(self._entity_types, self._source, localities, areas)
+        importer.import_stop_points(iter_stop_points(pipe_r, areas))
 
     def _import_stations(self, f, source, entity_type):
         
@@ -372,28 +509,26 @@ class NaptanMapsProvider(BaseMapsProvider):
         csvfile = csv.reader(f)
         csvfile.next()
 
+        sync = EntitySync(source, 'atco')
         for line in csvfile:
             atco, tiploc, crs, name, lang, grid_type, east, north, created, modified, rev, mod_type = line
 
-            entity, created = Entity.objects.get_or_create(source=source, _identifiers__scheme='atco', _identifiers__value=atco)
-            if modified == entity.metadata.get('naptan', {}).get('modified', ''):
-                continue
-
-            entity.title = name
-            entity.location = entity.geometry = Point(int(east), int(north), srid=27700) # GB National Grid
-            entity.primary_type = entity_type
-
-            entity.metadata['naptan'] = {
-                'modified': modified,
-            }
-
-            entity.save(identifiers={
-                'atco': atco,
-                'crs': crs,
-                'tiploc': tiploc,
-            })
-            entity.all_types.add(entity_type)
-            entity.update_all_types_completion()
+            sync.add(EntityRecord(
+                identifiers = {
+                    'atco': atco,
+                    'crs': crs,
+                    'tiploc': tiploc,
+                },
+                title = name,
+                primary_type = entity_type,
+                location = Point(int(east), int(north), srid=27700), # GB National Grid
+                metadata = {
+                    'naptan': {
+                        'modified': modified,
+                    },
+                },
+            ))
+        sync.finish()
 
     def _get_nptg(self, f):
         localities = {}
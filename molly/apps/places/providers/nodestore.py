@@ -0,0 +1,383 @@
+"""
+Stores of the locations of OpenStreetMap nodes, which the OSM importer keeps
+while it reads the nodes so that it can work out the shapes of the ways which
+come after them.
+
+A dictionary of tuples costs well over a hundred bytes a node, which for a
+country's worth of nodes is several gigabytes. These stores keep each node in
+a fixed-size record instead:
+
+ * @C{ArrayNodeStore} (the default) keeps them in memory, in arrays, at 16
+   bytes a node
+ * @C{MmapNodeStore} writes them to a temporary file and maps it in to
+   memory, so that they take up page cache rather than the importer's memory
+ * @C{SQLiteNodeStore} writes them to a temporary SQLite database, which is
+   the slowest, but doesn't mind what order nodes come in. It can also be
+   kept between imports, along with the nodes of each way imported, so that
+   diffs can be applied to it.
+
+Locations are kept to the seven decimal places OpenStreetMap gives them to, as
+integers, and so come back exactly as they were read.
+"""
+
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+from array import array
+from bisect import bisect_right
+
+# OpenStreetMap gives co-ordinates to seven decimal places
+SCALE = 10 ** 7
+
+# Node ids no longer fit in 32 bits. Where a C long doesn't hold 64, doubles
+# hold whole numbers exactly up to 2 ** 53.
+_ID_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
+
+def _to_fixed(x):
+    return int(round(x * SCALE))
+
+def _from_fixed(n):
+    return n / float(SCALE)
+
+class NodeStore(object):
+    """
+    The locations of nodes, by id. Nodes are added as they are read, and
+    looked up once they have been. If a node is added more than once, the
+    last location added is kept.
+    """
+
+    # Whether the store is kept between imports, and so can have diffs
+    # applied to it
+    persistent = False
+
+    def __init__(self, directory=None):
+        """
+        @param directory: The directory any temporary files are made in,
+                          which defaults to the system's
+        @type directory: str
+        """
+        self.directory = directory
+
+    def add(self, id, lon, lat):
+        """
+        @type id: int
+        @type lon: float
+        @type lat: float
+        """
+        raise NotImplementedError
+
+    def get(self, id):
+        """
+        @return: The location of a node, or None if it isn't stored
+        @rtype: (float, float)
+        """
+        raise NotImplementedError
+
+    def remove(self, id):
+        """
+        Forgets a node, until it is added again
+        """
+        raise NotImplementedError
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def add_way(self, id, nodes):
+        """
+        Notes the nodes of a way which has been imported, so that it can be
+        found again when one of them moves. Only stores which are kept
+        between imports need to do this.
+
+        @type id: int
+        @type nodes: [int]
+        """
+        pass
+
+    def remove_way(self, id):
+        pass
+
+    def get_way(self, id):
+        """
+        @return: The nodes of an imported way, or None if they aren't known
+        @rtype: [int]
+        """
+        return None
+
+    def get_ways_of(self, ids):
+        """
+        @return: The imported ways which any of these nodes are in
+        @rtype: set
+        """
+        return set()
+
+    def __len__(self):
+        """
+        @return: The number of nodes stored, counting each id once however
+                 many times it has been added
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Frees the store, deleting any temporary files
+        """
+        pass
+
+class ArrayNodeStore(NodeStore):
+    """
+    Keeps nodes in three arrays, of ids, longitudes and latitudes, which are
+    looked up by binary search. Extracts list nodes in order of id; if they
+    come in any other order, the arrays are sorted before the first look up.
+    """
+
+    def __init__(self, directory=None):
+        super(ArrayNodeStore, self).__init__(directory)
+        self.ids = array(_ID_TYPECODE)
+        self.lons, self.lats = array('i'), array('i')
+        self._sorted = True
+        # Nodes which have been removed, as they can't be taken out of the
+        # arrays cheaply
+        self._removed = set()
+
+    def add(self, id, lon, lat):
+        if self._removed:
+            self._removed.discard(id)
+        if self._sorted and self.ids and id <= self.ids[-1]:
+            if id == self.ids[-1]:
+                # Replace the node's location rather than keeping both
+                self.lons[-1], self.lats[-1] = _to_fixed(lon), _to_fixed(lat)
+                return
+            self._sorted = False
+        self.ids.append(id)
+        self.lons.append(_to_fixed(lon))
+        self.lats.append(_to_fixed(lat))
+
+    def _sort(self):
+        # sorted() is stable, so the last of any duplicates stays last, and
+        # is the only one kept
+        ids = self.ids
+        order = sorted(xrange(len(ids)), key=ids.__getitem__)
+        order = [i for n, i in enumerate(order)
+                 if n + 1 == len(order) or ids[order[n + 1]] != ids[i]]
+        self.ids = array(_ID_TYPECODE, (self.ids[i] for i in order))
+        self.lons = array('i', (self.lons[i] for i in order))
+        self.lats = array('i', (self.lats[i] for i in order))
+        self._sorted = True
+
+    def get(self, id):
+        if self._removed and id in self._removed:
+            return None
+        if not self._sorted:
+            self._sort()
+        i = bisect_right(self.ids, id) - 1
+        if i >= 0 and self.ids[i] == id:
+            return _from_fixed(self.lons[i]), _from_fixed(self.lats[i])
+        return None
+
+    def remove(self, id):
+        if id in self:
+            self._removed.add(id)
+
+    def __len__(self):
+        if not self._sorted:
+            self._sort()
+        return len(self.ids) - len(self._removed)
+
+class MmapNodeStore(NodeStore):
+    """
+    Writes nodes to a temporary file of fixed-size records, which is mapped
+    in to memory and looked up by binary search. As the file can't be sorted
+    in place, nodes must be added in order of id, as they are in extracts,
+    and removed nodes are only noted in memory.
+    """
+
+    RECORD = struct.Struct('<qii')
+
+    def __init__(self, directory=None):
+        super(MmapNodeStore, self).__init__(directory)
+        self._file = tempfile.TemporaryFile(prefix='molly-osm-nodes-',
+                                            dir=directory)
+        self._map, self._count, self._last = None, 0, None
+        self._removed = set()
+
+    def add(self, id, lon, lat):
+        if self._last is not None and id < self._last:
+            raise ValueError("Nodes must be added to a MmapNodeStore in order "
+                             "of id, but %d came after %d" % (id, self._last))
+        if self._removed:
+            self._removed.discard(id)
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._file.seek(0, os.SEEK_END)
+        if id == self._last:
+            # Replace the node's record rather than keeping both
+            self._file.seek(-self.RECORD.size, os.SEEK_CUR)
+            self._count -= 1
+        self._file.write(self.RECORD.pack(id, _to_fixed(lon), _to_fixed(lat)))
+        self._count += 1
+        self._last = id
+
+    def get(self, id):
+        if not self._count or (self._removed and id in self._removed):
+            return None
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        size, unpack_from = self.RECORD.size, self.RECORD.unpack_from
+        # Find the last record with this id
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpack_from(self._map, mid * size)[0] <= id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo:
+            found, lon, lat = unpack_from(self._map, (lo - 1) * size)
+            if found == id:
+                return _from_fixed(lon), _from_fixed(lat)
+        return None
+
+    def remove(self, id):
+        if id in self:
+            self._removed.add(id)
+
+    def __len__(self):
+        return self._count - len(self._removed)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+class SQLiteNodeStore(NodeStore):
+    """
+    Writes nodes to a SQLite database, in batches. The database is temporary,
+    unless it is given a filename, in which case it is kept (along with the
+    nodes of each way imported) for the next import to use.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, directory=None, filename=None):
+        """
+        @param filename: The database to keep nodes in between imports
+        @type filename: str
+        """
+        super(SQLiteNodeStore, self).__init__(directory)
+        self.persistent = filename is not None
+        if not self.persistent:
+            fd, filename = tempfile.mkstemp(prefix='molly-osm-nodes-',
+                                            suffix='.sqlite', dir=directory)
+            os.close(fd)
+        self._filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.execute('PRAGMA synchronous = OFF')
+        if not self.persistent:
+            # The database is thrown away if anything goes wrong
+            self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('CREATE TABLE IF NOT EXISTS nodes ('
+                         'id INTEGER PRIMARY KEY, '
+                         'lon INTEGER NOT NULL, lat INTEGER NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS way_nodes ('
+                         'way INTEGER NOT NULL, seq INTEGER NOT NULL, '
+                         'node INTEGER NOT NULL, PRIMARY KEY (way, seq))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS way_nodes_node '
+                         'ON way_nodes (node)')
+        self._pending = []
+
+    def clear(self):
+        """
+        Forgets every node and way, before a full import
+        """
+        self._pending = []
+        self._db.execute('DELETE FROM nodes')
+        self._db.execute('DELETE FROM way_nodes')
+        self._db.commit()
+
+    def add(self, id, lon, lat):
+        self._pending.append((id, _to_fixed(lon), _to_fixed(lat)))
+        if len(self._pending) >= self.BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._db.executemany('INSERT OR REPLACE INTO nodes (id, lon, lat) '
+                                 'VALUES (?, ?, ?)', self._pending)
+            self._pending = []
+        self._db.commit()
+
+    def get(self, id):
+        if self._pending:
+            self._flush()
+        row = self._db.execute('SELECT lon, lat FROM nodes WHERE id = ?',
+                               (id,)).fetchone()
+        if row is None:
+            return None
+        return _from_fixed(row[0]), _from_fixed(row[1])
+
+    def remove(self, id):
+        self._flush()
+        self._db.execute('DELETE FROM nodes WHERE id = ?', (id,))
+
+    def __len__(self):
+        self._flush()
+        return self._db.execute('SELECT count(*) FROM nodes').fetchone()[0]
+
+    def add_way(self, id, nodes):
+        if not self.persistent:
+            return
+        self.remove_way(id)
+        self._db.executemany('INSERT INTO way_nodes (way, seq, node) '
+                             'VALUES (?, ?, ?)',
+                             [(id, seq, node) for seq, node in enumerate(nodes)])
+
+    def remove_way(self, id):
+        if self.persistent:
+            self._db.execute('DELETE FROM way_nodes WHERE way = ?', (id,))
+
+    def get_way(self, id):
+        nodes = [row[0] for row in self._db.execute(
+            'SELECT node FROM way_nodes WHERE way = ? ORDER BY seq', (id,))]
+        return nodes or None
+
+    def get_ways_of(self, ids):
+        ids, ways = list(ids), set()
+        # SQLite allows at most 999 parameters
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i+500]
+            ways.update(row[0] for row in self._db.execute(
+                'SELECT DISTINCT way FROM way_nodes WHERE node IN (%s)'
+                % ', '.join(['?'] * len(batch)), batch))
+        return ways
+
+    def close(self):
+        if self._db is None:
+            return
+        self._flush()
+        self._db.close()
+        self._db = None
+        if not self.persistent:
+            os.unlink(self._filename)
+
+NODE_STORES = {
+    'array': ArrayNodeStore,
+    'mmap': MmapNodeStore,
+    'sqlite': SQLiteNodeStore,
+}
+
+def get_node_store(name, directory=None):
+    """
+    @param name: The kind of store, one of 'array', 'mmap' or 'sqlite'
+    @type name: str
+    @rtype: NodeStore
+    """
+    try:
+        cls = NODE_STORES[name]
+    except KeyError:
+        raise ValueError("Unknown node store %r" % name)
+    return cls(directory)
@@ -4,12 +4,17 @@ from django.conf import settings
 
 from molly.apps.places.models import Entity, EntityType, Source
 from molly.apps.places.providers import BaseMapsProvider
+from molly.apps.places.providers.bulk import EntityRecord, EntitySync
+from molly.apps.places.providers.nodestore import NodeStore, SQLiteNodeStore, get_node_store
+from molly.apps.places import get_entities, invalidate_identifier_cache
+from molly.apps.places.layers import invalidate_layers
 from molly.utils.misc import AnyMethodRequest
 from molly.geolocation import reverse_geocode
 from molly.conf.settings import batch
 
 from xml.sax import saxutils, handler, make_parser
-import urllib2, bz2, subprocess, sys, random
+from StringIO import StringIO
+import urllib, urllib2, bz2, gzip, subprocess, sys, random, re, os, tempfile, time
 from os import path
 
 def node_id(id):
@@ -17,8 +22,83 @@ def node_id(id):
 def way_id(id):
     return "W%d" % int(id)
 
+def get_osm_node_db():
+    """
+    @return: The SQLite database the locations of nodes are kept in between
+             imports, when OpenStreetMap diffs are applied
+    """
+    return getattr(settings, 'PLACES_OSM_NODE_DB',
+                   path.join(settings.CACHE_DIR, 'osm_nodes.sqlite'))
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def parse_pbf(filename, content_handler):
+    """
+    Reads the nodes and ways in an .osm.pbf file, passing them to a SAX
+    content handler as though they had been read from XML. This needs
+    pyosmium (the osmium package), which is not installed with Molly.
+    """
+    import osmium
+
+    def get_attrs(o, **extra):
+        attrs = {
+            'id': str(o.id),
+            'version': str(o.version),
+            'changeset': str(o.changeset),
+            'uid': str(o.uid),
+            'user': _text(o.user),
+            'timestamp': o.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+        attrs.update(extra)
+        return attrs
+
+    def send_tags(o):
+        for tag in o.tags:
+            content_handler.startElement('tag', {'k': _text(tag.k),
+                                                 'v': _text(tag.v)})
+            content_handler.endElement('tag')
+
+    class PBFHandler(osmium.SimpleHandler):
+        def node(self, n):
+            content_handler.startElement('node', get_attrs(n,
+                lon='%.7f' % n.location.lon, lat='%.7f' % n.location.lat))
+            send_tags(n)
+            content_handler.endElement('node')
+
+        def way(self, w):
+            content_handler.startElement('way', get_attrs(w))
+            for node in w.nodes:
+                content_handler.startElement('nd', {'ref': node.ref})
+                content_handler.endElement('nd')
+            send_tags(w)
+            content_handler.endElement('way')
+
+    content_handler.startDocument()
+    PBFHandler().apply_file(filename)
+    content_handler.endDocument()
+
+def get_pbf_sequence(filename):
+    """
+    @return: The replication sequence number an .osm.pbf file is up to date
+             with, if its header says
+    @rtype: int or None
+    """
+    import osmium
+    reader = osmium.io.Reader(filename, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        sequence = reader.header().get('osmosis_replication_sequence_number')
+    finally:
+        reader.close()
+    return int(sequence) if sequence else None
+
 class OSMHandler(handler.ContentHandler):
-    def __init__(self, source, entity_types, find_types, output, lat_north=None, lat_south=None, lon_west=None, lon_east=None):
+    # Entities which are no longer in the data are deleted
+    delete_missing = True
+
+    def __init__(self, source, entity_types, find_types, output, lat_north=None, lat_south=None, lon_west=None, lon_east=None, node_store='array'):
         self.source = source
         self.entity_types = entity_types
         self.find_types = find_types
@@ -27,17 +107,21 @@ class OSMHandler(handler.ContentHandler):
         self._lat_south = lat_south
         self._lon_west = lon_west
         self._lon_east = lon_east
+        self._node_store = node_store
 
     def startDocument(self):
-        self.ids = set()
         self.tags = {}
         self.valid_node = True
 
-        self.create_count, self.modify_count = 0,0
-        self.delete_count, self.unchanged_count = 0,0
+        self.sync = EntitySync(self.source, 'osm',
+                               delete_missing=self.delete_missing)
         self.ignore_count = 0
 
-        self.node_locations = {}
+        # Only nodes inside the bounding box are kept
+        if isinstance(self._node_store, NodeStore):
+            self.node_locations = self._node_store
+        else:
+            self.node_locations = get_node_store(self._node_store)
 
     def startElement(self, name, attrs):
         if name == 'node':
@@ -55,9 +139,8 @@ class OSMHandler(handler.ContentHandler):
             self.node_location = lon, lat
             self.attrs = attrs
             self.id = id
-            self.ids.add(id)
             self.tags = {}
-            self.node_locations[id] = lon, lat
+            self.node_locations.add(int(attrs['id']), lon, lat)
 
         elif name == 'tag' and self.valid:
             self.tags[attrs['k']] = attrs['v']
@@ -69,97 +152,113 @@ class OSMHandler(handler.ContentHandler):
 
             id = way_id(attrs['id'])
 
+            self.attrs = attrs
             self.id = id
-            self.ids.add(id)
 
         elif name == 'nd':
-            self.nodes.append( node_id(attrs['ref']) )
+            self.nodes.append(int(attrs['ref']))
 
     def endElement(self, name):
-        if name in ('node','way') and self.valid:
-            try:
-                types = self.find_types(self.tags)
-            except ValueError:
-                self.ignore_count += 1
-                return
+        if name == 'node' and self.valid:
+            self.import_element(name, self.id, self.attrs, self.tags,
+                                location=self.node_location)
+        elif name == 'way' and self.valid:
+            self.import_element(name, self.id, self.attrs, self.tags,
+                                nodes=self.nodes)
+
+    def import_element(self, name, id, attrs, tags, location=None, nodes=None):
+        """
+        Imports a node or a way, if it is something we have an entity type for
 
-            # Ignore ways that lay partly outside our bounding box
-            if name == 'way' and not all(id in self.node_locations for id in self.nodes):
-                return
+        @param location: The location of a node
+        @type location: (float, float)
+        @param nodes: The ids of the nodes of a way
+        @type nodes: [int]
+        """
+        try:
+            types = self.find_types(tags)
+        except ValueError:
+            self.ignore_count += 1
+            self.drop(id)
+            return
 
-            # We already have these from OxPoints, so leave them alone.
-            if self.tags.get('amenity') == 'library' and self.tags.get('operator') == 'University of Oxford':
+        # Ignore ways that lay partly outside our bounding box, but keep
+        # any we already have
+        if name == 'way':
+            locations = [self.node_locations.get(n) for n in nodes]
+            if None in locations:
+                self.sync.keep(id)
                 return
 
-            # Ignore disused and under-construction entities
-            if self.tags.get('life_cycle', 'in_use') != 'in_use' or self.tags.get('disused') in ('1', 'yes', 'true'):
-                return
+        # We already have these from OxPoints, so leave them alone.
+        if tags.get('amenity') == 'library' and tags.get('operator') == 'University of Oxford':
+            self.drop(id)
+            return
 
-            try:
-                entity = Entity.objects.get(source=self.source, _identifiers__scheme='osm', _identifiers__value=self.id)
-                created = True
-            except Entity.DoesNotExist:
-                entity = Entity(source=self.source)
-                created = False
+        # Ignore disused and under-construction entities
+        if tags.get('life_cycle', 'in_use') != 'in_use' or tags.get('disused') in ('1', 'yes', 'true'):
+            self.drop(id)
+            return
 
-            if not 'osm' in entity.metadata or entity.metadata['osm'].get('attrs', {}).get('timestamp', '') < self.attrs['timestamp']:
+        if name == 'node':
+            location = Point(location, srid=4326)
+            geometry = location
+        elif name == 'way':
+            cls = LinearRing if nodes[0] == nodes[-1] else LineString
+            geometry = cls(locations, srid=4326)
+            min_, max_ = (float('inf'), float('inf')), (float('-inf'), float('-inf'))
+            for lon, lat in locations:
+                min_ = min(min_[0], lon), min(min_[1], lat) 
+                max_ = max(max_[0], lon), max(max_[1], lat)
+            location = Point( (min_[0]+max_[0])/2 , (min_[1]+max_[1])/2 , srid=4326)
+            self.node_locations.add_way(int(id[1:]), nodes)
+        else:
+            raise AssertionError("There should be no other types of entity we're to deal with.")
+
+        self.sync.add(EntityRecord(
+            identifiers = {'osm': id},
+            title = self.get_title(tags, location),
+            primary_type = self.entity_types[types[0]],
+            all_types = [self.entity_types[et] for et in types],
+            location = location,
+            geometry = geometry,
+            metadata = {
+                'osm': {
+                    'attrs': dict(attrs),
+                    'tags': tags
+                },
+            },
+        ))
 
-                if created:
-                    self.create_count += 1
-                else:
-                    self.modify_count += 1
-
-                if name == 'node':
-                    entity.location = Point(self.node_location, srid=4326)
-                    entity.geometry = entity.location
-                elif name == 'way':
-                    cls = LinearRing if self.nodes[0] == self.nodes[-1] else LineString
-                    entity.geometry = cls([self.node_locations[n] for n in self.nodes], srid=4326)
-                    min_, max_ = (float('inf'), float('inf')), (float('-inf'), float('-inf'))
-                    for lon, lat in [self.node_locations[n] for n in self.nodes]:
-                        min_ = min(min_[0], lon), min(min_[1], lat) 
-                        max_ = max(max_[0], lon), max(max_[1], lat)
-                    entity.location = Point( (min_[0]+max_[0])/2 , (min_[1]+max_[1])/2 , srid=4326)
-                else:
-                    raise AssertionError("There should be no other types of entity we're to deal with.")
+    def drop(self, id):
+        """
+        Called for a node or way which isn't an entity. Those which were
+        entities are deleted once the import has finished.
+        """
+        pass
 
+    def get_title(self, tags, location):
+        """
+        @return: A function returning the title of an entity, which is only
+                 called when the entity is new or has changed, as entities
+                 without names are named after the nearest street
+        """
+        def title():
+            try:
+                return tags.get('name') or tags['operator']
+            except KeyError:
                 try:
-                    name = self.tags.get('name') or self.tags['operator']
-                except (KeyError, AssertionError):
-                    try:
-                        name = reverse_geocode(*entity.location)[0]['name']
-                        if not name:
-                            raise IndexError
-                        name = u"↝ %s" % name
-                    except IndexError:
-                        name = u"↝ %f, %f" % (self.node_location[1], self.node_location[0])
-
-                entity.title = name
-                entity.metadata['osm'] = {
-                    'attrs': dict(self.attrs),
-                    'tags': self.tags
-                }
-                entity.primary_type = self.entity_types[types[0]]
-
-                if 'addr:postcode' in self.tags:
-                    entity.post_code = self.tags['addr:postcode'].replace(' ', '')
-                else:
-                    entity.post_code = ""
-
-                entity.save(identifiers={'osm': self.id})
-
-                entity.all_types = [self.entity_types[et] for et in types]
-                entity.update_all_types_completion()
-
-            else:
-                self.unchanged_count += 1
+                    name = reverse_geocode(*location)[0]['name']
+                    if not name:
+                        raise IndexError
+                    return u"↝ %s" % name
+                except IndexError:
+                    return u"↝ %f, %f" % (location[1], location[0])
+        return title
 
     def endDocument(self):
-        for entity in Entity.objects.filter(source=self.source):
-            if not entity.identifiers['osm'] in self.ids:
-                entity.delete()
-                self.delete_count += 1
-
+        self.node_locations.close()
+        counts = self.sync.finish()
         self.output.write("""\
 Complete
   Created:   %6d
@@ -168,17 +267,86 @@ Complete
   Unchanged: %6d
   Ignored:   %6d
 """ % (
-            self.create_count,
-            self.modify_count,
-            self.delete_count,
-            self.unchanged_count,
+            counts['created'],
+            counts['modified'],
+            counts['deleted'],
+            counts['unchanged'],
             self.ignore_count,
         ))
 
+class OSMChangeHandler(OSMHandler):
+    """
+    Applies an osmChange diff, as published by OpenStreetMap's replication, to
+    the entities imported by @C{OSMHandler}. Only the nodes and ways in the
+    diff are looked at, so this needs the node store the last import kept,
+    and entities are only deleted when the diff deletes them, or they no
+    longer have a type we import. Ways which aren't in the diff are updated
+    if any of their nodes have moved.
+    """
+    delete_missing = False
+
+    def startDocument(self):
+        OSMHandler.startDocument(self)
+        if not self.node_locations.persistent:
+            raise ValueError("Diffs can only be applied to the nodes kept "
+                             "from the last import, in a SQLiteNodeStore "
+                             "with a filename")
+        self.action = None
+        self.moved, self.changed_ways = set(), set()
+
+    def startElement(self, name, attrs):
+        if name in ('create', 'modify', 'delete'):
+            self.action = name
+            return
+
+        if self.action == 'delete':
+            if name == 'node':
+                self.node_locations.remove(int(attrs['id']))
+                self.drop(node_id(attrs['id']))
+            elif name == 'way':
+                self.changed_ways.add(int(attrs['id']))
+                self.drop(way_id(attrs['id']))
+            # Deleted elements can still have their tags and nodes
+            self.valid = False
+            return
+
+        OSMHandler.startElement(self, name, attrs)
+        if name == 'node':
+            self.moved.add(int(attrs['id']))
+            if not self.valid:
+                # It has moved outside the bounding box
+                self.node_locations.remove(int(attrs['id']))
+                self.drop(node_id(attrs['id']))
+        elif name == 'way':
+            self.changed_ways.add(int(attrs['id']))
+
+    def endElement(self, name):
+        if name in ('create', 'modify', 'delete'):
+            self.action = None
+        else:
+            OSMHandler.endElement(self, name)
+
+    def endDocument(self):
+        ways = self.node_locations.get_ways_of(self.moved) - self.changed_ways
+        entities = get_entities('osm', [way_id(way) for way in ways])
+        for way in ways:
+            entity, nodes = entities.get(way_id(way)), self.node_locations.get_way(way)
+            if entity is None or nodes is None:
+                continue
+            self.import_element('way', way_id(way),
+                                entity.metadata['osm']['attrs'],
+                                entity.metadata['osm']['tags'], nodes=nodes)
+        OSMHandler.endDocument(self)
+
+    def drop(self, id):
+        self.sync.remove(id)
+        if id.startswith('W'):
+            self.node_locations.remove_way(int(id[1:]))
+
 class OSMMapsProvider(BaseMapsProvider):
     SHELL_CMD = "wget -O- %s --quiet | bunzip2"
 
-    def __init__(self, lat_north=None, lat_south=None, lon_west=None, lon_east=None, url='http://download.geofabrik.de/osm/europe/great_britain/england.osm.bz2'):
+    def __init__(self, lat_north=None, lat_south=None, lon_west=None, lon_east=None, url='http://download.geofabrik.de/osm/europe/great_britain/england.osm.bz2', node_store='array', replication_url=None, full_import_interval=7):
         """
         @param lat_north: A limit of the northern-most latitude to import points
                           for
@@ -192,45 +360,181 @@ class OSMMapsProvider(BaseMapsProvider):
         @param lon_east: A limit of the eastern-most longitude to import points
                           for
         @type lon_east: float
+        @param url: The extract to import, either bzipped XML (.osm.bz2) or,
+                    if pyosmium is installed, PBF (.osm.pbf)
+        @type url: str
+        @param node_store: How to keep the locations of nodes while ways are
+                           imported: 'array' (in memory, the default),
+                           'mmap' (in a memory-mapped temporary file) or
+                           'sqlite' (in a temporary SQLite database). See
+                           L{molly.apps.places.providers.nodestore}. When
+                           diffs are applied, nodes are always kept in the
+                           PLACES_OSM_NODE_DB SQLite database.
+        @type node_store: str
+        @param replication_url: The replication directory of diffs for the
+                                extract (the one with state.txt in it). If
+                                this is given, after the first full import
+                                each run only applies the diffs published
+                                since the last.
+        @type replication_url: str
+        @param full_import_interval: How many days to leave between full
+                                     imports, or None to only ever apply
+                                     diffs after the first
+        @type full_import_interval: int
         """
         self._lat_north = lat_north
         self._lat_south = lat_south
         self._lon_west = lon_west
         self._lon_east = lon_east
         self._url = url
+        self._node_store = node_store
+        self._replication_url = replication_url
+        self._full_import_interval = full_import_interval
 
-    @batch('%d 9 * * mon' % random.randint(0, 59))
+    @batch('%d 9 * * *' % random.randint(0, 59))
     def import_data(self, metadata, output):
         "Imports places data from OpenStreetMap"
 
-        old_etag = metadata.get('etag', '')
-
+        metadata = dict(metadata)
+        source = self._get_source()
+        entity_types = self._get_entity_types()
+
+        if self._full_import_due(metadata):
+            self._import_full(metadata, output, source, entity_types)
+        if self._replication_url and 'sequence' in metadata:
+            self._apply_diffs(metadata, output, source, entity_types)
+
+        invalidate_layers(entity_types.values())
+        invalidate_identifier_cache()
+
+        return metadata
+
+    def _get_handler(self, cls, source, entity_types, output, node_store):
+        return cls(source, entity_types, self._find_types, output,
+                   self._lat_north, self._lat_south,
+                   self._lon_west, self._lon_east, node_store)
+
+    def _full_import_due(self, metadata):
+        last_import = metadata.get('full_import')
+        if last_import is None:
+            return True
+        if self._replication_url is None:
+            # Without diffs, a full import is the only way to update
+            return self._full_import_interval is None or \
+                time.time() - last_import >= self._full_import_interval * 86400 - 3600
+        if 'sequence' not in metadata:
+            return True
+        if self._full_import_interval is None:
+            return False
+        # An hour's grace, as the batch doesn't start at exactly the same
+        # time each day
+        return time.time() - last_import >= self._full_import_interval * 86400 - 3600
+
+    def _get_etag(self):
         request = AnyMethodRequest(self._url, method='HEAD')
         response = urllib2.urlopen(request)
-        new_etag = response.headers['ETag'][1:-1]
+        return response.headers.get('ETag', '')[1:-1]
 
-        if False and new_etag == old_etag:
+    def _import_full(self, metadata, output, source, entity_types):
+        new_etag = self._get_etag()
+        if new_etag and new_etag == metadata.get('etag'):
             output.write('OSM data not updated. Not updating.\n')
             return
 
-        p = subprocess.Popen([self.SHELL_CMD % self._url], shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
-
-        parser = make_parser()
-        parser.setContentHandler(OSMHandler(self._get_source(),
-                                            self._get_entity_types(),
-                                            self._find_types,
-                                            output,
-                                            self._lat_north,
-                                            self._lat_south,
-                                            self._lon_west,
-                                            self._lon_east))
-        parser.parse(p.stdout)
-        
-        self.disambiguate_titles(self._get_source())
-
-        return {
+        if self._replication_url:
+            # Diffs are applied from the state the extract was made at. If
+            # the extract doesn't say, the state before it was downloaded is
+            # used; applying changes the extract already has again does no
+            # harm, as later diffs are applied after them.
+            sequence = self._get_replication_sequence()
+            # The nodes are kept in a new database, which only replaces the
+            # one diffs are applied to once the import has succeeded, as the
+            # last full import is used until then
+            node_db = get_osm_node_db()
+            temp_node_db = '%s.%d.tmp' % (node_db, os.getpid())
+            if path.exists(temp_node_db):
+                os.unlink(temp_node_db)
+            node_store = SQLiteNodeStore(filename=temp_node_db)
+        else:
+            node_store = self._node_store
+        content_handler = self._get_handler(OSMHandler, source, entity_types,
+                                            output, node_store)
+
+        try:
+            if self._url.endswith('.pbf'):
+                fd, filename = tempfile.mkstemp(suffix='.osm.pbf')
+                os.close(fd)
+                try:
+                    urllib.urlretrieve(self._url, filename)
+                    if self._replication_url:
+                        sequence = get_pbf_sequence(filename) or sequence
+                    parse_pbf(filename, content_handler)
+                finally:
+                    os.unlink(filename)
+            else:
+                p = subprocess.Popen([self.SHELL_CMD % self._url], shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+                parser = make_parser()
+                parser.setContentHandler(content_handler)
+                parser.parse(p.stdout)
+
+            self.disambiguate_titles(source)
+        except:
+            # The handler only closes its node store at the end of the
+            # document, so any temporary files it keeps would be left behind
+            if self._replication_url:
+                node_store.close()
+                os.unlink(temp_node_db)
+            elif hasattr(content_handler, 'node_locations'):
+                content_handler.node_locations.close()
+            raise
+
+        metadata.update({
             'etag': new_etag,
-        }
+            'full_import': time.time(),
+        })
+        if self._replication_url:
+            os.rename(temp_node_db, node_db)
+            metadata['sequence'] = sequence
+
+    def _get_replication_sequence(self):
+        """
+        @return: The sequence number of the latest diff
+        @rtype: int
+        """
+        state = urllib2.urlopen('%s/state.txt' % self._replication_url.rstrip('/')).read()
+        match = re.search(r'^sequenceNumber=(\d+)', state, re.MULTILINE)
+        if not match:
+            raise ValueError("No sequence number in the replication state")
+        return int(match.group(1))
+
+    def _get_diff_url(self, sequence):
+        return '%s/%03d/%03d/%03d.osc.gz' % (self._replication_url.rstrip('/'),
+                                             sequence // 1000000,
+                                             sequence // 1000 % 1000,
+                                             sequence % 1000)
+
+    def _apply_diffs(self, metadata, output, source, entity_types):
+        """
+        Applies each diff published since the last one applied, in order
+        """
+        latest = self._get_replication_sequence()
+        first = metadata['sequence']
+        while metadata['sequence'] < latest:
+            url = self._get_diff_url(metadata['sequence'] + 1)
+            output.write("Applying %s\n" % url)
+            # GzipFile needs to seek, which a response can't
+            f = gzip.GzipFile(fileobj=StringIO(urllib2.urlopen(url).read()))
+            parser = make_parser()
+            parser.setContentHandler(self._get_handler(
+                OSMChangeHandler, source, entity_types, output,
+                SQLiteNodeStore(filename=get_osm_node_db())))
+            parser.parse(f)
+            metadata['sequence'] += 1
+
+        # Entities which have been added or renamed may now share a title
+        # with others, which is only worked out once for all the diffs
+        if metadata['sequence'] > first:
+            self.disambiguate_titles(source)
 
     def _get_source(self):
         try:
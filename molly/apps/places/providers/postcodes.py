@@ -11,7 +11,10 @@ import re
 from django.contrib.gis.geos import Point
 
 from molly.apps.places.providers import BaseMapsProvider
-from molly.apps.places.models import Entity, EntityType, Source
+from molly.apps.places.providers.bulk import EntityRecord, EntitySync
+from molly.apps.places.models import EntityType, Source
+from molly.apps.places import invalidate_identifier_cache
+from molly.apps.places.layers import invalidate_layers
 
 from molly.conf.settings import batch
 
@@ -38,6 +41,7 @@ class PostcodesMapsProvider(BaseMapsProvider):
         else:
             filenames = [path for path in archive.namelist() if re.match(r'Code\-Point Open\/Data\/[a-z]{1,2}.csv', path)]
 
+        sync = EntitySync(source, 'postcode')
         for filename in filenames:
             if hasattr(archive, 'open'):
                 f = archive.open(filename)
@@ -46,12 +50,21 @@ class PostcodesMapsProvider(BaseMapsProvider):
                 f.write(archive.read(filename))
                 f.seek(0)
             reader = csv.reader(f)
-            self._load_from_csv(reader, entity_type, source)
+            for record in self._load_from_csv(reader, entity_type):
+                sync.add(record)
             del f
+        counts = sync.finish()
+        output.write("Created %(created)d, modified %(modified)d and left "
+                     "%(unchanged)d postcodes unchanged\n" % counts)
+        
+        invalidate_layers([entity_type])
+        invalidate_identifier_cache()
 
-    def _load_from_csv(self, reader, entity_type, source):
-        j = 0
-        for i, line in enumerate(reader):
+    def _load_from_csv(self, reader, entity_type):
+        """
+        @return: A record of each postcode in a Code-Point Open CSV file
+        """
+        for line in reader:
             postcode_abbrev, (easting, northing) = line[0], line[10:12]
             if postcode_abbrev[-4] != ' ':
                 postcode = '%s %s' % (postcode_abbrev[:-3], postcode_abbrev[-3:])
@@ -63,26 +76,16 @@ class PostcodesMapsProvider(BaseMapsProvider):
                 easting, northing = int(easting), int(northing)
             except ValueError:
                 continue
-                
-            j += 1
-            
-            try:
-                entity = Entity.objects.get(source=source, _identifiers__scheme='postcode', _identifiers__value=postcode_abbrev)
-            except Entity.DoesNotExist:
-                entity = Entity(source=source)
-            
-            entity.title = postcode
-            entity.location = Point(easting, northing, srid=27700)
-            entity.geometry = entity.location
-            entity.primary_type = entity_type
             
-            identifiers = {
-                'postcode': postcode_abbrev,
-                'postcode-canonical': postcode,
-            }
-            entity.save(identifiers=identifiers)
-            entity.all_types.add(entity_type)
-            entity.update_all_types_completion()
+            yield EntityRecord(
+                identifiers = {
+                    'postcode': postcode_abbrev,
+                    'postcode-canonical': postcode,
+                },
+                title = postcode,
+                primary_type = entity_type,
+                location = Point(easting, northing, srid=27700),
+            )
 
     def _get_entity_type(self):
         try:
@@ -1,11 +1,28 @@
-import unittest, random, urllib2, itertools
+import unittest, random, urllib2, itertools, os, os.path, tempfile, time, gzip, shutil
+import simplejson
+from StringIO import StringIO
+from xml.sax import parse, handler, SAXParseException
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import connection
+from django.http import Http404
 from django.test.client import Client
 from django.core.urlresolvers import reverse
+from django.contrib.gis.geos import Point
 
-from molly.apps.places.models import Entity, EntityType
-from molly.apps.places.providers import NaptanMapsProvider
+from molly.maps.osm.draw import get_tile_ref
+from molly.apps.places.models import Entity, EntityType, Source
+from molly.apps.places.layers import get_layer_tile, get_layer_version, invalidate_layers
+from molly.apps.places.providers import NaptanMapsProvider, OSMMapsProvider
+from molly.apps.places.providers.bulk import EntityRecord, EntitySync
+from molly.apps.places.providers.naptan import NaptanContentHandler, NaptanImporter, iter_stop_points
+from molly.apps.places.providers.osm import OSMHandler, OSMChangeHandler, parse_pbf
+from molly.apps.places.providers.nodestore import NODE_STORES, SQLiteNodeStore, get_node_store
+from molly.apps.places import IdentifierCache, get_entity, get_entities, identifier_cache, invalidate_identifier_cache
+from molly.apps.places.views import ServiceDetailView
+from molly.utils.misc import OrderedDict, SimpleOrderedDict
 
 class MapsTestCase(unittest.TestCase):
     def setUp(self):
@@ -45,4 +62,692 @@ class MapsTestCase(unittest.TestCase):
                     entity.display_id,
                     entity_type.slug,
                 ]))
-            self.assertEqual(response.template[0].name, 'maps/entity_without_location.xhtml')
\ No newline at end of file
+            self.assertEqual(response.template[0].name, 'maps/entity_without_location.xhtml')
+
+class LayersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source = Source.objects.create(
+            module_name='molly.apps.places.tests', name='Layers test')
+        self.entity_type = EntityType.objects.create(
+            slug='layers-test', article='a', verbose_name='test',
+            verbose_name_plural='tests', show_in_nearby_list=False,
+            show_in_category_list=False)
+        # A 10x10 grid of entities, all in one tile at zoom 10
+        for i in range(100):
+            entity = Entity(source=self.source, title='Test %d' % i,
+                            primary_type=self.entity_type,
+                            location=Point(-1.26 + (i % 10) * 0.001,
+                                           51.75 + (i // 10) * 0.001,
+                                           srid=4326))
+            entity.save()
+            entity.all_types.add(self.entity_type)
+            entity.update_all_types_completion()
+
+    def tearDown(self):
+        Entity.objects.filter(source=self.source).delete()
+        self.entity_type.delete()
+        self.source.delete()
+
+    def testTilesAreClustered(self):
+        xtile, ytile = map(int, get_tile_ref(-1.255, 51.755, 10))
+        tile = simplejson.loads(get_layer_tile(self.entity_type, 10, xtile, ytile))
+        self.assertTrue(len(tile['features']) <= 8 * 8)
+        self.assertEqual(sum(f['properties']['count'] for f in tile['features']),
+                         100)
+
+        # At zoom 18 the grid is fine enough for every entity to be on its own
+        xtile, ytile = map(int, get_tile_ref(-1.26, 51.75, 18))
+        tile = simplejson.loads(get_layer_tile(self.entity_type, 18, xtile, ytile))
+        self.assertEqual([f['properties']['title'] for f in tile['features']],
+                         ['Test 0'])
+
+    def testImportsInvalidateTiles(self):
+        version = get_layer_version(self.entity_type.slug)
+        self.assertEqual(get_layer_version(self.entity_type.slug), version)
+        invalidate_layers([self.entity_type])
+        self.assertNotEqual(get_layer_version(self.entity_type.slug), version)
+
+class IdentifierCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source = Source.objects.create(
+            module_name='molly.apps.places.tests', name='Identifier test')
+        self.entities = []
+        for i in range(20):
+            entity = Entity(source=self.source, title='Station %d' % i)
+            entity.save(identifiers={'crs': 'T%02d' % i})
+            self.entities.append(entity)
+        invalidate_identifier_cache()
+        self.old_debug, settings.DEBUG = settings.DEBUG, True
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+        Entity.objects.filter(source=self.source).delete()
+        self.source.delete()
+        invalidate_identifier_cache()
+
+    def count_queries(self, f, *args):
+        connection.queries = []
+        result = f(*args)
+        return result, len(connection.queries)
+
+    def testGetEntities(self):
+        entities, queries = self.count_queries(
+            get_entities, 'crs', ['T00', 'T05', 'T19', 'XXX'])
+        self.assertEqual(sorted((value, entity.pk) for value, entity in entities.items()),
+                         [('T00', self.entities[0].pk),
+                          ('T05', self.entities[5].pk),
+                          ('T19', self.entities[19].pk)])
+        self.assertEqual(queries, 2)
+
+        # Those are now cached, so only the entities themselves are fetched
+        entities, queries = self.count_queries(
+            get_entities, 'crs', ['T00', 'T05'])
+        self.assertEqual(len(entities), 2)
+        self.assertEqual(queries, 1)
+
+    def testGetEntity(self):
+        self.assertEqual(get_entity('crs', 'T03').pk, self.entities[3].pk)
+        entity, queries = self.count_queries(get_entity, 'crs', 'T03')
+        self.assertEqual(entity.pk, self.entities[3].pk)
+        self.assertEqual(queries, 1)
+        self.assertRaises(Http404, get_entity, 'crs', 'XXX')
+
+        # Deleted entities aren't returned from the cache
+        self.entities[3].delete()
+        self.assertRaises(Http404, get_entity, 'crs', 'T03')
+
+    def testInvalidation(self):
+        get_entity('crs', 'T04')
+        self.entities[4].save(identifiers={'crs': 'T99'})
+        self.entities[5].save(identifiers={'crs': 'T04'})
+        invalidate_identifier_cache()
+        self.assertEqual(get_entity('crs', 'T04').pk, self.entities[5].pk)
+
+    def testVersionEvicted(self):
+        get_entity('crs', 'T04')
+        version = identifier_cache.version
+        cache.delete(IdentifierCache.VERSION_KEY)
+        invalidate_identifier_cache()
+        # It doesn't start again from a version which has already been seen
+        new_version = cache.get(IdentifierCache.VERSION_KEY)
+        self.assertTrue(new_version >= time.time() - 60)
+        self.assertNotEqual(new_version, version)
+
+    def testEvictsLeastRecentlyUsed(self):
+        for pks in (OrderedDict(), SimpleOrderedDict()):
+            cache = IdentifierCache(3)
+            cache._pks = pks
+            for value, pk in (('A', 1), ('B', 2), ('C', 3)):
+                cache.put_many('crs', {value: pk})
+            cache.get_many('crs', ['A'])
+            cache.put_many('crs', {'D': 4})
+            self.assertEqual(cache.get_many('crs', ['A', 'B', 'C', 'D']),
+                             {'A': 1, 'C': 3, 'D': 4})
+
+    def testServiceDetailQueryCount(self):
+        def calling_points(stations):
+            return [{'crs': 'T%02d' % i, 'locationName': 'Station %d' % i}
+                    for i in stations]
+        view = ServiceDetailView(None)
+
+        points = calling_points(range(3))
+        stop_entities, few_queries = self.count_queries(
+            view.get_calling_point_entities, points)
+        self.assertEqual(len(stop_entities), 3)
+
+        # A train which splits and has a train joining it, calling at more
+        # stations, some of which aren't known
+        invalidate_identifier_cache()
+        points = calling_points(range(10))
+        points[2]['joining'] = calling_points(range(10, 14))
+        points[6]['splitting'] = {'destination': 'Station 19',
+                                  'list': calling_points(range(14, 20))}
+        points += calling_points([98, 99])
+        stop_entities, many_queries = self.count_queries(
+            view.get_calling_point_entities, points)
+        self.assertEqual(len(stop_entities), 20)
+        self.assertEqual(many_queries, few_queries)
+        self.assertEqual(points[2]['joining'][0]['stop_num'], 3)
+        self.assertFalse('entity' in points[-1])
+
+class EntitySyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.source = Source.objects.create(
+            module_name='molly.apps.places.tests', name='Sync test')
+        self.parent_type = EntityType.objects.create(
+            slug='sync-test-parent', article='a', verbose_name='parent',
+            verbose_name_plural='parents', show_in_nearby_list=False,
+            show_in_category_list=False)
+        self.entity_type = EntityType.objects.create(
+            slug='sync-test', article='a', verbose_name='test',
+            verbose_name_plural='tests', show_in_nearby_list=False,
+            show_in_category_list=False)
+        self.entity_type.subtype_of.add(self.parent_type)
+        self.entity_type.save()
+        self.old_debug, settings.DEBUG = settings.DEBUG, True
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+        for entity in Entity.objects.filter(source=self.source):
+            entity.delete()
+        self.entity_type.delete()
+        self.parent_type.delete()
+        self.source.delete()
+
+    def records(self, count, title='Stop %d'):
+        for i in range(count):
+            yield EntityRecord(
+                identifiers={'atco': 'SYNC%04d' % i, 'naptan': '%08d' % i},
+                title=title % i,
+                primary_type=self.entity_type,
+                location=Point(-1.26 + i * 0.0001, 51.75, srid=4326),
+                metadata={'naptan': {'atco-code': 'SYNC%04d' % i}})
+
+    def sync(self, records, **kwargs):
+        connection.queries = []
+        counts = EntitySync(self.source, 'atco', **kwargs).sync(records)
+        return counts, len(connection.queries)
+
+    def testSync(self):
+        counts, queries = self.sync(self.records(50))
+        self.assertEqual(counts['created'], 50)
+
+        entity = get_entity('naptan', '00000007')
+        self.assertEqual(entity.title, 'Stop 7')
+        self.assertEqual(entity.identifiers['atco'], 'SYNC0007')
+        self.assertEqual(entity.absolute_url,
+                         reverse('places:entity', args=['atco', 'SYNC0007']))
+        self.assertEqual(set(entity.all_types_completion.all()),
+                         set([self.entity_type, self.parent_type]))
+        self.assertEqual(entity.metadata['types'],
+                         ['sync-test', 'sync-test-parent'])
+        self.assertEqual(entity.location.x, -1.26 + 7 * 0.0001)
+
+        # Nothing has changed
+        counts, queries = self.sync(self.records(50))
+        self.assertEqual((counts['created'], counts['modified'], counts['unchanged']),
+                         (0, 0, 50))
+
+        records = list(self.records(50))
+        records[3].title = 'Renamed'
+        records[4].identifiers['naptan'] = '99999999'
+        counts, queries = self.sync(records[:40], delete_missing=True)
+        self.assertEqual((counts['modified'], counts['unchanged'], counts['deleted']),
+                         (2, 38, 10))
+        self.assertEqual(get_entity('atco', 'SYNC0003').title, 'Renamed')
+        self.assertEqual(get_entity('atco', 'SYNC0004').identifiers['naptan'], '99999999')
+        self.assertRaises(Http404, get_entity, 'naptan', '00000004')
+        self.assertEqual(Entity.objects.filter(source=self.source).count(), 40)
+
+    def testDuplicates(self):
+        for name in NODE_STORES:
+            store = get_node_store(name)
+            try:
+                for node in self.nodes[:3]:
+                    store.add(*node)
+                store.add(self.nodes[2][0], 0.5, 0.25)
+                store.add(self.nodes[2][0], 0.75, 0.25)
+                if name != 'mmap':
+                    store.add(*self.nodes[0])
+                self.assertEqual(len(store), 3)
+                self.assertEqual(store.get(self.nodes[2][0]), (0.75, 0.25))
+                self.assertEqual(store.get(self.nodes[1][0]), self.nodes[1][1:])
+            finally:
+                store.close()
+
+    def testRemove(self):
+        self.sync(self.records(10))
+        records = list(self.records(12))
+        sync = EntitySync(self.source, 'atco')
+        sync.add(records[10])
+        sync.add(records[11])
+        sync.remove('SYNC0003')
+        sync.remove('SYNC0011')
+        sync.remove('SYNC9999')
+        counts = sync.finish()
+        self.assertEqual((counts['created'], counts['deleted']), (1, 1))
+        self.assertRaises(Http404, get_entity, 'atco', 'SYNC0003')
+        self.assertRaises(Http404, get_entity, 'atco', 'SYNC0011')
+        self.assertEqual(Entity.objects.filter(source=self.source).count(), 10)
+
+    def testQueryCount(self):
+        few, few_queries = self.sync(self.records(10))
+        Entity.objects.filter(source=self.source).delete()
+        many, many_queries = self.sync(self.records(500))
+        self.assertEqual(many['created'], 500)
+        # The same number of queries, however many records are in a batch
+        self.assertEqual(many_queries, few_queries)
+
+    def naptan(self, stops):
+        """
+        Imports stops, given as (ATCO code, revision, common name), from a
+        NaPTAN document
+        """
+        document = '<NaPTAN><StopPoints>%s</StopPoints></NaPTAN>' % ''.join(
+            '<StopPoint RevisionNumber="%d" ModificationDateTime="2011-0%d-01T00:00:00">'
+            '<AtcoCode>%s</AtcoCode><Descriptor><CommonName>%s</CommonName></Descriptor>'
+            '<Place><Location><Translation><Longitude>-1.26</Longitude>'
+            '<Latitude>51.75</Latitude></Translation></Location></Place>'
+            '<StopClassification><StopType>BCT</StopType></StopClassification>'
+            '</StopPoint>' % (revision, revision, atco, name)
+            for atco, revision, name in stops)
+        connection.queries = []
+        importer = NaptanImporter({'BCT': self.entity_type}, self.source,
+                                  areas=['SYNC'])
+        counts = importer.import_stop_points(
+            iter_stop_points(StringIO(document), ['SYNC']))
+        return counts, len(connection.queries)
+
+    def testNaptanRevisions(self):
+        stops = [('SYNC%04d' % i, 1, 'Stop %d' % i) for i in range(20)]
+        counts, queries = self.naptan(stops)
+        self.assertEqual(counts['created'], 20)
+        self.assertEqual(get_entity('atco', 'SYNC0003').import_stamp,
+                         '1@2011-01-01T00:00:00')
+
+        # Only the revised stop is looked at, and the missing one is deleted
+        stops[3] = ('SYNC0003', 2, 'Renamed')
+        del stops[7]
+        counts, queries = self.naptan(stops)
+        self.assertEqual((counts['modified'], counts['unchanged'], counts['deleted']),
+                         (1, 18, 1))
+        self.assertEqual(get_entity('atco', 'SYNC0003').title, 'Renamed')
+        self.assertRaises(Http404, get_entity, 'atco', 'SYNC0007')
+
+        # Nothing is compared when no stop has been revised
+        unrevised, unrevised_queries = self.naptan(stops)
+        self.assertEqual(unrevised['unchanged'], 19)
+        self.assertTrue(unrevised_queries < queries)
+
+class NaptanParserTestCase(unittest.TestCase):
+    extract = os.path.join(os.path.dirname(__file__), 'testdata',
+                           'naptan-extract.xml')
+
+    def parse(self, areas=None):
+        stop_points = []
+        parse(open(self.extract), NaptanContentHandler(
+            lambda meta, revision: stop_points.append((meta, revision)), areas))
+        return stop_points
+
+    def testSameStopPoints(self):
+        for areas in (None, ['340']):
+            stop_points = list(iter_stop_points(open(self.extract), areas))
+            self.assertEqual(stop_points, self.parse(areas))
+
+    def testStopPoints(self):
+        stop_points = list(iter_stop_points(open(self.extract), ['340']))
+        # Inactive and deleted stops, and those in other areas, are left out
+        self.assertEqual([meta['atco-code'] for meta, revision in stop_points],
+                         ['340000004R5', '340000006C3', '340001987OPP',
+                          '3400TXR00012'])
+        meta, revision = stop_points[0]
+        self.assertEqual(revision, ('3', '2010-04-19T12:00:53'))
+        self.assertEqual((meta['common-name'], meta['indicator'], meta['area']),
+                         ('Parks Road', 'opp', '070'))
+        # Empty elements aren't fields
+        self.assertFalse('indicator' in stop_points[2][0])
+
+class NodeStoreTestCase(unittest.TestCase):
+    # Ids beyond 32 bits, and co-ordinates to seven decimal places
+    nodes = [(id * 7 + 2 ** 33, float('%.7f' % (-1.25 - id * 1e-7)),
+              float('%.7f' % (51.75 + id * 1e-7))) for id in range(1000)]
+
+    def testStores(self):
+        for name in NODE_STORES:
+            store = get_node_store(name)
+            try:
+                for node in self.nodes:
+                    store.add(*node)
+                self.assertEqual(len(store), len(self.nodes))
+                for id, lon, lat in self.nodes:
+                    # Exactly as they were added
+                    self.assertEqual(store.get(id), (lon, lat))
+                self.assertEqual(store.get(self.nodes[0][0] + 1), None)
+                self.assertFalse(self.nodes[-1][0] + 1 in store)
+                self.assertTrue(self.nodes[-1][0] in store)
+            finally:
+                store.close()
+
+    def testOutOfOrder(self):
+        for name in ('array', 'sqlite'):
+            store = get_node_store(name)
+            try:
+                for node in reversed(self.nodes):
+                    store.add(*node)
+                store.add(self.nodes[5][0], 0.5, 0.25)
+                self.assertEqual(store.get(self.nodes[5][0]), (0.5, 0.25))
+                self.assertEqual(store.get(self.nodes[6][0]), self.nodes[6][1:])
+            finally:
+                store.close()
+
+        store = get_node_store('mmap')
+        try:
+            store.add(*self.nodes[1])
+            self.assertRaises(ValueError, store.add, *self.nodes[0])
+        finally:
+            store.close()
+
+    def testDuplicates(self):
+        for name in NODE_STORES:
+            store = get_node_store(name)
+            try:
+                for node in self.nodes[:3]:
+                    store.add(*node)
+                store.add(self.nodes[2][0], 0.5, 0.25)
+                store.add(self.nodes[2][0], 0.75, 0.25)
+                if name != 'mmap':
+                    store.add(*self.nodes[0])
+                self.assertEqual(len(store), 3)
+                self.assertEqual(store.get(self.nodes[2][0]), (0.75, 0.25))
+                self.assertEqual(store.get(self.nodes[1][0]), self.nodes[1][1:])
+            finally:
+                store.close()
+
+    def testRemove(self):
+        for name in NODE_STORES:
+            store = get_node_store(name)
+            try:
+                for node in self.nodes[:10]:
+                    store.add(*node)
+                store.remove(self.nodes[9][0])
+                store.remove(self.nodes[0][0] + 1)
+                self.assertEqual(store.get(self.nodes[9][0]), None)
+                self.assertEqual(len(store), 9)
+                # Until it is added again
+                for node in self.nodes[9:12]:
+                    store.add(*node)
+                self.assertEqual(store.get(self.nodes[9][0]), self.nodes[9][1:])
+            finally:
+                store.close()
+
+    def testPersistentStore(self):
+        fd, filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            store = SQLiteNodeStore(filename=filename)
+            for node in self.nodes[:10]:
+                store.add(*node)
+            ids = [id for id, lon, lat in self.nodes]
+            store.add_way(1, ids[0:3])
+            store.add_way(2, ids[2:5])
+            store.close()
+
+            # The next import picks up where the last left off
+            store = SQLiteNodeStore(filename=filename)
+            self.assertEqual(store.get(ids[4]), self.nodes[4][1:])
+            self.assertEqual(store.get_way(2), ids[2:5])
+            self.assertEqual(store.get_ways_of([ids[2]]), set([1, 2]))
+            store.remove(ids[4])
+            store.remove_way(1)
+            self.assertEqual(store.get(ids[4]), None)
+            self.assertEqual(store.get_ways_of(ids), set([2]))
+            store.clear()
+            self.assertEqual((len(store), store.get_way(2)), (0, None))
+            store.close()
+        finally:
+            os.unlink(filename)
+
+        # Temporary stores don't keep ways
+        store = SQLiteNodeStore()
+        store.add_way(1, [1, 2])
+        self.assertEqual(store.get_way(1), None)
+        store.close()
+
+class OSMChangeTestCase(unittest.TestCase):
+    # Nodes 1 and 2 make up a pub (way 10), and nodes 3, 4 and 6 are pubs
+    extract = """<osm>
+        <node id="1" lon="-1.5" lat="51.5"/>
+        <node id="2" lon="-1.4" lat="51.5"/>
+        <node id="3" lon="-1.4" lat="51.6"><tag k="amenity" v="pub"/><tag k="name" v="Three"/></node>
+        <node id="4" lon="-1.3" lat="51.6"><tag k="amenity" v="pub"/><tag k="name" v="Four"/></node>
+        <node id="6" lon="-1.3" lat="51.7"><tag k="amenity" v="pub"/><tag k="name" v="Six"/></node>
+        <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="1"/><tag k="amenity" v="pub"/><tag k="name" v="Ten"/></way>
+        <way id="11"><nd ref="2"/><nd ref="3"/><tag k="highway" v="footway"/></way>
+    </osm>"""
+
+    change = """<osmChange>
+        <modify>
+            <node id="2" lon="-1.45" lat="51.5"/>
+            <node id="3" lon="-1.4" lat="51.6"><tag k="name" v="Three"/></node>
+            <node id="4" lon="-5.0" lat="51.6"><tag k="amenity" v="pub"/><tag k="name" v="Four"/></node>
+        </modify>
+        <create>
+            <node id="5" lon="-1.2" lat="51.2"><tag k="amenity" v="pub"/><tag k="name" v="Five"/></node>
+        </create>
+        <delete>
+            <way id="11"><nd ref="2"/><nd ref="3"/></way>
+            <node id="6" lon="-1.3" lat="51.7"/>
+        </delete>
+    </osmChange>"""
+
+    def setUp(self):
+        self.source = Source.objects.create(
+            module_name='molly.apps.places.tests', name='OSM test')
+        self.entity_type = EntityType.objects.create(
+            slug='osm-test-pub', article='a', verbose_name='pub',
+            verbose_name_plural='pubs', show_in_nearby_list=False,
+            show_in_category_list=False)
+        fd, self.node_db = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        for entity in Entity.objects.filter(source=self.source):
+            entity.delete()
+        self.entity_type.delete()
+        self.source.delete()
+        os.unlink(self.node_db)
+
+    def find_types(self, tags):
+        if tags.get('amenity') == 'pub':
+            return ['pub']
+        raise ValueError
+
+    def parse(self, cls, document, node_store=None):
+        if node_store is None:
+            node_store = SQLiteNodeStore(filename=self.node_db)
+        parse(StringIO(document), cls(self.source, {'pub': self.entity_type},
+                                      self.find_types, StringIO(),
+                                      52, 51, -2, -1, node_store))
+        invalidate_identifier_cache()
+
+    def osm_ids(self):
+        return sorted(entity.identifiers['osm'] for entity
+                      in Entity.objects.filter(source=self.source))
+
+    def testChanges(self):
+        self.parse(OSMHandler, self.extract)
+        self.assertEqual(self.osm_ids(), ['N3', 'N4', 'N6', 'W10'])
+
+        self.parse(OSMChangeHandler, self.change)
+        # N3 is no longer a pub, N4 has moved out of the bounding box and
+        # N6 has been deleted
+        self.assertEqual(self.osm_ids(), ['N5', 'W10'])
+        self.assertEqual(get_entity('osm', 'N5').title, 'Five')
+        # W10 isn't in the diff, but one of its nodes has moved
+        self.assertEqual(list(get_entity('osm', 'W10').geometry.coords),
+                         [(-1.5, 51.5), (-1.45, 51.5), (-1.5, 51.5)])
+
+        # Applying it again changes nothing
+        self.parse(OSMChangeHandler, self.change)
+        self.assertEqual(self.osm_ids(), ['N5', 'W10'])
+
+    def testNeedsNodesFromLastImport(self):
+        self.assertRaises(ValueError, self.parse, OSMChangeHandler,
+                          self.change, node_store='array')
+
+    def testFailedFullImport(self):
+        provider = OSMMapsProvider(lat_north=52, lat_south=51, lon_west=-2,
+                                   lon_east=-1, url=self.node_db + '.osm',
+                                   replication_url='http://example.com/minute')
+        provider.SHELL_CMD = 'cat %s'
+        provider._get_etag = lambda: ''
+        provider._get_replication_sequence = lambda: 42
+        old_node_db = getattr(settings, 'PLACES_OSM_NODE_DB', None)
+        settings.PLACES_OSM_NODE_DB = self.node_db
+        try:
+            self.parse(OSMHandler, self.extract)
+            open(provider._url, 'w').write('<osm><node id="7" lon="-1.5" lat="51.5"/>')
+            metadata = {'full_import': 0, 'sequence': 41}
+            self.assertRaises(SAXParseException, provider._import_full,
+                              metadata, StringIO(), self.source,
+                              {'pub': self.entity_type})
+            # The last import's nodes are still there for diffs
+            self.assertEqual(metadata, {'full_import': 0, 'sequence': 41})
+            store = SQLiteNodeStore(filename=self.node_db)
+            self.assertEqual((store.get(1), store.get(7)), ((-1.5, 51.5), None))
+            store.close()
+            self.assertEqual(
+                [f for f in os.listdir(os.path.dirname(self.node_db))
+                 if f.startswith(os.path.basename(self.node_db) + '.')],
+                [os.path.basename(provider._url)])
+
+            open(provider._url, 'w').write('<osm><node id="7" lon="-1.5" lat="51.5"/></osm>')
+            provider._import_full(metadata, StringIO(), self.source,
+                                  {'pub': self.entity_type})
+            self.assertEqual(metadata['sequence'], 42)
+            store = SQLiteNodeStore(filename=self.node_db)
+            self.assertEqual((store.get(1), store.get(7)), (None, (-1.5, 51.5)))
+            store.close()
+        finally:
+            if old_node_db is None:
+                del settings.PLACES_OSM_NODE_DB
+            else:
+                settings.PLACES_OSM_NODE_DB = old_node_db
+            if os.path.exists(provider._url):
+                os.unlink(provider._url)
+
+    def testAppliesDiffs(self):
+        replication_dir = tempfile.mkdtemp()
+        provider = OSMMapsProvider(lat_north=52, lat_south=51, lon_west=-2,
+                                   lon_east=-1,
+                                   replication_url='file://' + replication_dir)
+        provider._get_replication_sequence = lambda: 42
+        disambiguated = []
+        provider.disambiguate_titles = disambiguated.append
+        old_node_db = getattr(settings, 'PLACES_OSM_NODE_DB', None)
+        settings.PLACES_OSM_NODE_DB = self.node_db
+        try:
+            self.parse(OSMHandler, self.extract)
+            diff_filename = os.path.join(replication_dir, '000', '000', '042.osc.gz')
+            os.makedirs(os.path.dirname(diff_filename))
+            f = gzip.open(diff_filename, 'wb')
+            f.write(self.change)
+            f.close()
+
+            metadata = {'full_import': 0, 'sequence': 41}
+            provider._apply_diffs(metadata, StringIO(), self.source,
+                                  {'pub': self.entity_type})
+            invalidate_identifier_cache()
+            self.assertEqual(metadata['sequence'], 42)
+            self.assertEqual(self.osm_ids(), ['N5', 'W10'])
+            self.assertEqual(disambiguated, [self.source])
+
+            # Titles are left alone when there are no new diffs
+            provider._apply_diffs(metadata, StringIO(), self.source,
+                                  {'pub': self.entity_type})
+            self.assertEqual(disambiguated, [self.source])
+        finally:
+            if old_node_db is None:
+                del settings.PLACES_OSM_NODE_DB
+            else:
+                settings.PLACES_OSM_NODE_DB = old_node_db
+            shutil.rmtree(replication_dir)
+
+    def testFailedFullImportWithoutReplication(self):
+        provider = OSMMapsProvider(lat_north=52, lat_south=51, lon_west=-2,
+                                   lon_east=-1, url=self.node_db + '.osm',
+                                   node_store='sqlite')
+        provider.SHELL_CMD = 'cat %s'
+        provider._get_etag = lambda: ''
+        def node_files():
+            return [f for f in os.listdir(tempfile.gettempdir())
+                    if f.startswith('molly-osm-nodes-')]
+        before = node_files()
+        try:
+            open(provider._url, 'w').write('<osm><node id="7" lon="-1.5" lat="51.5"/>')
+            self.assertRaises(SAXParseException, provider._import_full,
+                              {}, StringIO(), self.source,
+                              {'pub': self.entity_type})
+            # The temporary node store has been deleted
+            self.assertEqual(node_files(), before)
+        finally:
+            os.unlink(provider._url)
+
+    def testFullImportDue(self):
+        url, now, day = 'http://example.com/minute', time.time(), 86400
+        for replication_url, interval, metadata, due in (
+                (None, 7, {}, True),
+                (None, 7, {'full_import': now - day}, False),
+                (None, 7, {'full_import': now - 7 * day}, True),
+                (None, None, {'full_import': now}, True),
+                (url, 7, {}, True),
+                (url, 7, {'full_import': now - day}, True),
+                (url, 7, {'full_import': now - day, 'sequence': 5}, False),
+                # The batch doesn't start at exactly the same time each day
+                (url, 7, {'full_import': now - 7 * day + 1800, 'sequence': 5}, True),
+                (url, None, {'full_import': now - 365 * day, 'sequence': 5}, False)):
+            provider = OSMMapsProvider(replication_url=replication_url,
+                                       full_import_interval=interval)
+            self.assertEqual(provider._full_import_due(metadata), due,
+                             (replication_url, interval, metadata))
+
+    def testDiffURL(self):
+        for replication_url, sequence, diff_url in (
+                ('http://example.com/minute', 1,
+                 'http://example.com/minute/000/000/001.osc.gz'),
+                ('http://example.com/minute/', 4567890,
+                 'http://example.com/minute/004/567/890.osc.gz'),
+                ('http://example.com/day', 123456789,
+                 'http://example.com/day/123/456/789.osc.gz')):
+            provider = OSMMapsProvider(replication_url=replication_url)
+            self.assertEqual(provider._get_diff_url(sequence), diff_url)
+
+class RecordingHandler(handler.ContentHandler):
+    def startDocument(self):
+        self.events = []
+
+    def startElement(self, name, attrs):
+        self.events.append((name, sorted((k, unicode(v)) for k, v in attrs.items())))
+
+    def endElement(self, name):
+        self.events.append(('/' + name,))
+
+class PBFTestCase(unittest.TestCase):
+    def testSameAsXML(self):
+        try:
+            import osmium
+        except ImportError:
+            # PBF support is optional
+            return
+        from datetime import datetime
+        fd, filename = tempfile.mkstemp(suffix='.osm.pbf')
+        os.close(fd)
+        os.unlink(filename)
+        try:
+            common = dict(version=2, changeset=3, uid=4, user='alice',
+                          timestamp=datetime(2011, 1, 2, 3, 4, 5))
+            writer = osmium.SimpleWriter(filename)
+            writer.add_node(osmium.osm.mutable.Node(
+                id=1, location=(-1.25, 51.75), tags={'amenity': 'pub'},
+                **common))
+            writer.add_node(osmium.osm.mutable.Node(
+                id=2, location=(-1.2500001, 51.7500001), tags={}, **common))
+            writer.add_way(osmium.osm.mutable.Way(
+                id=10, nodes=[1, 2], tags={'highway': 'footway'}, **common))
+            writer.close()
+
+            from_pbf = RecordingHandler()
+            parse_pbf(filename, from_pbf)
+        finally:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+        attrs = 'version="2" changeset="3" uid="4" user="alice" timestamp="2011-01-02T03:04:05Z"'
+        from_xml = RecordingHandler()
+        parse(StringIO("""<osm>
+            <node id="1" %(attrs)s lon="-1.2500000" lat="51.7500000"><tag k="amenity" v="pub"/></node>
+            <node id="2" %(attrs)s lon="-1.2500001" lat="51.7500001"/>
+            <way id="10" %(attrs)s><nd ref="1"/><nd ref="2"/><tag k="highway" v="footway"/></way>
+            </osm>""" % {'attrs': attrs}), from_xml)
+        self.assertEqual(from_pbf.events, from_xml.events[1:-1])
+
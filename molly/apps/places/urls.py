@@ -13,7 +13,7 @@ from views import (
     
     ServiceDetailView,
 
-    APIView,
+    APIView, LayerView,
 )
 
 urlpatterns = patterns('',
@@ -62,4 +62,8 @@ urlpatterns = patterns('',
     (r'^api/$',
         APIView, {},
         'api'),
+
+    (r'^layers/(?P<ptype>[^/]+)/(?P<zoom>\d+)/(?P<xtile>\d+)/(?P<ytile>\d+)\.geojson$',
+        LayerView, {},
+        'layer'),
 )
@@ -19,11 +19,14 @@ from molly.favourites.views import FavouritableView
 from molly.geolocation.views import LocationRequiredView
 
 from molly.maps import Map
+from molly.maps.osm import get_max_tile_zoom
 from molly.maps.osm.models import OSMUpdate
+from molly.utils.http import not_modified, set_cache_headers
 
 from molly.apps.places.models import Entity, EntityType
-from molly.apps.places import get_entity, get_point
+from molly.apps.places import get_entity, get_entities, get_point
 from molly.apps.places.forms import UpdateOSMForm
+from molly.apps.places.layers import get_layer_tile, get_layer_version
 
 
 class IndexView(BaseView):
@@ -251,8 +254,15 @@ class EntityDetailView(ZoomableView, FavouritableView):
                 id_type, id, associated_entities = association
                 try:
                     if id in entity.identifiers[id_type]:
-                        associations += [{'type': type, 'entities': [get_entity(ns, value) for ns, value in es]} for type, es in associated_entities]
-                except (KeyError, Http404):
+                        # Look up the associated entities a scheme at a time
+                        found = {}
+                        for type, es in associated_entities:
+                            for ns, value in es:
+                                found.setdefault(ns, set()).add(value)
+                        for ns, values in found.items():
+                            found[ns] = get_entities(ns, values)
+                        associations += [{'type': type, 'entities': [found[ns][value] for ns, value in es]} for type, es in associated_entities]
+                except KeyError:
                     pass
         
         board = request.GET.get('board', 'departures')
@@ -607,32 +617,7 @@ class ServiceDetailView(BaseView):
 
             # Now get a list of the entities for the stations (if they exist)
             # to plot on a map
-            for point in calling_points:
-
-                if 'joining' in point:
-                    for jpoint in point['joining']:
-                        point_entity = Entity.objects.filter(_identifiers__scheme='crs', _identifiers__value=str(jpoint['crs']))
-                        if len(point_entity):
-                            point_entity = point_entity[0]
-                            jpoint['entity'] = point_entity
-                            stop_entities.append(point_entity)
-                            jpoint['stop_num'] = len(stop_entities)
-
-                point_entity = Entity.objects.filter(_identifiers__scheme='crs', _identifiers__value=str(point['crs']))
-                if len(point_entity):
-                    point_entity = point_entity[0]
-                    point['entity'] = point_entity
-                    stop_entities.append(point_entity)
-                    point['stop_num'] = len(stop_entities)
-
-                if 'splitting' in point:
-                    for spoint in point['splitting']['list']:
-                        point_entity = Entity.objects.filter(_identifiers__scheme='crs', _identifiers__value=str(spoint['crs']))
-                        if len(point_entity):
-                            point_entity = point_entity[0]
-                            spoint['entity'] = point_entity
-                            stop_entities.append(point_entity)
-                            spoint['stop_num'] = len(stop_entities)
+            stop_entities = self.get_calling_point_entities(calling_points)
             
             if 'std' in service:
                 title = service['std'] + ' ' + service['locationName'] + ' to ' + ' and '.join(destinations)
@@ -665,6 +650,31 @@ class ServiceDetailView(BaseView):
         
         return context
 
+    def get_calling_point_entities(self, calling_points):
+        """
+        Attaches the entity for each station a train calls at (including
+        those on joining and splitting trains) to its calling point, along
+        with its number on the map
+        
+        @return: The entities, in the order they are numbered on the map
+        @rtype: [Entity]
+        """
+        points = []
+        for point in calling_points:
+            points += point.get('joining', [])
+            points.append(point)
+            if 'splitting' in point:
+                points += point['splitting']['list']
+        
+        entities = get_entities('crs', [str(point['crs']) for point in points])
+        stop_entities = []
+        for point in points:
+            if str(point['crs']) in entities:
+                point['entity'] = entities[str(point['crs'])]
+                stop_entities.append(point['entity'])
+                point['stop_num'] = len(stop_entities)
+        return stop_entities
+
     def handle_GET(self, request, context, scheme, value):
         return self.render(request, context, 'places/service_details')
 
@@ -785,3 +795,33 @@ class APIView(BaseView):
         }
 
         return self.render(request, out, None)
+
+class LayerView(BaseView):
+    """
+    Returns a GeoJSON slippy map tile of the entities of a type, clustered
+    on a grid so that tiles stay small however many entities there are.
+    See L{molly.apps.places.layers}.
+    """
+
+    breadcrumb = NullBreadcrumb
+
+    # Clients can't be told when a layer changes, so only let them keep a
+    # tile for an hour
+    max_age = 3600
+
+    def handle_GET(self, request, context, ptype, zoom, xtile, ytile):
+        zoom, xtile, ytile = int(zoom), int(xtile), int(ytile)
+        if zoom > get_max_tile_zoom() or xtile >= 2 ** zoom \
+          or ytile >= 2 ** zoom:
+            raise Http404
+        entity_type = get_object_or_404(EntityType, slug=ptype)
+
+        etag = '%s-%d-%d-%d-%d' % (ptype, get_layer_version(ptype),
+                                   zoom, xtile, ytile)
+        response = not_modified(request, etag, max_age=self.max_age)
+        if response is None:
+            response = HttpResponse(
+                get_layer_tile(entity_type, zoom, xtile, ytile),
+                mimetype='application/json')
+            set_cache_headers(response, etag, max_age=self.max_age)
+        return response
@@ -11,7 +11,8 @@ import os.path
 
 from molly.utils.xslt import transform
 from molly.utils.misc import AnyMethodRequest
-from molly.external_media.models import ExternalImage, ExternalImageSized
+from molly.external_media.models import ExternalImage, ExternalImageSized, \
+                                        get_external_image_storage
 
 def sanitise_html(dirty_html, opener=None, device=None):
     html = etree.fromstring("<div>%s</div>" % dirty_html,
@@ -58,7 +59,8 @@ def resize_external_image(url, width, timeout=None):
             eis.delete()
         eis, created = ExternalImageSized.objects.get_or_create(external_image=ei, width=width)
     
-    if not os.path.exists(eis.get_filename()):
+    # This fetches the image from another node, if it resized it
+    if not get_external_image_storage().exists(eis.slug):
         eis.delete()
         eis, created = ExternalImageSized.objects.get_or_create(external_image=ei, width=width)
     
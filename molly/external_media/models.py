@@ -15,6 +15,8 @@ from django.db import models
 from django.conf import settings
 from django.core.urlresolvers import reverse
 
+from molly.utils.artifacts import get_artifact_storage
+
 
 class ExternalImage(models.Model):
     url = models.URLField()
@@ -33,6 +35,15 @@ def get_external_image_dir():
     return getattr(settings, 'EXTERNAL_IMAGE_DIR', os.path.join(settings.CACHE_DIR, 'external_images'))
 
 
+def get_external_image_storage():
+    """
+    @return: Where resized images are kept, which is configured by the
+             ARTIFACT_STORAGE setting
+    @rtype: molly.utils.artifacts.ArtifactStorage
+    """
+    return get_artifact_storage('external_images', get_external_image_dir())
+
+
 class ExternalImageSized(models.Model):
     external_image = models.ForeignKey(ExternalImage)
     width = models.PositiveIntegerField()
@@ -41,13 +52,10 @@ class ExternalImageSized(models.Model):
     content_type = models.TextField()
 
     def get_filename(self):
-        external_image_dir = get_external_image_dir()
         if not self.slug:
             while not self.slug or ExternalImageSized.objects.filter(slug=self.slug).count():
                 self.slug = "%08x" % random.randint(0, 16**8-1)
-        if not os.path.exists(external_image_dir):
-            os.makedirs(external_image_dir)
-        return os.path.join(external_image_dir, self.slug)
+        return get_external_image_storage().get_filename(self.slug)
 
     def get_absolute_url(self):
         return reverse('external_media:image', args=[self.slug])
@@ -74,16 +82,22 @@ class ExternalImageSized(models.Model):
                         raise
             self.width, self.height = resized.size
 
+            # Write to a temporary file first, so that other requests (and
+            # other nodes) never see a partially written image
+            self.get_filename()
+            storage = get_external_image_storage()
+            temp_filename = storage.get_temp_filename(self.slug)
             try:
-                resized.save(self.get_filename(), format='jpeg')
+                resized.save(temp_filename, format='jpeg')
                 self.content_type = 'image/jpeg'
             except IOError, e:
                 try:
-                    resized.convert('RGB').save(self.get_filename(), format='jpeg')
+                    resized.convert('RGB').save(temp_filename, format='jpeg')
                     self.content_type = 'image/jpeg'
                 except IOError:
-                    open(self.get_filename(), 'w').write(data.getvalue())
+                    open(temp_filename, 'w').write(data.getvalue())
                     self.content_type = response.headers['content-type']
+            storage.put(self.slug, temp_filename)
 
             self.external_image.width = size[0]
             self.external_image.height = size[1]
@@ -91,10 +105,6 @@ class ExternalImageSized(models.Model):
         super(ExternalImageSized, self).save(force_insert=False, force_update=False, **kwargs)
 
     def delete(self):
-        try:
-            os.unlink(self.get_filename())
-        except OSError:
-            # Ignore errors where we're trying to delete a file that's already
-            # been deleted
-            pass
+        if self.slug:
+            get_external_image_storage().delete(self.slug)
         super(ExternalImageSized, self).delete()
@@ -1,14 +1,11 @@
-from email.utils import formatdate
-from datetime import datetime, timedelta
-from time import mktime
-
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, Http404
+from django.http import Http404
 
 from molly.utils.views import BaseView
 from molly.utils.breadcrumbs import NullBreadcrumb
+from molly.utils.http import not_modified, file_response
 
-from models import ExternalImageSized
+from models import ExternalImageSized, get_external_image_storage
 
 
 class IndexView(BaseView):
@@ -24,9 +21,18 @@ class ExternalImageView(BaseView):
 
     def handle_GET(self, request, context, slug):
         eis = get_object_or_404(ExternalImageSized, slug=slug)
-        response = HttpResponse(open(eis.get_filename(), 'r').read(), mimetype=eis.content_type.encode('ascii'))
-
-        response['ETag'] = slug
-        response['Expires'] = formatdate(mktime((datetime.now() + timedelta(days=7)).timetuple()))
-        response['Last-Modified'] = formatdate(mktime(eis.external_image.last_updated.timetuple()))
+        last_modified = eis.external_image.last_updated
+
+        # A resized image is deleted (and gets a new slug) whenever the
+        # original changes, so the slug identifies its contents
+        response = not_modified(request, slug, last_modified)
+        if response is None:
+            if not get_external_image_storage().exists(slug):
+                # No node has the image any more, so have it resized again
+                # the next time a page uses it
+                eis.delete()
+                raise Http404
+            response = file_response(eis.get_filename(),
+                                     eis.content_type.encode('ascii'),
+                                     slug, last_modified)
         return response
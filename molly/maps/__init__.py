@@ -1,6 +1,10 @@
 from urllib import urlencode
 
-from molly.maps.osm import fit_to_map
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+from molly.maps.osm import fit_to_map, snap_map_size, get_tile_proxy_enabled
+from molly.maps.osm.draw import plan_fitted_map, get_tile_ref, get_tile_geo
 from molly.maps.models import GeneratedMap
 
 class Map:
@@ -9,7 +13,8 @@ class Map:
     passed to @C{render_map} in your template to get the appropriate HTML
     """
     
-    def __init__(self, centre_point, points, min_points, zoom, width, height):
+    def __init__(self, centre_point, points, min_points, zoom, width, height,
+                 lazy=None):
         """
         @param centre_point: A tuple of longitude, latitude, colour and title
                              corresponding to the "centre" of the map. This is
@@ -36,49 +41,29 @@ class Map:
         @type width: int
         @param height: The height of the generated map image, in pixels
         @type height: int
+        @param lazy: Whether to put off drawing the map image until it is
+                     first requested, which defaults to the LAZY_MAP_RENDERING
+                     setting
+        @type lazy: bool
         """
         
         self.centre_point = centre_point
         self.min_points = min_points
         self.width = width
         self.height = height
+        self._static_map_hash = None
         
-        try:
-            self.static_map_hash, \
-                (self.points, self.zoom, lon_center, lat_center) = fit_to_map(
-                    centre_point = centre_point,
-                    points = points,
-                    min_points = min_points,
-                    zoom = zoom,
-                    width = width,
-                    height = height,
-                )
-            # Check if this uses the old format of self.points
-            if len(self.points) > 0:
-                # this will throw a ValueError if it can't unpack, triggering a
-                # regeneration of the map
-                (lon, lat, colour, title), indices = self.points[0]
-        except ValueError:
-            # Old style metadata, which didn't store lon_center and lat_center
-            # was stored, so we need to regenerate the map
-            static_map_hash, metadata = fit_to_map(
-                    centre_point = centre_point,
-                    points = points,
-                    min_points = min_points,
-                    zoom = zoom,
-                    width = width,
-                    height = height,
-                )
-            GeneratedMap.objects.get(hash=static_map_hash).delete()
-            self.static_map_hash, \
-                (self.points, self.zoom, lon_center, lat_center) = fit_to_map(
-                    centre_point = centre_point,
-                    points = points,
-                    min_points = min_points,
-                    zoom = zoom,
-                    width = width,
-                    height = height,
-                )
+        # Work out which points are shown without touching the database, as
+        # devices which draw maps themselves never need the static map. The
+        # plan is kept, so that the map isn't fitted again when it is.
+        plan = plan_fitted_map(centre_point, list(points), min_points, zoom,
+                               snap_map_size(width), snap_map_size(height))
+        (self.points, self.zoom, self.lon_center, self.lat_center), \
+            render_args = plan
+        self._fit_args = dict(centre_point=centre_point, points=list(points),
+                              min_points=min_points, zoom=zoom,
+                              width=width, height=height, lazy=lazy,
+                              plan=plan)
         
         markers = [
             (str(centre_point[1]),
@@ -96,15 +81,116 @@ class Map:
                 )
         
         self.slippy_map_parameters = urlencode({
-            'lon': lon_center,
-            'lat': lat_center,
+            'lon': self.lon_center,
+            'lat': self.lat_center,
             'zoom': (self.zoom - 1) if len(self.points) > 0 else self.zoom,
             'markers': '~'.join(map('|'.join, markers))
         })
+    
+    @property
+    def static_map_hash(self):
+        """
+        The hash of the generated map image, which is only planned (and so
+        only written to the database) when this is first used
+        """
+        if self._static_map_hash is None:
+            try:
+                self._static_map_hash, (points, zoom, lon_center, lat_center) = \
+                    fit_to_map(**self._fit_args)
+                # Check if this uses the old format of self.points
+                if len(points) > 0:
+                    # this will throw a ValueError if it can't unpack,
+                    # triggering a regeneration of the map
+                    (lon, lat, colour, title), indices = points[0]
+            except ValueError:
+                # Old style metadata, which didn't store lon_center and
+                # lat_center was stored, so we need to regenerate the map
+                static_map_hash, metadata = fit_to_map(**self._fit_args)
+                GeneratedMap.objects.get(hash=static_map_hash).delete()
+                self._static_map_hash, metadata = fit_to_map(**self._fit_args)
+        return self._static_map_hash
+    
+    def get_bounds(self):
+        """
+        @return: The area the map covers, as (west, south, east, north)
+        @rtype: (float, float, float, float)
+        """
+        x, y = get_tile_ref(self.lon_center, self.lat_center, self.zoom)
+        width, height = snap_map_size(self.width), snap_map_size(self.height)
+        west, north = get_tile_geo(x - width / 512.0, y - height / 512.0,
+                                   self.zoom)
+        east, south = get_tile_geo(x + width / 512.0, y + height / 512.0,
+                                   self.zoom)
+        return west, south, east, north
+    
+    def get_vector_overlay(self, tile_url=None, marker_url=None):
+        """
+        Describes the map for a client to draw itself over map tiles, rather
+        than having the server draw it
+        
+        @param tile_url: The URL which tiles are served from, with
+                         /zoom/x/y.png appended to it
+        @type tile_url: str
+        @param marker_url: The URL which marker images are served from, with
+                           the name of the marker and .png appended to it
+        @type marker_url: str
+        @return: The bounds, centre and zoom level of the map, and the
+                 position, marker name, anchor (the offset in pixels of the
+                 point the marker image marks) and title of each marker
+        @rtype: dict
+        """
+        markers = []
+        if self.centre_point:
+            markers.append({
+                'lon': self.centre_point[0],
+                'lat': self.centre_point[1],
+                'marker': self.centre_point[2] + '-star',
+                'anchor': [10, 10],
+                'title': self.centre_point[3],
+            })
+        for point, indices in self.points:
+            markers.append({
+                'lon': point[0],
+                'lat': point[1],
+                'marker': '%s-%d' % (point[2], indices[0] + 1),
+                'anchor': [10, 25],
+                'title': point[3],
+            })
+        overlay = {
+            'bounds': self.get_bounds(),
+            'centre': [self.lon_center, self.lat_center],
+            'zoom': self.zoom,
+            'width': self.width,
+            'height': self.height,
+            'markers': markers,
+        }
+        if tile_url:
+            overlay['tile_url'] = tile_url
+        if marker_url:
+            overlay['marker_url'] = marker_url
+        return overlay
 
 def map_from_point(point, width, height, colour='green', title='', zoom=16):
     """
     A shortcut which renders a simple map containing only one point rendered as
     a star
     """
-    return Map((point[0], point[1], colour, title), [], 1, zoom, width, height)
\ No newline at end of file
+    return Map((point[0], point[1], colour, title), [], 1, zoom, width, height)
+
+def get_tile_url():
+    """
+    @return: The URL slippy maps drawn by the client should load tiles from,
+             with /zoom/x/y.png appended to it. This is Molly's tile cache if
+             OSM_TILE_PROXY is on, or OpenStreetMap's tile server if not.
+    """
+    if get_tile_proxy_enabled():
+        return reverse('maps:tile', args=[0, 0, 0])[:-len('/0/0/0.png')]
+    else:
+        return 'http://tile.openstreetmap.org'
+
+def get_marker_url():
+    """
+    @return: The URL marker images are served from, with the name of the
+             marker and .png appended to it
+    """
+    return settings.STATIC_URL + 'markers/'
@@ -0,0 +1,352 @@
+import os.path, platform, random, resource, shutil, sys, tempfile, time
+from datetime import datetime
+from optparse import make_option
+from StringIO import StringIO
+
+import simplejson
+import PIL, PIL.Image, PIL.ImageDraw, PIL.ImageFile
+from django.core.management.base import NoArgsCommand, CommandError
+
+from molly.maps.osm import MARKER_COLORS, get_or_create_map
+from molly.maps.osm import imagecache, tilestore
+from molly.maps.osm.draw import fit_map, get_fitted_map, get_map
+from molly.maps.osm.imagecache import ImageCache, MarkerAtlas, get_image_cache_size
+from molly.maps.osm.markers import generate_markers
+from molly.maps.osm.models import GeneratedMap
+
+FUNCTIONS = ('get_map', 'get_fitted_map', 'get_or_create_map', 'fit_map')
+
+# Fitted maps are asked to show at least this many points, as a nearby page
+# does
+MIN_POINTS = 5
+
+def synthetic_tile(xtile, ytile, zoom):
+    """
+    @return: PNG data for a made-up tile, which is always the same for the
+             same co-ordinates
+    """
+    rand = random.Random('%d/%d/%d' % (xtile, ytile, zoom))
+    image = PIL.Image.new('RGB', (256, 256), (242, 239, 233))
+    draw = PIL.ImageDraw.Draw(image)
+    for i in range(20):
+        draw.line([(rand.randint(0, 255), rand.randint(0, 255))
+                   for j in range(4)],
+                  fill=(rand.randint(0, 255), rand.randint(0, 255), 255),
+                  width=rand.randint(1, 6))
+    out = StringIO()
+    image.convert('P', palette=PIL.Image.ADAPTIVE).save(out, 'png')
+    return out.getvalue()
+
+class SyntheticTileStore(tilestore.MBTilesTileStore):
+    """
+    A tile store which makes up any tile it doesn't have, so that benchmarks
+    never go to the tile server.
+    """
+
+    def get(self, xtile, ytile, zoom, max_age=None):
+        data = super(SyntheticTileStore, self).get(xtile, ytile, zoom)
+        if data is None:
+            data = synthetic_tile(xtile, ytile, zoom)
+            self.put(xtile, ytile, zoom, data)
+        return data
+
+class DecodeCounter(object):
+    """
+    Counts how many images PIL decodes while it is in use, by wrapping
+    @C{ImageFile.load}, which every image read from a file goes through.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self._load = load = PIL.ImageFile.ImageFile.load
+        def counting_load(image):
+            # Images which have already been decoded have no tiles left
+            if image.tile:
+                self.count += 1
+            return load(image)
+        PIL.ImageFile.ImageFile.load = counting_load
+        return self
+
+    def __exit__(self, *exc_info):
+        PIL.ImageFile.ImageFile.load = self._load
+
+def get_peak_rss():
+    """
+    @return: The most memory this process has used so far, in kilobytes
+    @rtype: int
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kilobytes, but Mac OS X in bytes
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def parse_list(value, parse):
+    try:
+        return [parse(item) for item in value.split(',')]
+    except ValueError:
+        raise CommandError("Unable to understand %r" % value)
+
+def parse_size(value):
+    width, height = value.split('x')
+    return int(width), int(height)
+
+class Command(NoArgsCommand):
+    help = "Times drawing and fitting maps over numbers of points, map " \
+           "sizes and cold and warm image caches, against made-up tiles so " \
+           "that nothing is fetched from the tile server. Maps drawn by " \
+           "get_or_create_map are saved as usual, and deleted afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-n', '--renders',
+            action='store',
+            dest='renders',
+            type='int',
+            default=20,
+            help='The number of maps to time for each case'),
+        make_option('-p', '--points',
+            action='store',
+            dest='points',
+            default='1,10,99,500',
+            help='Comma-separated numbers of points to put on each map'),
+        make_option('--sizes',
+            action='store',
+            dest='sizes',
+            default='160x160,320x320,640x480',
+            help='Comma-separated sizes of maps to draw, as WIDTHxHEIGHT'),
+        make_option('-f', '--function',
+            action='append',
+            dest='functions',
+            default=[],
+            help='Only time this function (may be given more than once), '
+                 'one of %s' % ', '.join(FUNCTIONS)),
+        make_option('-o', '--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='Write the results to this file as JSON'),
+        make_option('--compare',
+            action='store',
+            dest='compare',
+            default=None,
+            help='Compare the results against those written to this file by '
+                 'an earlier run'),
+    )
+
+    def handle_noargs(self, **options):
+        functions = options['functions'] or FUNCTIONS
+        for function in functions:
+            if function not in FUNCTIONS:
+                raise CommandError("Unknown function %r" % function)
+        point_counts = parse_list(options['points'], int)
+        sizes = parse_list(options['sizes'], parse_size)
+
+        work_dir = tempfile.mkdtemp()
+        old_tile_store = tilestore._tile_store
+        old_tile_cache = imagecache._tile_cache
+        old_marker_atlas = imagecache._marker_atlas
+        results = []
+        try:
+            self.marker_dir = os.path.join(work_dir, 'markers')
+            generate_markers(self.marker_dir, 1)
+            tilestore._tile_store = SyntheticTileStore(
+                os.path.join(work_dir, 'tiles.mbtiles'), max_size=0)
+            self.filename = os.path.join(work_dir, 'map')
+
+            for points in point_counts:
+                maps = self.get_maps(options['renders'], points)
+                for function in functions:
+                    if function == 'fit_map':
+                        results.extend(self.benchmark_fitting(maps, sizes))
+                        continue
+                    for width, height in sizes:
+                        results.extend(self.benchmark_drawing(
+                            function, maps, width, height))
+        finally:
+            tilestore._tile_store = old_tile_store
+            imagecache._tile_cache = old_tile_cache
+            imagecache._marker_atlas = old_marker_atlas
+            shutil.rmtree(work_dir)
+
+        if options['compare']:
+            self.compare(results, simplejson.load(open(options['compare'])))
+
+        if options['output']:
+            f = open(options['output'], 'w')
+            simplejson.dump({
+                'environment': {
+                    'date': datetime.utcnow().isoformat(),
+                    'python': platform.python_version(),
+                    'pil': getattr(PIL, '__version__',
+                                   getattr(PIL.Image, 'VERSION', None)),
+                    'platform': platform.platform(),
+                    'renders': options['renders'],
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.close()
+
+    def reset_caches(self, preload=True):
+        imagecache._tile_cache = ImageCache(get_image_cache_size())
+        imagecache._marker_atlas = MarkerAtlas(self.marker_dir,
+                                               preload=preload)
+
+    def get_renderer(self, function, width, height):
+        """
+        @return: A function which draws a map, given its centre point and
+                 other points, using the function being benchmarked
+        """
+        if function == 'get_map':
+            def render(centre_point, points):
+                # Number the points as a fitted map would
+                markers = [centre_point] + [
+                    (lon, lat, color, i % 99 + 1)
+                    for i, (lon, lat, color, index) in enumerate(points)]
+                get_map(markers, width, height, self.filename)
+        elif function == 'get_fitted_map':
+            def render(centre_point, points):
+                get_fitted_map(centre_point, points, MIN_POINTS, None,
+                               width, height, self.filename)
+        else:
+            def render(centre_point, points):
+                return get_or_create_map(get_fitted_map, (
+                    centre_point, points, MIN_POINTS, None, width, height))
+        return render
+
+    def benchmark_drawing(self, function, maps, width, height):
+        """
+        Times drawing maps with a function, once with warm caches, and then
+        again with caches that have never seen any of the tiles or markers
+
+        For get_or_create_map, warm means the maps have already been drawn,
+        and cold that they haven't.
+        """
+        render = self.get_renderer(function, width, height)
+        results = []
+        hashes = set()
+        try:
+            # Doing this first puts every tile needed in the tile store
+            self.reset_caches()
+            for centre_point, points in maps:
+                hash = render(centre_point, points)
+                if hash:
+                    hashes.add(hash[0])
+
+            for cache in ('warm', 'cold'):
+                timings = []
+                with DecodeCounter() as decodes:
+                    for centre_point, points in maps:
+                        if cache == 'cold':
+                            self.reset_caches(preload=False)
+                            self.delete_maps(hashes)
+                        start = time.time()
+                        render(centre_point, points)
+                        timings.append(time.time() - start)
+                results.append(self.report(timings, decodes.count, {
+                    'function': function,
+                    'points': len(maps[0][1]),
+                    'width': width,
+                    'height': height,
+                    'cache': cache,
+                }))
+        finally:
+            self.delete_maps(hashes)
+        return results
+
+    def benchmark_fitting(self, maps, sizes):
+        """
+        Times fitting maps (without drawing them), both when only a few of
+        the points fit on the map and when all of them do
+        """
+        results = []
+        for width, height in sizes:
+            for zoom in (None, 10):
+                timings = []
+                for centre_point, points in maps:
+                    start = time.time()
+                    fit_map(centre_point, points, MIN_POINTS, zoom, width,
+                            height)
+                    timings.append(time.time() - start)
+                results.append(self.report(timings, 0, {
+                    'function': 'fit_map',
+                    'points': len(maps[0][1]),
+                    'width': width,
+                    'height': height,
+                    'zoom': zoom,
+                }))
+        return results
+
+    def delete_maps(self, hashes):
+        # Delete them one at a time, so their images are deleted too
+        for generated_map in GeneratedMap.objects.filter(hash__in=hashes):
+            generated_map.delete()
+
+    def report(self, timings, decodes, case):
+        """
+        Summarises and prints the timings for one case
+
+        @return: The case, with the results added
+        @rtype: dict
+        """
+        timings = sorted(timings)
+        case.update({
+            'renders': len(timings),
+            'mean_ms': sum(timings) * 1000 / len(timings),
+            'median_ms': timings[len(timings) // 2] * 1000,
+            'max_ms': timings[-1] * 1000,
+            'decodes_per_render': float(decodes) / len(timings),
+            'peak_rss_kb': get_peak_rss(),
+        })
+        self.stdout.write(
+            "%s: mean %.2fms, median %.2fms, max %.2fms, "
+            "%.1f decodes/render, peak RSS %dKB\n" % (
+                self.describe(case), case['mean_ms'], case['median_ms'],
+                case['max_ms'], case['decodes_per_render'],
+                case['peak_rss_kb']))
+        return case
+
+    def describe(self, case):
+        description = "%s, %d points, %dx%d" % (
+            case['function'], case['points'], case['width'], case['height'])
+        if 'cache' in case:
+            description += ", %s caches" % case['cache']
+        else:
+            description += ", zoom %s" % (case['zoom'] or 'closest')
+        return description
+
+    def compare(self, results, previous):
+        """
+        Prints how much faster or slower each case is than it was in an
+        earlier run
+        """
+        previous = dict((self.describe(case), case)
+                        for case in previous['results'])
+        self.stdout.write("\nCompared with the earlier run:\n")
+        for case in results:
+            description = self.describe(case)
+            if description in previous and case['mean_ms']:
+                self.stdout.write("%s: %.2fx as long\n" % (
+                    description,
+                    case['mean_ms'] / max(previous[description]['mean_ms'],
+                                          1e-6)))
+
+    def get_maps(self, renders, points):
+        """
+        @return: A list of (centre_point, points) for maps scattered around
+                 a city centre, as a nearby page would show
+        """
+        rand = random.Random(0)
+        colors = [color[0] for color in MARKER_COLORS]
+        maps = []
+        for i in range(renders):
+            lon = -1.26 + rand.uniform(-0.01, 0.01)
+            lat = 51.75 + rand.uniform(-0.01, 0.01)
+            centre_point = (lon, lat, rand.choice(colors), None)
+            map_points = [(lon + rand.uniform(-0.005, 0.005),
+                           lat + rand.uniform(-0.005, 0.005),
+                           rand.choice(colors), None)
+                          for j in range(points)]
+            maps.append((centre_point, map_points))
+        return maps
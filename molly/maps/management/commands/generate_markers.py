@@ -1,45 +1,100 @@
-import itertools, subprocess, os.path, tempfile, os
+import itertools, subprocess, os.path, tempfile, os, shutil, time
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
-from django.conf import settings
 
 from molly.maps.osm import MARKER_COLORS, MARKER_RANGE
+from molly.maps.osm.markers import generate_markers
 from molly.maps.osm.models import get_marker_dir
 
-    
+def generate_markers_with_imagemagick(marker_dir):
+    """
+    Renders every marker from the SVG templates with ImageMagick, one convert
+    process per marker, as markers used to be generated. This is only kept to
+    benchmark against.
+    """
+    template = open(os.path.join(os.path.dirname(__file__), 'markers', 'base.svg')).read()
+
+    for color, index in itertools.product(MARKER_COLORS, MARKER_RANGE):
+        out = template % {
+            'label': str(index),
+            'fill': color[1],
+            'stroke': color[2],
+            'text_color': color[3],
+        }
+
+        f, infile = tempfile.mkstemp()
+        os.write(f, out)
+        os.close(f)
+
+        filename = os.path.join(marker_dir, '%s-%d.png' % (color[0], index))
+        subprocess.call(['convert', '-background', 'none', infile, filename])
+        os.unlink(infile)
+
+    template = open(os.path.join(os.path.dirname(__file__), 'markers', 'star-base.svg')).read()
+
+    for color in MARKER_COLORS:
+        out = template % {'fill': color[1], 'stroke': color[2]}
+
+        f, infile = tempfile.mkstemp()
+        os.write(f, out)
+        os.close(f)
+
+        filename = os.path.join(marker_dir, '%s-star.png' % color[0])
+        subprocess.call(['convert', '-background', 'none', infile, filename])
+        os.unlink(infile)
+
+def have_imagemagick():
+    try:
+        return subprocess.call(['convert', '-version'],
+                               stdout=open(os.devnull, 'w')) == 0
+    except OSError:
+        return False
+
 class Command(NoArgsCommand):
+    help = "Draws the markers used on generated maps"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes',
+            action='store',
+            dest='processes',
+            type='int',
+            default=None,
+            help='The number of processes to draw markers in, defaults to '
+                 'the number of CPUs'),
+        make_option('--benchmark',
+            action='store_true',
+            dest='benchmark',
+            default=False,
+            help='Instead of generating the markers, time drawing them in '
+                 'one process and in a pool, and rendering them with '
+                 'ImageMagick (if it is installed)'),
+    )
+
     def handle_noargs(self, **options):
-        template = open(os.path.join(os.path.dirname(__file__), 'markers', 'base.svg')).read()
-        marker_dir = get_marker_dir()
-        
-        if not os.path.exists(marker_dir):
-            os.makedirs(marker_dir)
-        
-
-        for color, index in itertools.product(MARKER_COLORS, MARKER_RANGE):
-            out = template % {
-                'label': str(index),
-                'fill': color[1],
-                'stroke': color[2],
-                'text_color': color[3],
-            }
-            
-            f, infile = tempfile.mkstemp()
-            os.write(f, out)
-            os.close(f)
-            
-            filename = os.path.join(marker_dir, '%s-%d.png' % (color[0], index))
-            subprocess.call(['convert', '-background', 'none', infile, filename])
-            os.unlink(infile)
-        
-        template = open(os.path.join(os.path.dirname(__file__), 'markers', 'star-base.svg')).read()
-            
-        for color in MARKER_COLORS:
-            out = template % {'fill': color[1], 'stroke': color[2]}
-            
-            f, infile = tempfile.mkstemp()
-            os.write(f, out)
-            os.close(f)
-            
-            filename = os.path.join(marker_dir, '%s-star.png' % color[0])
-            subprocess.call(['convert', '-background', 'none', infile, filename])
-            os.unlink(infile)
+        if options['benchmark']:
+            self.benchmark(options['processes'])
+        else:
+            generate_markers(get_marker_dir(), options['processes'])
+
+    def benchmark(self, processes):
+        runs = [
+            ('PIL, 1 process', lambda d: generate_markers(d, 1)),
+            ('PIL, pool', lambda d: generate_markers(d, processes)),
+        ]
+        if have_imagemagick():
+            runs.insert(0, ('ImageMagick', generate_markers_with_imagemagick))
+        else:
+            self.stdout.write("ImageMagick isn't installed, so it can't be "
+                              "compared against\n")
+
+        for name, generate in runs:
+            marker_dir = tempfile.mkdtemp()
+            try:
+                start = time.time()
+                generate(marker_dir)
+                elapsed = time.time() - start
+                self.stdout.write("%s: %d markers in %.2fs\n" % (
+                    name, len(os.listdir(marker_dir)), elapsed))
+            finally:
+                shutil.rmtree(marker_dir)
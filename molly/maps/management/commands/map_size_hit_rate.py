@@ -0,0 +1,93 @@
+from optparse import make_option
+
+import dateutil.parser
+from django.core.management.base import NoArgsCommand
+
+from molly.apps.stats.models import Hit
+from molly.wurfl.wurfl_data import devices
+from molly.maps.osm import get_map_size_buckets, snap_map_size
+
+def get_device(device_id):
+    """
+    @return: The WURFL device with this ID, or its nearest known ancestor
+    """
+    while device_id:
+        try:
+            return devices.select_id(device_id)
+        except Exception:
+            device_id = '_'.join(device_id.split('_')[:-1])
+    return devices.select_id('generic')
+
+class Command(NoArgsCommand):
+    help = "Estimates the generated map hit rate from the stats Hit table, " \
+           "with and without map sizes snapped to MAP_SIZE_BUCKETS"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-s', '--start',
+            action='store',
+            dest='start',
+            default=None,
+            help='Only consider hits from this date onwards'),
+        make_option('-e', '--end',
+            action='store',
+            dest='end',
+            default=None,
+            help='Only consider hits before this date'),
+        make_option('-p', '--path-prefix',
+            action='append',
+            dest='path_prefixes',
+            default=[],
+            help='Only consider pages under this path, e.g., /places/ '
+                 '(may be given more than once)'),
+    )
+
+    def handle_noargs(self, **options):
+        hits = Hit.objects.filter(status_code='200')
+        if options['start']:
+            hits = hits.filter(
+                requested__gte=dateutil.parser.parse(options['start']))
+        if options['end']:
+            hits = hits.filter(
+                requested__lt=dateutil.parser.parse(options['end']))
+
+        buckets = get_map_size_buckets()
+        sizes, requests = {}, 0
+        exact_maps, bucketed_maps = set(), set()
+        for full_path, device_id in hits.values_list('full_path',
+                                                     'device_id').iterator():
+            if options['path_prefixes'] and not any(
+                    full_path.startswith(prefix)
+                    for prefix in options['path_prefixes']):
+                continue
+            if device_id not in sizes:
+                # The same as WurflMiddleware works out
+                device = get_device(device_id)
+                sizes[device_id] = (
+                    min(320, device.resolution_width - 10),
+                    min(320, device.resolution_height - 10))
+            width, height = sizes[device_id]
+
+            # Assuming each page always shows the same map, a map is only
+            # generated the first time a page is seen at each size
+            requests += 1
+            exact_maps.add((full_path, width, height))
+            bucketed_maps.add((full_path, snap_map_size(width, buckets),
+                               snap_map_size(height, buckets)))
+
+        if not requests:
+            self.stdout.write("No hits found\n")
+            return
+
+        exact_sizes = set(sizes.values())
+        bucketed_sizes = set((snap_map_size(width, buckets),
+                              snap_map_size(height, buckets))
+                             for width, height in exact_sizes)
+        self.stdout.write("%d page views from %d devices\n" % (
+            requests, len(sizes)))
+        for name, map_sizes, maps in (
+                ('exact sizes', exact_sizes, exact_maps),
+                ('bucketed sizes', bucketed_sizes, bucketed_maps)):
+            self.stdout.write(
+                "%s: %d map sizes, %d maps generated, hit rate %.1f%%\n" % (
+                    name, len(map_sizes), len(maps),
+                    100.0 * (requests - len(maps)) / requests))
@@ -0,0 +1,208 @@
+import os
+import os.path
+import time
+from itertools import islice
+from optparse import make_option
+
+import simplejson
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from molly.maps.osm import get_max_tile_zoom
+from molly.maps.osm.draw import get_tile_ref
+from molly.maps.osm.fetch import fetch_tiles, get_tile_fetch_workers
+from molly.maps.osm.models import TILE_MAX_AGE
+from molly.maps.osm.tilestore import get_tile_store
+
+def get_entity_extent(sources=None):
+    """
+    @param sources: The module names of the sources to consider entities from,
+                    or None for all entities
+    @type sources: [str]
+    @return: The bounding box of all the entities with locations, as
+             (min longitude, min latitude, max longitude, max latitude)
+    """
+    from molly.apps.places.models import Entity
+    entities = Entity.objects.exclude(location=None)
+    if sources:
+        entities = entities.filter(source__module_name__in=sources)
+    return entities.extent()
+
+def get_tile_ranges(bbox, zoom):
+    """
+    @return: The ranges of x and y tile co-ordinates which cover a bounding
+             box at a zoom level
+    @rtype: (xrange, xrange)
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    # Tile rows count down from the north
+    x_min, y_min = get_tile_ref(lon_min, lat_max, zoom)
+    x_max, y_max = get_tile_ref(lon_max, lat_min, zoom)
+    last = 2 ** zoom - 1
+    return (xrange(max(0, int(x_min)), min(last, int(x_max)) + 1),
+            xrange(max(0, int(y_min)), min(last, int(y_max)) + 1))
+
+def get_tile_pyramid(bbox, min_zoom, max_zoom):
+    """
+    @return: Every tile covering the bounding box between the zoom levels, as
+             (xtile, ytile, zoom), always in the same order
+    """
+    for zoom in range(min_zoom, max_zoom + 1):
+        xtiles, ytiles = get_tile_ranges(bbox, zoom)
+        for xtile in xtiles:
+            for ytile in ytiles:
+                yield xtile, ytile, zoom
+
+def count_tile_pyramid(bbox, min_zoom, max_zoom):
+    total = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        xtiles, ytiles = get_tile_ranges(bbox, zoom)
+        total += len(xtiles) * len(ytiles)
+    return total
+
+class Command(NoArgsCommand):
+    help = "Fills the OSM tile cache with the tiles covering an area, so " \
+           "that maps don't wait on the tile server. Please respect the " \
+           "tile usage policy of the tile server you seed from."
+
+    # How often to report progress, in seconds
+    REPORT_INTERVAL = 10
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--bbox',
+            action='store',
+            dest='bbox',
+            default=None,
+            help='The area to seed, as min_lon,min_lat,max_lon,max_lat. '
+                 'Defaults to the extent of all entities with a location'),
+        make_option('--source',
+            action='append',
+            dest='sources',
+            default=[],
+            help='When working out the default area, only consider entities '
+                 'from this source (may be given more than once)'),
+        make_option('--min-zoom',
+            action='store',
+            dest='min_zoom',
+            type='int',
+            default=10,
+            help='The lowest zoom level to seed'),
+        make_option('--max-zoom',
+            action='store',
+            dest='max_zoom',
+            type='int',
+            default=17,
+            help='The highest zoom level to seed'),
+        make_option('--workers',
+            action='store',
+            dest='workers',
+            type='int',
+            default=None,
+            help='The number of tiles to fetch at once, defaults to the '
+                 'OSM_TILE_FETCH_WORKERS setting'),
+        make_option('--batch',
+            action='store',
+            dest='batch',
+            type='int',
+            default=100,
+            help='The number of tiles to fetch between checkpoints'),
+        make_option('--tile-url',
+            action='store',
+            dest='tile_url',
+            default=None,
+            help='The tile server to seed from, as a URL containing '
+                 '%(zoom)d, %(xtile)d and %(ytile)d, defaults to the '
+                 'OSM_TILE_URL setting'),
+        make_option('--checkpoint',
+            action='store',
+            dest='checkpoint',
+            default=None,
+            help='Where to record progress, so an interrupted run can carry '
+                 'on where it left off'),
+        make_option('--restart',
+            action='store_true',
+            dest='restart',
+            default=False,
+            help='Ignore any checkpoint and start from the beginning'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['bbox']:
+            try:
+                bbox = tuple(map(float, options['bbox'].split(',')))
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4:
+                raise CommandError("--bbox must be four comma-separated "
+                                   "numbers")
+        else:
+            bbox = get_entity_extent(options['sources'])
+            if bbox is None:
+                raise CommandError("There are no entities to seed tiles "
+                                   "around; give a --bbox instead")
+        min_zoom = max(0, options['min_zoom'])
+        max_zoom = min(get_max_tile_zoom(), options['max_zoom'])
+        workers = options['workers'] or get_tile_fetch_workers()
+
+        job = {'bbox': list(bbox), 'min_zoom': min_zoom, 'max_zoom': max_zoom}
+        checkpoint = options['checkpoint'] or os.path.join(
+            settings.CACHE_DIR, 'seed_osm_tiles.json')
+        position = 0
+        if not options['restart'] and os.path.exists(checkpoint):
+            saved = simplejson.load(open(checkpoint))
+            if saved['job'] == job:
+                position = saved['position']
+                self.stdout.write("Resuming from tile %d\n" % position)
+
+        total = count_tile_pyramid(bbox, min_zoom, max_zoom)
+        self.stdout.write("Seeding %d tiles at zoom %d to %d\n" % (
+            total, min_zoom, max_zoom))
+
+        tile_store = get_tile_store()
+        self.fetched = self.skipped = self.failed = 0
+        start = time.time()
+        batch = []
+        tiles = islice(get_tile_pyramid(bbox, min_zoom, max_zoom),
+                       position, None)
+        last_report = start
+        for position, (xtile, ytile, zoom) in enumerate(tiles, position + 1):
+            if tile_store.is_fresh(xtile, ytile, zoom, TILE_MAX_AGE):
+                self.skipped += 1
+            else:
+                batch.append((xtile, ytile, zoom))
+            if len(batch) >= options['batch'] or position == total:
+                self.fetch(tile_store, batch, workers, options['tile_url'])
+                batch = []
+                self.save_checkpoint(checkpoint, job, position)
+                if time.time() - last_report > self.REPORT_INTERVAL:
+                    self.report(position, total, start)
+                    last_report = time.time()
+
+        if os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+        self.report(total, total, start)
+
+    def fetch(self, tile_store, refs, workers, tile_url):
+        for (xtile, ytile, zoom), data in fetch_tiles(
+                refs, workers=workers, tile_url=tile_url).items():
+            if data is None:
+                self.failed += 1
+            else:
+                tile_store.put(xtile, ytile, zoom, data)
+                self.fetched += 1
+
+    def save_checkpoint(self, checkpoint, job, position):
+        # Write atomically, so being interrupted never leaves a checkpoint
+        # that can't be read
+        f = open(checkpoint + '.tmp', 'w')
+        simplejson.dump({'job': job, 'position': position}, f)
+        f.close()
+        os.rename(checkpoint + '.tmp', checkpoint)
+
+    def report(self, position, total, start):
+        elapsed = max(time.time() - start, 1e-6)
+        self.stdout.write(
+            "%d/%d tiles: %d fetched (%.1f tiles/s), %d already fresh, "
+            "%d failed\n" % (position, total, self.fetched,
+                             self.fetched / elapsed, self.skipped,
+                             self.failed))
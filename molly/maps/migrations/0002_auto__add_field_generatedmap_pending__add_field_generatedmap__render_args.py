@@ -0,0 +1,106 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'GeneratedMap.pending'
+        db.add_column('osm_generatedmap', 'pending', self.gf('django.db.models.fields.BooleanField')(default=False), keep_default=False)
+
+        # Adding field 'GeneratedMap._render_args'
+        db.add_column('osm_generatedmap', '_render_args', self.gf('django.db.models.fields.TextField')(default='', blank=True), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'GeneratedMap.pending'
+        db.delete_column('osm_generatedmap', 'pending')
+
+        # Deleting field 'GeneratedMap._render_args'
+        db.delete_column('osm_generatedmap', '_render_args')
+
+
+    models = {
+        'osm.generatedmap': {
+            'Meta': {'object_name': 'GeneratedMap'},
+            '_metadata': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            '_render_args': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'faulty': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'generated': ('django.db.models.fields.DateTimeField', [], {}),
+            'hash': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '16', 'primary_key': 'True'}),
+            'last_accessed': ('django.db.models.fields.DateTimeField', [], {}),
+            'pending': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        'osm.osmtile': {
+            'Meta': {'unique_together': "(('xtile', 'ytile', 'zoom'),)", 'object_name': 'OSMTile'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_fetched': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'xtile': ('django.db.models.fields.IntegerField', [], {}),
+            'ytile': ('django.db.models.fields.IntegerField', [], {}),
+            'zoom': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'osm.osmupdate': {
+            'Meta': {'object_name': 'OSMUpdate'},
+            'approved': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'contributor_attribute': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'contributor_email': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'contributor_name': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'entity': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['places.Entity']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'new': ('django.db.models.fields.TextField', [], {}),
+            'notes': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'old': ('django.db.models.fields.TextField', [], {}),
+            'submitted': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'places.entity': {
+            'Meta': {'ordering': "('title',)", 'object_name': 'Entity'},
+            '_identifiers': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['places.Identifier']", 'symmetrical': 'False'}),
+            '_metadata': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'absolute_url': ('django.db.models.fields.TextField', [], {}),
+            'all_types': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'entities'", 'blank': 'True', 'to': "orm['places.EntityType']"}),
+            'all_types_completion': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'entities_completion'", 'blank': 'True', 'to': "orm['places.EntityType']"}),
+            'geometry': ('django.contrib.gis.db.models.fields.GeometryField', [], {'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'identifier_scheme': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'identifier_value': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'is_stack': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_sublocation': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'location': ('django.contrib.gis.db.models.fields.PointField', [], {'null': 'True'}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['places.Entity']", 'null': 'True'}),
+            'primary_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['places.EntityType']", 'null': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['places.Source']"}),
+            'title': ('django.db.models.fields.TextField', [], {'blank': 'True'})
+        },
+        'places.entitytype': {
+            'Meta': {'ordering': "('verbose_name',)", 'object_name': 'EntityType'},
+            'article': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'note': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'show_in_category_list': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_in_nearby_list': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50', 'db_index': 'True'}),
+            'subtype_of': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'subtypes'", 'blank': 'True', 'to': "orm['places.EntityType']"}),
+            'subtype_of_completion': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "'subtypes_completion'", 'blank': 'True', 'to': "orm['places.EntityType']"}),
+            'verbose_name': ('django.db.models.fields.TextField', [], {}),
+            'verbose_name_plural': ('django.db.models.fields.TextField', [], {})
+        },
+        'places.identifier': {
+            'Meta': {'object_name': 'Identifier'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'scheme': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '256'})
+        },
+        'places.source': {
+            'Meta': {'object_name': 'Source'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'module_name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        }
+    }
+
+    complete_apps = ['maps']
@@ -2,33 +2,335 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import fcntl
 import hashlib
 import os
 import os.path
 import logging
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import IntegrityError, transaction
 
-from molly.maps.osm.models import GeneratedMap, get_generated_map_dir
-from molly.maps.osm.draw import get_fitted_map, MapGenerationError
+from molly.maps.osm.models import GeneratedMap, get_generated_map_dir, \
+                                  get_generated_map_storage
+from molly.maps.osm.draw import get_fitted_map, plan_fitted_map, get_map, \
+                                get_planned_map, MapGenerationError
+from molly.maps.osm.markers import MARKER_COLORS, MARKER_RANGE
 
-MARKER_COLORS = (
-    # name, fill, border, text
-    ('amber', '#ff7e00', '#824000', '#000000'),
-    ('blue', '#0000ff', '#000050', '#ffffff'),
-    ('green', '#00ff1e', '#005009', '#000000'),
-    ('purple', '#9146b8', '#3c1d4c', '#ffffff'),
-    ('red', '#ff0000', '#500000', '#ffffff'),
-    ('yellow', '#f0ff00', '#4b5000', '#000000'),
-)
+logger = logging.getLogger('molly.osm.generation')
 
-MARKER_RANGE = xrange(1, 100)
+def get_map_lock_timeout():
+    """
+    @return: How long, in seconds, to wait for another request which is
+             generating the same map before giving up and generating it anyway
+    """
+    return getattr(settings, 'GENERATED_MAP_LOCK_TIMEOUT', 30)
 
-logger = logging.getLogger('molly.osm.generation')
+@contextmanager
+def map_generation_lock(hash):
+    """
+    Holds an exclusive lock on generating the map with the given hash, across
+    all threads and processes on this machine, waiting for it for up to
+    GENERATED_MAP_LOCK_TIMEOUT seconds.
+    
+    Lock files are shared between maps with the same hash prefix, so that
+    we don't leave one behind for every map ever generated.
+    
+    @return: A context manager, which yields whether the lock was acquired
+    """
+    lock_dir = os.path.join(get_generated_map_dir(), 'locks')
+    if not os.path.exists(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:
+            # Someone else has just created it
+            pass
+    
+    lock_file = open(os.path.join(lock_dir, hash[:3]), 'w')
+    try:
+        deadline = time.time() + get_map_lock_timeout()
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                if time.time() > deadline:
+                    logger.warning("Timed out waiting for map %s", hash)
+                    locked = False
+                    break
+                time.sleep(0.05)
+            else:
+                locked = True
+                break
+        yield locked
+    finally:
+        # Closing the file releases the lock
+        lock_file.close()
+
+MAP_REQUEST_COUNTERS = ('hit', 'planned', 'rendered', 'coalesced')
+
+def count_map_request(counter):
+    """
+    Increments one of the map request counters, which are kept in the cache
+    so that they are shared between processes
+    """
+    key = 'molly.maps.requests.%s' % counter
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1)
+
+def get_map_request_counts():
+    """
+    @return: The number of map requests which have been served by an existing
+             map ('hit'), by planning a map to be drawn later ('planned'), by
+             drawing one ('rendered'), and by waiting for another request to
+             draw it ('coalesced'), since the counters were last cleared from
+             the cache
+    @rtype: dict
+    """
+    counts = cache.get_many(['molly.maps.requests.%s' % counter
+                             for counter in MAP_REQUEST_COUNTERS])
+    return dict((counter, counts.get('molly.maps.requests.%s' % counter, 0))
+                for counter in MAP_REQUEST_COUNTERS)
+
+def get_lazy_map_rendering():
+    """
+    @return: Whether fitted maps should only be planned when a page is
+             rendered, and drawn when the map image itself is requested
+    """
+    return getattr(settings, 'LAZY_MAP_RENDERING', True)
 
-def get_or_create_map(generator, args):
+def get_map_size_buckets():
+    """
+    @return: The sizes, in pixels, which the widths and heights of generated
+             maps are snapped to, so that devices with similar screens share
+             maps, or None to generate maps at exactly the size requested
+    """
+    return getattr(settings, 'MAP_SIZE_BUCKETS',
+                   (120, 160, 200, 240, 280, 320))
+
+def snap_map_size(size, buckets=None):
+    """
+    Snaps a map dimension to the largest bucket which is no larger than it, so
+    the map still fits in the space it was requested for, with any spare space
+    around it. Sizes smaller than every bucket are snapped up to the smallest,
+    and left to the client to scale down.
+    
+    @param size: The requested width or height, in pixels
+    @type size: int
+    @param buckets: The sizes to snap to, defaults to the MAP_SIZE_BUCKETS
+                    setting
+    @type buckets: [int]
+    @rtype: int
+    """
+    if buckets is None:
+        buckets = get_map_size_buckets()
+    if not buckets:
+        return size
+    buckets = sorted(buckets)
+    smaller = [bucket for bucket in buckets if bucket <= size]
+    return smaller[-1] if smaller else buckets[0]
+
+def get_tile_proxy_enabled():
+    """
+    @return: Whether slippy maps should fetch tiles through @C{TileView}
+             rather than straight from the OSM tile servers
+    """
+    return getattr(settings, 'OSM_TILE_PROXY', False)
+
+def get_max_tile_zoom():
+    """
+    @return: The highest zoom level tiles are proxied for
+    """
+    return getattr(settings, 'OSM_TILE_PROXY_MAX_ZOOM', 18)
+
+def get_access_flush_interval():
+    """
+    @return: How often, in seconds, to write the times maps were last accessed
+             back to the database
+    """
+    return getattr(settings, 'GENERATED_MAP_ACCESS_FLUSH_INTERVAL', 60)
+
+class AccessTracker(object):
+    """
+    Records which generated maps have been used, and periodically writes that
+    back to the database in one go, rather than updating every map every time
+    it is used.
+    """
+    
+    # Flush early if this many maps are waiting to be written back
+    MAX_PENDING = 1000
+    
+    def __init__(self):
+        self._pending = set()
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+    
+    def record(self, hash):
+        """
+        Records a map as having been accessed, flushing any pending accesses
+        if they have been waiting long enough
+        """
+        with self._lock:
+            self._pending.add(hash)
+            if len(self._pending) < self.MAX_PENDING and \
+               time.time() - self._last_flush < get_access_flush_interval():
+                return
+            hashes, self._pending = self._pending, set()
+            self._last_flush = time.time()
+        self.flush(hashes)
+    
+    def flush(self, hashes=None):
+        """
+        Writes the pending accesses back to the database
+        """
+        if hashes is None:
+            with self._lock:
+                hashes, self._pending = self._pending, set()
+                self._last_flush = time.time()
+        if hashes:
+            GeneratedMap.objects.filter(hash__in=hashes).update(
+                last_accessed=datetime.utcnow())
+
+access_tracker = AccessTracker()
+
+def generate_map(hash, generator, args, start_time):
+    """
+    Calls a map generator and saves the resulting GeneratedMap
+    
+    @return: The metadata of the generated map
+    """
+    generated_map = GeneratedMap(
+        hash = hash,
+        generated = datetime.utcnow(),
+        last_accessed = datetime.utcnow(),
+    )
+    storage = get_generated_map_storage()
+    name = generated_map.get_artifact_name()
+    temp_filename = storage.get_temp_filename(name)
+    try:
+        # Call the generator to generate it
+        metadata = generator(filename=temp_filename, *args)
+        # If no exception was raised, we mark it as non-faulty
+        faulty = False
+    except MapGenerationError as e:
+        # If a map generation error occurs, then mark this map as faulty
+        # this means that it is deleted next time it is requested, forcing
+        # it to be re-generated next time (hopefully the error is transient)
+        logger.warning("Unable to generate map")
+        metadata = e.metadata
+        faulty = True
+    # The map is drawn even if some of its tiles couldn't be fetched
+    storage.put(name, temp_filename)
+
+    generated_map.faulty = faulty
+    generated_map.metadata = metadata
+
+    # This may fail, so we use a transaction savepoint in case we need to
+    # roll back the transaction - not doing this causes any future database
+    # queries to fail
+    savepoint = transaction.savepoint()
+    try:
+        generated_map.save()
+    except IntegrityError:
+        # This means a race error was generated, but because of the
+        # functional nature of generator, we can carry on here
+        logger.debug("Map generated: %s, took %.5f seconds (with race)",
+                     (hash, time.time()-start_time))
+        transaction.savepoint_rollback(savepoint)
+    else:
+        logger.debug("Map generated: %s, took %.5f seconds",
+                     (hash, time.time()-start_time))
+        transaction.savepoint_commit(savepoint)
+    return metadata
+
+def plan_map(hash, planner, args):
+    """
+    Works out the metadata for a map, and saves a pending GeneratedMap so that
+    the map can be drawn later by @C{render_pending_map}
+    
+    @return: The metadata of the planned map
+    """
+    metadata, render_args = planner(*args)
+    
+    generated_map = GeneratedMap(
+        hash = hash,
+        generated = datetime.utcnow(),
+        last_accessed = datetime.utcnow(),
+        pending = True,
+    )
+    generated_map.metadata = metadata
+    generated_map.render_args = render_args
+    
+    savepoint = transaction.savepoint()
+    try:
+        generated_map.save()
+    except IntegrityError:
+        # Someone else has planned (or drawn) this map in the meantime, which
+        # is fine, as it will be the same as ours
+        transaction.savepoint_rollback(savepoint)
+    else:
+        transaction.savepoint_commit(savepoint)
+    return metadata
+
+def render_pending_map(generated_map):
+    """
+    Draws a map which was planned by @C{get_or_create_map} but hasn't yet been
+    drawn, or whose image can no longer be found in the generated map
+    storage. If another request is already drawing it, then this waits for
+    that instead.
+    
+    @param generated_map: The pending map
+    @type generated_map: GeneratedMap
+    @return: The map, now drawn
+    @rtype: GeneratedMap
+    @raise GeneratedMap.DoesNotExist: If the map has since been deleted, or
+                                      can't be drawn again
+    """
+    start_time = time.time()
+    storage = get_generated_map_storage()
+    with map_generation_lock(generated_map.hash):
+        generated_map = GeneratedMap.objects.get(hash=generated_map.hash)
+        if not generated_map.pending and \
+           storage.exists(generated_map.get_artifact_name()):
+            count_map_request('coalesced')
+            return generated_map
+        
+        if not generated_map._render_args:
+            # This map was drawn straight away, so wasn't planned, and there
+            # is no way to draw it again. Mark it as faulty, so that it is
+            # regenerated next time a page asks for it.
+            generated_map.faulty = True
+            generated_map.save()
+            raise GeneratedMap.DoesNotExist()
+        
+        # This is a new generation of the map, so it is stored under a new
+        # name, and no node serves an image it already has in its place
+        points, width, height, zoom = generated_map.render_args
+        generated_map.generated = datetime.utcnow()
+        name = generated_map.get_artifact_name()
+        temp_filename = storage.get_temp_filename(name)
+        try:
+            get_map(points, width, height, temp_filename, zoom)
+            generated_map.faulty = False
+        except MapGenerationError:
+            logger.warning("Unable to generate map")
+            generated_map.faulty = True
+        storage.put(name, temp_filename)
+        
+        generated_map.pending = False
+        generated_map.save()
+        logger.debug("Pending map generated: %s, took %.5f seconds",
+                     generated_map.hash, time.time()-start_time)
+        count_map_request('rendered')
+    return generated_map
+
+def get_or_create_map(generator, args, planner=None):
     """
     A wrapper function for a map generator which protects against race
     conditions in map generation. You should use this instead of calling a
@@ -36,11 +338,19 @@ def get_or_create_map(generator, args):
     
     @param generator: The generator to use
     @param args: Any extra arguments to pass to the generator function
+    @param planner: If given, a new map isn't drawn now. Instead this is
+                    called with the same arguments as the generator, to get
+                    the map's metadata and the arguments to @C{get_map} which
+                    will draw it, and the map is drawn by
+                    @C{render_pending_map} when it is first requested.
+    
+    Only one request at a time generates any given map: others requesting it
+    at the same time wait for the first to finish and then use its map.
     
     This assumes that generator is functional, i.e. its return value is
-    determined solely by its arguments. In the case that a map is requested
-    again before the original map generation has finished, the following
-    happens:
+    determined solely by its arguments. If waiting for another request times
+    out, or that request is on another machine, then the map is generated
+    again, in which case the following happens:
     * Nothing has yet been saved to the database as we have to wait for the
       metadata to come back. Hence, we get a DoesNotExist.
     * The map is regenerated. Due to the atomic nature of filesystem writes
@@ -68,8 +378,6 @@ def get_or_create_map(generator, args):
     # Try fetching the map if it already exists
     try:
         generated_map = GeneratedMap.objects.get(hash=hash)
-        generated_map.last_accessed = datetime.utcnow()
-        generated_map.save()
         metadata = generated_map.metadata
         
         # Except if the current map is marked as faulty (e.g., missing OSM tile,
@@ -82,69 +390,33 @@ def get_or_create_map(generator, args):
             raise GeneratedMap.DoesNotExist()
         else:
             logger.debug("Found previously generated map: %s", hash)
+            access_tracker.record(hash)
+            count_map_request('hit')
             
     
-    # If it doesn't exist, generate it
+    # If it doesn't exist, generate it, unless someone else is already doing
+    # so, in which case wait for them and use theirs
     except GeneratedMap.DoesNotExist:
-        generated_map_dir = get_generated_map_dir()
-        if not os.path.exists(generated_map_dir):
-            os.makedirs(generated_map_dir)
-        try:
-            # Call the generator to generate it
-            metadata = generator(filename=os.path.join(generated_map_dir, hash),
-                                 *args)
-            # If no exception was raised, we mark it as non-faulty
-            faulty = False
-        except MapGenerationError as e:
-            # If a map generation error occurs, then mark this map as faulty
-            # this means that it is deleted next time it is requested, forcing
-            # it to be re-generated next time (hopefully the error is transient)
-            logger.warning("Unable to generate map")
-            metadata = e.metadata
-            faulty = True
-        
-        generated_map = GeneratedMap(
-            hash = hash,
-            generated = datetime.utcnow(),
-            last_accessed = datetime.utcnow(),
-            faulty = faulty,
-        )
-        generated_map.metadata = metadata
-        
-        # This may fail, so we use a transaction savepoint in case we need to
-        # roll back the transaction - not doing this causes any future database
-        # queries to fail
-        savepoint = transaction.savepoint()
-        try:
-            generated_map.save()
-        except IntegrityError:
-            # This means a race error was generated, but because of the
-            # functional nature of generator, we can carry on here
-            logger.debug("Map generated: %s, took %.5f seconds (with race)",
-                         (hash, time.time()-start_time))
-            transaction.savepoint_rollback(savepoint)
-        else:
-            logger.debug("Map generated: %s, took %.5f seconds",
-                         (hash, time.time()-start_time))
-            transaction.savepoint_commit(savepoint)
+        if planner:
+            metadata = plan_map(hash, planner, args)
+            count_map_request('planned')
+            return hash, metadata
         
-        # If there are any maps older than a week, regenerate them
-        to_delete = GeneratedMap.objects.filter(generated__lt=datetime.now()-timedelta(weeks=1))
-        if to_delete.count() > 0:
-            # But only clear up 50 at a time
-            youngest = None
-            to_delete = to_delete[:50]
-            for generated_map in to_delete:
-                if not youngest:
-                    youngest = generated_map.last_accessed
-                generated_map.delete()
-            age = (datetime.now()-youngest)
-            age = age.days*24 + age.seconds/3600.0
-            logger.debug("Cleared out old maps, youngest is %f hours", age)
+        with map_generation_lock(hash):
+            try:
+                generated_map = GeneratedMap.objects.get(hash=hash)
+            except GeneratedMap.DoesNotExist:
+                metadata = generate_map(hash, generator, args, start_time)
+                count_map_request('rendered')
+            else:
+                logger.debug("Map generated by another request: %s", hash)
+                metadata = generated_map.metadata
+                count_map_request('coalesced')
     
     return hash, metadata
     
-def fit_to_map(centre_point, points, min_points, zoom, width, height):
+def fit_to_map(centre_point, points, min_points, zoom, width, height,
+               lazy=None, plan=None):
     """
     Given a list of points and some minimum number of points, then a "fitted
     map" is generated, which is one which contains at least @C{min_points}, and
@@ -173,12 +445,33 @@ def fit_to_map(centre_point, points, min_points, zoom, width, height):
                  map will be zoomed out further to fit in. If this is None, then
                  this is equivalent to the smallest zoom level.
     @type zoom: int
-    @param width: The width of the generated map image, in pixels
+    @param width: The width of the space for the map, in pixels. The map image
+                  is generated at this width snapped to the MAP_SIZE_BUCKETS
+                  setting.
     @type width: int
-    @param height: The height of the generated map image, in pixels
+    @param height: The height of the space for the map, in pixels, which is
+                   snapped in the same way
     @type height: int
+    @param lazy: Whether to only work out which points are shown on the map
+                 now, and draw it when it is first requested. Defaults to the
+                 LAZY_MAP_RENDERING setting.
+    @type lazy: bool
+    @param plan: What @C{plan_fitted_map} returns for these arguments (with
+                 the width and height snapped), if the caller has already
+                 worked it out, so that the map isn't fitted again
+    @type plan: (tuple, tuple)
     """
     points = list(points)
-    return get_or_create_map(get_fitted_map,
+    width, height = snap_map_size(width), snap_map_size(height)
+    if lazy is None:
+        lazy = get_lazy_map_rendering()
+    if plan is None:
+        generator, planner = get_fitted_map, plan_fitted_map
+    else:
+        generator = lambda *args, **kwargs: \
+            get_planned_map(plan, kwargs['filename'])
+        planner = lambda *args: plan
+    return get_or_create_map(generator,
                              (centre_point, points, min_points,
-                              zoom, width, height))
+                              zoom, width, height),
+                             planner=planner if lazy else None)
@@ -7,7 +7,21 @@ import os.path
 import sys
 import time
 
-from molly.maps.osm.models import OSMTile, get_marker_dir
+from molly.maps.osm.models import OSMTile
+from molly.maps.osm.imagecache import get_tile_cache, get_marker_atlas
+
+_fallback_tile = None
+
+def get_fallback_tile():
+    """
+    @return: The tile to use in place of any that can't be fetched
+    """
+    global _fallback_tile
+    if _fallback_tile is None:
+        _fallback_tile = PIL.Image.open(os.path.join(os.path.dirname(__file__),
+                                                     'fallback', 'fallback.png'))
+        _fallback_tile = _fallback_tile.convert('RGBA')
+    return _fallback_tile
 
 def log2(x):
     """
@@ -74,6 +88,20 @@ def minmax(i):
         max_ = max(max_, e)
     return min_, max_
 
+def get_map_centre(points):
+    """
+    Gets the centre of the map generated for some points
+    
+    @param points: The points to be shown on the map, as tuples starting with
+                   longitude and latitude
+    @type points: list
+    @return: The longitude and latitude of the centre of the map
+    @rtype: (float, float)
+    """
+    lon_min, lon_max = minmax(p[0] for p in points)
+    lat_min, lat_max = minmax(p[1] for p in points)
+    return (lon_min + lon_max)/2, (lat_min + lat_max)/2
+
 def get_map(points, width, height, filename, zoom=None, lon_center=None, lat_center=None):
     """
     Generates a map for the passed in arguments, saving that to filename
@@ -110,11 +138,12 @@ def get_map(points, width, height, filename, zoom=None, lon_center=None, lat_cen
         else:
             zoom = 16
     
+    if not lat_center:
+        lon_center, lat_center = get_map_centre(points)
+    
     points = [(get_tile_ref(p[0], p[1], zoom), p[2], p[3]) for p in points]
 
     lon_range, lat_range = lon_max - lon_min, lat_min - lat_max
-    if not lat_center:
-        lon_center, lat_center = (lon_min + lon_max)/2, (lat_min + lat_max)/2
     
     tx_min, tx_max = map(int, minmax(p[0][0] for p in points))
     ty_min, ty_max = map(int, minmax(p[0][1] for p in points))
@@ -138,34 +167,48 @@ def get_map(points, width, height, filename, zoom=None, lon_center=None, lat_cen
     # Keep track of if the image if malformed or not
     malformed = False
     
-    # Lots of different tiles contain the parts we're interested in, so take the
-    # parts of those tiles, and copy them into our new image
+    # Lots of different tiles contain the parts we're interested in, so work
+    # out which of those tiles are visible
+    tiles = [tile for tile in tiles
+             if -256 < (tile['ref'][0] - tx_min) * 256 - ox < width
+            and -256 < (tile['ref'][1] - ty_min) * 256 - oy < height]
+    
+    # Use any tiles we already have decoded, and fetch all the rest we need in
+    # one go, so a cold cache costs roughly one round trip to the tile server
+    # rather than one per tile
+    tile_cache = get_tile_cache()
     for tile in tiles:
-        offx = (tile['ref'][0] - tx_min) * 256 - ox
-        offy = (tile['ref'][1] - ty_min) * 256 - oy
-        
-        if not (-256 < offx and offx < width and -256 < offy and offy < height):
-            continue
-        
-        try:
-            tile_data = OSMTile.get_data(tile['ref'][0], tile['ref'][1], zoom)
-            tile['surface'] = PIL.Image.open(tile_data)
-        except Exception, e:
-            tile['surface'] = PIL.Image.open(os.path.join(os.path.dirname(__file__), 'fallback', 'fallback.png'))
-            malformed = True
+        tile['surface'] = tile_cache.get(tile['ref'] + (zoom,))
+    tile_data = OSMTile.get_tiles([tile['ref'] for tile in tiles
+                                   if tile['surface'] is None], zoom)
+    
+    # Now take the parts of those tiles, and copy them into our new image
+    for tile in tiles:
+        if tile['surface'] is None:
+            try:
+                if tile_data[tile['ref']] is None:
+                    raise IOError("Tile %d/%d/%d unavailable" % (
+                        zoom, tile['ref'][0], tile['ref'][1]))
+                # Convert now, so pasting a cached tile doesn't need to
+                tile['surface'] = PIL.Image.open(
+                    tile_data[tile['ref']]).convert('RGBA')
+            except Exception, e:
+                tile['surface'] = get_fallback_tile()
+                malformed = True
+            else:
+                tile_cache.put(tile['ref'] + (zoom,), tile['surface'])
         
         image.paste(tile['surface'], ((tile['ref'][0] - tx_min) * 256 - ox, (tile['ref'][1] - ty_min) * 256 - oy))
     
     # Now add the markers to the image
     points.sort(key=lambda p:p[0][1])
-    marker_dir = get_marker_dir()
+    marker_atlas = get_marker_atlas()
     for (tx, ty), color, index in points:
         if index is None:
-            off, fn = (10, 10), "%s-star.png" % color
+            off, name = (10, 10), "%s-star" % color
         else:
-            off, fn = (10, 25), "%s-%d.png" % (color, index)
-        fn = os.path.join(marker_dir, fn)
-        marker = PIL.Image.open(fn)
+            off, name = (10, 25), "%s-%d" % (color, index)
+        marker = marker_atlas.get(name)
         off = (
             int((tx - tx_min) * 256 - off[0] - ox),
             int((ty - ty_min) * 256 - off[1] - oy),
@@ -178,78 +221,165 @@ def get_map(points, width, height, filename, zoom=None, lon_center=None, lat_cen
         raise MapGenerationError((lon_center, lat_center))
     return lon_center, lat_center
 
-class PointSet(set):
-    
-    def __init__(self, initial=None):
-        """
-        @param initial: An initial point set to use
-        @type initial: ( (float, float) )
-        """
-        super(PointSet, self).__init__(initial)
-        self._min = (float('inf'), float('inf'))
-        self._max = (float('-inf'), float('-inf'))
-        self.ordered = []
-        for p in initial:
-            self.update(p)
-        
-    def add(self, point):
-        """
-        Add a point to the set
-        
-        @param point: The point to be added
-        @type point: (float, float)
-        """
-        super(PointSet, self).add(point)
-        self.update(point)
-    
-    def remove(self, point):
-        """
-        Remove a point from the set
-        
-        @param point: The point to be removed
-        @type point: (float, float)
-        """
-        self.ordered.remove(point)
-        super(PointSet, self).remove(point)
-        if any((point[i] in (self._min[i], self._max[i])) for i in range(2)):
-            self._min = (float('inf'), float('inf'))
-            self._max = (float('-inf'), float('-inf'))
-            for point in self:
-                self._min = (min(self._min[0], point[0]),
-                             min(self._min[1], point[1]))
-                self._max = (max(self._max[0], point[0]),
-                             max(self._max[1], point[1]))
-    
-    def update(self, point):
-        """
-        Update the set
-        
-        @param point: The point to be added
-        @type point: (float, float)
-        """
-        self.ordered.append(point)
-        self._min = min(self._min[0], point[0]), min(self._min[1], point[1])
-        self._max = max(self._max[0], point[0]), max(self._max[1], point[1])
-        
-    def extent(self, zoom):
-        """
-        Get the bounding box of this set of points
-        
-        @param zoom: The zoom level to use
-        """
-        top_left = get_tile_ref(self._min[0], self._min[1], zoom)
-        bottom_right = get_tile_ref(self._max[0], self._max[1], zoom)
-        
-        a = (bottom_right[0]-top_left[0])*256, (top_left[1]-bottom_right[1])*256
-        return a
-        
-    def contained_within(self, box, zoom):
-        """
-        Check if @C{box} is inside this pointset at the specified zoom level
-        """
-        extent = self.extent(zoom)
+def get_extent(lon_lat_min, lon_lat_max, zoom):
+    """
+    Get the size of the bounding box of a set of points
+    
+    @param lon_lat_min: The minimum longitude and latitude of the points
+    @type lon_lat_min: (float, float)
+    @param lon_lat_max: The maximum longitude and latitude of the points
+    @type lon_lat_max: (float, float)
+    @param zoom: The zoom level to use
+    @type zoom: int
+    @return: The width and height of the bounding box, in pixels
+    """
+    top_left = get_tile_ref(lon_lat_min[0], lon_lat_min[1], zoom)
+    bottom_right = get_tile_ref(lon_lat_max[0], lon_lat_max[1], zoom)
+    return (bottom_right[0]-top_left[0])*256, (top_left[1]-bottom_right[1])*256
+
+def fit_points(points, min_points, box, zoom):
+    """
+    Finds the zoom level at which the first @C{min_points} points fit inside
+    @C{box} (zooming out from @C{zoom} as necessary), and then how many of the
+    points fit inside the box at that zoom level.
+    
+    As the bounding box of the first n points only grows with n, and only
+    shrinks when zooming out, both of these are found by searching on the
+    bounding boxes of each prefix of the points. Those bounding boxes are only
+    worked out as far in to the list of points as the search needs.
+    
+    @param points: An (ordered) list of points, as tuples starting with
+                   longitude and latitude
+    @type points: list
+    @param min_points: The number of points which must fit on the map
+    @type min_points: int
+    @param box: The width and height which the points must fit in to
+    @type box: (int, int)
+    @param zoom: The maximum zoom level to use
+    @type zoom: int
+    @return: The number of points that fit, and the zoom level
+    @rtype: (int, int)
+    """
+    
+    # The bounding box of each prefix of the points
+    prefix_min, prefix_max = [], []
+    
+    def fits(n, zoom):
+        while len(prefix_min) < n:
+            point = points[len(prefix_min)]
+            if prefix_min:
+                (lon_min, lat_min), (lon_max, lat_max) = prefix_min[-1], prefix_max[-1]
+                prefix_min.append((min(lon_min, point[0]), min(lat_min, point[1])))
+                prefix_max.append((max(lon_max, point[0]), max(lat_max, point[1])))
+            else:
+                prefix_min.append((point[0], point[1]))
+                prefix_max.append((point[0], point[1]))
+        extent = get_extent(prefix_min[n-1], prefix_max[n-1], zoom)
         return extent[0] <= box[0] and extent[1] <= box[1]
-        
+    
+    min_points = min(min_points, len(points))
+    
+    # Zoom out until the minimum points fit, first by doubling the steps to
+    # find a zoom level which fits, and then binary searching back in
+    if not fits(min_points, zoom):
+        step, fitting = 1, zoom - 1
+        while not fits(min_points, fitting):
+            zoom, step = fitting, step * 2
+            fitting = zoom - step
+        while fitting < zoom - 1:
+            mid = (fitting + zoom) // 2
+            if fits(min_points, mid):
+                fitting = mid
+            else:
+                zoom = mid
+        zoom = fitting
+    
+    # Then find the longest run of points which fits at that zoom level, in
+    # the same way
+    low, step = min_points, 1
+    high = low + step
+    while high <= len(points) and fits(high, zoom):
+        low, step = high, step * 2
+        high = low + step
+    high = min(high - 1, len(points))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid, zoom):
+            low = mid
+        else:
+            high = mid - 1
+    
+    return low, zoom
+
+def fit_map(centre_point, points, min_points, zoom, width, height):
+    """
+    Works out which points are to be shown on a fitted map, and at what zoom
+    level, without drawing it. See @C{get_fitted_map} for the parameters.
+    
+    @return: A tuple of the markers to pass to @C{get_map}, the points shown
+             on the map with the indices they came from in @C{points}, and
+             the zoom level
+    @rtype: (list, list, int)
+    """
+
+    # If we haven't been given a zoom, start as close as we can
+    if not zoom:
+        zoom = 18
+
+    box = max(64, width - 20), max(64, height-35)
+    
+    new_points = []
+    for i, point in enumerate(points):
+        if i>1 and point == new_points[-1][0]:
+            new_points[-1][1].append(i)
+        else:
+            new_points.append( (point, [i]) )
+    
+    points = [p[0] for p in new_points]
+    
+    # Include the central point in the points to be considered
+    if centre_point:
+        points = [centre_point] + list(points)
+    
+    used, zoom = fit_points(points, min_points+1, box, zoom)
+    
+    if centre_point:
+        used_points = points[1:used]
+        markers = [(centre_point[0], centre_point[1], centre_point[2], None)]
+    else:
+        used_points = points[:used]
+        markers = []
+    
+    for i, point in enumerate(used_points):
+        markers.append(
+            (point[0], point[1], point[2], i+1)
+        )
+    
+    # Points which appear more than once are only counted once
+    used = len(set(points[:used]))
+    if centre_point:
+        new_points = new_points[:used-1]
+    else:
+        new_points = new_points[:used]
+    
+    return markers, new_points, zoom
+
+def plan_fitted_map(centre_point, points, min_points, zoom, width, height):
+    """
+    Works out everything about a fitted map except for drawing it, so that it
+    can be drawn later. This takes the same arguments as @C{get_fitted_map},
+    except for the filename.
+    
+    @return: The metadata that @C{get_fitted_map} would return, and the
+             arguments (other than the filename) to pass to @C{get_map} to
+             draw the map
+    @rtype: (tuple, tuple)
+    """
+    markers, new_points, zoom = fit_map(centre_point, points, min_points, zoom,
+                                        width, height)
+    lon_center, lat_center = get_map_centre(markers)
+    return (new_points, zoom, lon_center, lat_center), \
+           (markers, width, height, zoom)
 
 def get_fitted_map(centre_point, points, min_points, zoom, width, height, filename):
     """
@@ -288,65 +418,35 @@ def get_fitted_map(centre_point, points, min_points, zoom, width, height, filena
                                OSM tile server is down)
     """
 
-    # If we haven't been given a zoom, start as close as we can
-    if not zoom:
-        zoom = 18
-
-    box = max(64, width - 20), max(64, height-35)
+    points, new_points, zoom = fit_map(centre_point, points, min_points, zoom,
+                                       width, height)
     
-    new_points = []
-    for i, point in enumerate(points):
-        if i>1 and point == new_points[-1][0]:
-            new_points[-1][1].append(i)
-        else:
-            new_points.append( (point, [i]) )
-    
-    points = [p[0] for p in new_points]
-    
-    # Include the central point in the points to be considered
-    if centre_point:
-        points = [centre_point] + list(points)
-    
-    # Get a set of the minimum points
-    point_set, points = PointSet(points[:min_points+1]), points[min_points+1:]
+    try:
+        lon_center, lat_center = get_map(points, width, height, filename, zoom)
+    except MapGenerationError as e:
+        e.metadata = (new_points, zoom, e.metadata[0], e.metadata[1])
+        raise
     
-    # Zoom out until the entire point set fits inside the generated map
-    while not point_set.contained_within(box, zoom):
-        zoom -= 1
+    return new_points, zoom, lon_center, lat_center
 
-    # If there are points outside the minimum points, see if they fit inside
-    # the bounding box of the minimum points (or the specified zoom level)
-    while point_set.contained_within(box, zoom):
-        if not points:
-            break
-        new_point, points = points[0], points[1:]
-        point_set.add(new_point)
-    else:
-        point_set.remove(new_point)
-    
-    if centre_point:
-        used_points = point_set.ordered[1:]
-        points = [(centre_point[0], centre_point[1], centre_point[2], None)]
-    else:
-        used_points = point_set.ordered[:]
-        points = []
-    
-    for i, point in enumerate(used_points):
-        points.append(
-            (point[0], point[1], point[2], i+1)
-        )
-    
-    if centre_point:
-        new_points = new_points[:len(point_set)-1]
-    else:
-        new_points = new_points[:len(point_set)]
+def get_planned_map(plan, filename):
+    """
+    Draws a map which has been planned by @C{plan_fitted_map}, without
+    fitting it again
     
+    @param plan: What @C{plan_fitted_map} returned
+    @type plan: (tuple, tuple)
+    @return: The same metadata as @C{get_fitted_map}
+    @raise MapGenerationError: If a map can not be generated (normally if the
+                               OSM tile server is down)
+    """
+    (new_points, zoom, lon_center, lat_center), render_args = plan
+    markers, width, height, zoom = render_args
     try:
-        lon_center, lat_center = get_map(points, width, height, filename, zoom)
+        get_map(markers, width, height, filename, zoom)
     except MapGenerationError as e:
         e.metadata = (new_points, zoom, e.metadata[0], e.metadata[1])
         raise
-    
     return new_points, zoom, lon_center, lat_center
 
 class MapGenerationError(Exception):
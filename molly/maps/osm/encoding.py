@@ -0,0 +1,158 @@
+"""
+The encodings generated maps can be served in. A map is always drawn as a
+full colour PNG, and is re-encoded in to the smaller encodings a device can
+display the first time it is asked for, with each encoding kept alongside the
+original. Which encoding is smallest depends on the map (lossy encodings do
+well on shaded tiles, palette PNGs on flat ones), so the smallest of those the
+device supports is served.
+"""
+
+import logging
+import os
+
+import PIL.Image
+
+from django.conf import settings
+
+from molly.maps.osm.models import get_generated_map_storage
+
+logger = logging.getLogger('molly.osm.generation')
+
+def get_preferred_map_encodings():
+    """
+    @return: The encodings to consider serving generated maps in, with maps
+             being served as full colour PNGs to devices which support none
+             of them
+    """
+    return getattr(settings, 'GENERATED_MAP_ENCODINGS',
+                   ('webp', 'jpeg', 'png8'))
+
+def get_map_quality():
+    """
+    @return: The quality (from 1 to 100) to encode lossy maps at
+    """
+    return getattr(settings, 'GENERATED_MAP_QUALITY', 75)
+
+def encode_png(image, f):
+    image.save(f, 'png', optimize=True)
+
+def encode_png8(image, f):
+    image = image.convert('RGB').convert('P', palette=PIL.Image.ADAPTIVE,
+                                         colors=256)
+    image.save(f, 'png', optimize=True)
+
+def encode_jpeg(image, f):
+    image.convert('RGB').save(f, 'jpeg', quality=get_map_quality(),
+                              optimize=True, progressive=True)
+
+def encode_webp(image, f):
+    image.convert('RGB').save(f, 'webp', quality=get_map_quality())
+
+# name: (content type, encoder)
+MAP_ENCODINGS = {
+    'png': ('image/png', encode_png),
+    'png8': ('image/png', encode_png8),
+    'jpeg': ('image/jpeg', encode_jpeg),
+    'webp': ('image/webp', encode_webp),
+}
+
+def can_encode(encoding):
+    """
+    @return: Whether the installed PIL can write this encoding
+    """
+    PIL.Image.init()
+    return {'jpeg': 'JPEG', 'webp': 'WEBP'}.get(encoding, 'PNG') \
+        in PIL.Image.SAVE
+
+def device_supports(device, encoding):
+    """
+    @param device: The WURFL device the map is for
+    @param encoding: The name of an encoding in @C{MAP_ENCODINGS}
+    @type encoding: str
+    @return: Whether the device can display maps in this encoding
+    """
+    if encoding == 'webp':
+        return getattr(device, 'webp_lossy_support', False)
+    elif encoding == 'jpeg':
+        # Devices with few colours are better served by a palette PNG than a
+        # dithered JPEG
+        return getattr(device, 'jpg', False) \
+           and getattr(device, 'colors', 0) >= 65536
+    else:
+        return getattr(device, 'png', True)
+
+def get_map_encodings(device):
+    """
+    @param device: The WURFL device the map is for
+    @return: The names of the encodings the device supports, or just 'png' if
+             it supports none of the preferred encodings
+    @rtype: [str]
+    """
+    encodings = [encoding for encoding in get_preferred_map_encodings()
+                 if encoding in MAP_ENCODINGS
+                and can_encode(encoding)
+                and device_supports(device, encoding)]
+    return encodings or ['png']
+
+def encode_map(generated_map, encoding):
+    """
+    Encodes a generated map, unless it has already been encoded that way
+
+    @param generated_map: The map, which must already have been drawn
+    @type generated_map: GeneratedMap
+    @param encoding: The name of an encoding in @C{MAP_ENCODINGS}
+    @type encoding: str
+    @return: The name of the file containing the encoded map, or None if it
+             couldn't be encoded
+    @rtype: str
+    """
+    if encoding == 'png':
+        return generated_map.get_filename()
+
+    storage = get_generated_map_storage()
+    name = generated_map.get_artifact_name(encoding)
+    # The original is here, so encoding it again is quicker than waiting for
+    # peers to say whether they have this encoding
+    if not storage.exists_locally(name):
+        # Write to a temporary file first, so that concurrent requests never
+        # see a partially written map
+        temp_filename = storage.get_temp_filename(name)
+        try:
+            image = PIL.Image.open(generated_map.get_filename())
+            f = open(temp_filename, 'wb')
+            try:
+                MAP_ENCODINGS[encoding][1](image, f)
+            finally:
+                f.close()
+            storage.put(name, temp_filename)
+        except (IOError, KeyError), e:
+            logger.warning("Unable to encode map %s as %s: %s",
+                           generated_map.hash, encoding, e)
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            return None
+    return storage.get_filename(name)
+
+def get_encoded_map(generated_map, encodings):
+    """
+    @param generated_map: The map, which must already have been drawn
+    @type generated_map: GeneratedMap
+    @param encodings: The encodings the map can be served in, as returned by
+                      @C{get_map_encodings}
+    @type encodings: [str]
+    @return: The name of the file containing the smallest encoding of the map,
+             its content type and the name of that encoding
+    @rtype: (str, str, str)
+    """
+    smallest = None
+    for encoding in encodings:
+        filename = encode_map(generated_map, encoding)
+        if filename is None:
+            continue
+        size = os.path.getsize(filename)
+        if smallest is None or size < smallest[0]:
+            smallest = size, filename, encoding
+    if smallest is None:
+        return generated_map.get_filename(), 'image/png', 'png'
+    size, filename, encoding = smallest
+    return filename, MAP_ENCODINGS[encoding][0], encoding
@@ -0,0 +1,119 @@
+"""
+Exports of every entity of a type, as GPX, KML or GeoJSON. Only the title
+and location of each entity is read, a chunk of entities at a time, and the
+document is written out as it goes, so exporting a type with hundreds of
+thousands of entities takes no more memory than exporting one with ten.
+"""
+
+from xml.sax.saxutils import escape
+
+import simplejson
+
+# The number of entities to read from the database at a time
+CHUNK_SIZE = 1000
+
+# The number of bytes of the document to collect before handing them on
+BUFFER_SIZE = 64 * 1024
+
+def iter_locations(entities, chunk_size=CHUNK_SIZE):
+    """
+    Reads the titles and locations of entities in chunks, each fetched by
+    carrying on from the primary key the last one stopped at, so that neither
+    the database driver nor Django ever holds more than one chunk in memory.
+
+    @param entities: The entities to read
+    @type entities: QuerySet
+    @return: The (title, longitude, latitude) of each entity with a location
+    """
+    entities = entities.exclude(location=None).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = entities
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list('pk', 'title', 'location')[:chunk_size])
+        for pk, title, location in rows:
+            yield title, location.x, location.y
+        if len(rows) < chunk_size:
+            break
+        last_pk = rows[-1][0]
+
+def buffered(strings, size=BUFFER_SIZE):
+    """
+    Joins the many small strings a document is written as in to fewer larger
+    ones, so that they can be sent efficiently
+    """
+    buf, length = [], 0
+    for s in strings:
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        buf.append(s)
+        length += len(s)
+        if length >= size:
+            yield ''.join(buf)
+            buf, length = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def gpx_document(locations, name):
+    """
+    @param locations: The (title, longitude, latitude) of each waypoint
+    @param name: The name of the document
+    @type name: unicode
+    @return: The parts of a GPX document
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<gpx version="1.0"'
+    yield ' creator="Molly Project &lt;http://mollyproject.org/&gt;"'
+    yield ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    yield ' xmlns="http://www.topografix.com/GPX/1/0"'
+    yield ' xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">\n'
+    yield '  <name>%s</name>\n' % escape(name)
+    for title, lon, lat in locations:
+        yield '  <wpt lat="%f" lon="%f">\n' % (lat, lon)
+        yield '    <name>%s</name>\n' % escape(title)
+        yield '  </wpt>\n'
+    yield '</gpx>\n'
+
+def kml_document(locations, name):
+    """
+    @return: The parts of a KML document, taking the same arguments as
+             @C{gpx_document}
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+    yield '<Document>\n'
+    yield '  <name>%s</name>\n' % escape(name)
+    for title, lon, lat in locations:
+        yield '  <Placemark>\n'
+        yield '    <name>%s</name>\n' % escape(title)
+        yield '    <Point><coordinates>%f,%f</coordinates></Point>\n' % (
+            lon, lat)
+        yield '  </Placemark>\n'
+    yield '</Document>\n'
+    yield '</kml>\n'
+
+def geojson_document(locations, name):
+    """
+    @return: The parts of a GeoJSON feature collection, taking the same
+             arguments as @C{gpx_document}
+    """
+    yield '{"type": "FeatureCollection", "name": %s, "features": [' % (
+        simplejson.dumps(name))
+    separator = '\n'
+    for title, lon, lat in locations:
+        yield separator
+        yield simplejson.dumps({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'title': title},
+        })
+        separator = ',\n'
+    yield '\n]}\n'
+
+# name: (content type, writer)
+EXPORT_FORMATS = {
+    'gpx': ('application/gpx+xml', gpx_document),
+    'kml': ('application/vnd.google-earth.kml+xml', kml_document),
+    'geojson': ('application/json', geojson_document),
+}
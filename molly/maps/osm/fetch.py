@@ -0,0 +1,166 @@
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+from Queue import Queue, Empty
+
+from django.conf import settings
+
+logger = logging.getLogger('molly.osm.fetch')
+
+def get_tile_url(xtile, ytile, zoom, tile_url=None):
+    """
+    Return a URL for a tile given some OSM tile co-ordinates
+    
+    @param tile_url: A template for the URL, with %(zoom)d, %(xtile)d and
+                     %(ytile)d in it, defaulting to the OSM_TILE_URL setting
+    @type tile_url: str
+    """
+    if tile_url is None:
+        tile_url = getattr(settings, 'OSM_TILE_URL',
+            'http://tile.openstreetmap.org/%(zoom)d/%(xtile)d/%(ytile)d.png')
+    return tile_url % {'zoom': zoom, 'xtile': xtile, 'ytile': ytile}
+
+def get_tile_fetch_workers():
+    """
+    @return: The maximum number of connections to open to the tile server when
+             fetching tiles for a single map
+    """
+    return getattr(settings, 'OSM_TILE_FETCH_WORKERS', 6)
+
+def get_tile_fetch_timeout():
+    """
+    @return: The number of seconds to wait on the tile server for any one tile
+             before giving up on it
+    """
+    return getattr(settings, 'OSM_TILE_FETCH_TIMEOUT', 5)
+
+class TileFetcher(threading.Thread):
+    """
+    A worker which takes tile references off a shared queue and fetches them,
+    reusing one keep-alive connection per tile server for as long as it can.
+    """
+
+    def __init__(self, queue, results, timeout, tile_url=None):
+        """
+        @param queue: The queue of (xtile, ytile, zoom) references to fetch
+        @type queue: Queue.Queue
+        @param results: A dictionary to put the fetched tile data in to
+        @type results: dict
+        @param timeout: The socket timeout to use, in seconds
+        @type timeout: float
+        @param tile_url: The template for tile URLs, as for @C{get_tile_url}
+        @type tile_url: str
+        """
+        super(TileFetcher, self).__init__()
+        self.daemon = True
+        self.queue, self.results, self.timeout = queue, results, timeout
+        self.tile_url = tile_url
+        self._connections = {}
+
+    def run(self):
+        while True:
+            try:
+                ref = self.queue.get_nowait()
+            except Empty:
+                break
+            self.results[ref] = self.fetch(ref)
+        for connection in self._connections.values():
+            connection.close()
+
+    def get_connection(self, scheme, netloc):
+        if netloc not in self._connections:
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc,
+                                                     timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc,
+                                                    timeout=self.timeout)
+            self._connections[netloc] = connection
+        return self._connections[netloc]
+
+    def drop_connection(self, netloc):
+        self._connections.pop(netloc).close()
+
+    def fetch(self, ref, retry=True):
+        """
+        @return: The tile data, or None if the tile could not be fetched
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(
+            get_tile_url(ref[0], ref[1], ref[2], self.tile_url))
+        if query:
+            path += '?' + query
+        connection = self.get_connection(scheme, netloc)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            data = response.read()
+        except socket.timeout:
+            self.drop_connection(netloc)
+            logger.warning("Timed out fetching tile %d/%d/%d", ref[2], ref[0],
+                           ref[1])
+            return None
+        except (socket.error, httplib.HTTPException), e:
+            # The server may have closed a kept-alive connection on us, so
+            # try again on a fresh one, but only once
+            self.drop_connection(netloc)
+            if retry:
+                return self.fetch(ref, retry=False)
+            logger.warning("Unable to fetch tile %d/%d/%d: %s", ref[2], ref[0],
+                           ref[1], e)
+            return None
+
+        if response.status != 200:
+            logger.warning("Unable to fetch tile %d/%d/%d: HTTP %d", ref[2],
+                           ref[0], ref[1], response.status)
+            return None
+        return data
+
+def fetch_tiles(refs, workers=None, timeout=None, tile_url=None):
+    """
+    Fetches a number of tiles from the tile server at once, using a bounded
+    pool of workers.
+
+    @param refs: The tiles to fetch, as (xtile, ytile, zoom) tuples
+    @type refs: [(int, int, int)]
+    @param workers: The maximum number of tiles to fetch in parallel, defaults
+                    to the OSM_TILE_FETCH_WORKERS setting
+    @type workers: int
+    @param timeout: The time to wait for any one tile, in seconds, defaults to
+                    the OSM_TILE_FETCH_TIMEOUT setting
+    @type timeout: float
+    @param tile_url: The template for tile URLs, defaulting to the OSM_TILE_URL
+                     setting
+    @type tile_url: str
+    @return: A dictionary mapping each tile reference to its data, or None if
+             that tile could not be fetched in time
+    @rtype: dict
+    """
+    refs = set(refs)
+    results = dict((ref, None) for ref in refs)
+    if not refs:
+        return results
+
+    workers = workers or get_tile_fetch_workers()
+    timeout = timeout or get_tile_fetch_timeout()
+
+    queue = Queue()
+    for ref in refs:
+        queue.put(ref)
+
+    fetchers = [TileFetcher(queue, results, timeout, tile_url)
+                for i in range(min(workers, len(refs)))]
+    for fetcher in fetchers:
+        fetcher.start()
+
+    # Each worker handles its share of the tiles one after the other, so allow
+    # for that (plus a connection set up) before giving up on stragglers
+    rounds = -(-len(refs) // len(fetchers)) + 1
+    deadline = time.time() + timeout * rounds
+    for fetcher in fetchers:
+        fetcher.join(max(0, deadline - time.time()))
+
+    # Copy the results, as a straggling worker may still write to them
+    return dict(results)
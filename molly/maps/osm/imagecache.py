@@ -0,0 +1,203 @@
+"""
+In-process caches of decoded images used when compositing maps, so that
+popular tiles and markers don't need to be read and decoded for every map.
+"""
+
+import os
+import os.path
+import threading
+import time
+
+import PIL.Image
+
+from django.conf import settings
+
+from molly.maps.osm.models import TILE_MAX_AGE, get_marker_dir
+from molly.maps.osm.markers import draw_marker, save_marker
+from molly.utils.misc import OrderedDict
+
+def get_image_cache_size():
+    """
+    @return: The number of bytes of decoded tiles to keep in memory in each
+             process
+    """
+    return getattr(settings, 'MAP_IMAGE_CACHE_SIZE', 64 * 1024 * 1024)
+
+def image_size(image):
+    """
+    @return: The approximate number of bytes a decoded image takes up
+    """
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+class ImageCache(object):
+    """
+    A least-recently-used cache of decoded images, bounded by the memory the
+    images take up rather than by how many there are.
+    """
+
+    def __init__(self, max_size, max_age=None):
+        """
+        @param max_size: The maximum number of bytes of images to keep
+        @type max_size: int
+        @param max_age: How long an image can be kept for, in seconds, or None
+                        to keep images until they are evicted
+        @type max_age: float
+        """
+        self.max_size, self.max_age = max_size, max_age
+        self.size = 0
+        self.hits, self.misses = 0, 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        @return: The cached image, or None if it isn't in the cache
+        """
+        with self._lock:
+            try:
+                image, added = self._images.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if self.max_age is not None and added < time.time() - self.max_age:
+                self.size -= image_size(image)
+                self.misses += 1
+                return None
+            # Re-insert it, so it's now the most recently used
+            self._images[key] = image, added
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """
+        Add a decoded image to the cache, evicting the least recently used
+        images if that takes the cache over its size.
+        """
+        size = image_size(image)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._images:
+                self.size -= image_size(self._images.pop(key)[0])
+            self._images[key] = image, time.time()
+            self.size += size
+            while self.size > self.max_size:
+                evicted, added = self._images.popitem(last=False)[1]
+                self.size -= image_size(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
+
+class MarkerAtlas(object):
+    """
+    All of the marker images, decoded once and held as a single sprite atlas
+    """
+
+    # The width of the atlas; markers are packed in to rows this wide
+    WIDTH = 1024
+
+    def __init__(self, marker_dir, preload=True):
+        """
+        @param marker_dir: The directory containing the marker images
+        @type marker_dir: str
+        @param preload: Whether to load every marker now, rather than loading
+                        each one the first time it is used
+        @type preload: bool
+        """
+        self.marker_dir = marker_dir
+        self.image, self._boxes, self._extra = None, {}, {}
+        self._lock = threading.Lock()
+        if preload:
+            self.load()
+
+    def load(self):
+        markers = []
+        if os.path.exists(self.marker_dir):
+            for filename in sorted(os.listdir(self.marker_dir)):
+                if not filename.endswith('.png'):
+                    continue
+                marker = PIL.Image.open(os.path.join(self.marker_dir, filename))
+                markers.append((filename[:-4], marker.convert('RGBA')))
+
+        # Pack the markers left to right in rows
+        x, y, row_height, boxes = 0, 0, 0, {}
+        for name, marker in markers:
+            width, height = marker.size
+            if x + width > self.WIDTH:
+                x, y, row_height = 0, y + row_height, 0
+            boxes[name] = (x, y, x + width, y + height)
+            x, row_height = x + width, max(row_height, height)
+
+        image = PIL.Image.new('RGBA', (self.WIDTH, max(1, y + row_height)))
+        for name, marker in markers:
+            image.paste(marker, boxes[name][:2])
+        self.image, self._boxes = image, boxes
+
+    def get(self, name):
+        """
+        @param name: The name of the marker, e.g., 'red-12' or 'blue-star'
+        @type name: str
+        @return: The marker image
+        @raise IOError: If there is no such marker
+        """
+        box = self._boxes.get(name)
+        if box is not None:
+            return self.image.crop(box)
+
+        # This may be a marker that has been created since the atlas was
+        # built (or it wasn't preloaded), so fall back to loading it
+        # individually, or drawing it if it hasn't been generated at all
+        with self._lock:
+            if name not in self._extra:
+                filename = os.path.join(self.marker_dir, '%s.png' % name)
+                if os.path.exists(filename):
+                    marker = PIL.Image.open(filename)
+                else:
+                    try:
+                        marker = draw_marker(name)
+                    except ValueError, e:
+                        raise IOError(str(e))
+                    self._save(name, marker)
+                self._extra[name] = marker.convert('RGBA')
+            return self._extra[name]
+
+    def _save(self, name, marker):
+        # Keep the marker for other processes, and the next time the atlas
+        # is built, if we can
+        try:
+            if not os.path.exists(self.marker_dir):
+                os.makedirs(self.marker_dir)
+            save_marker(self.marker_dir, name, marker)
+        except (IOError, OSError):
+            pass
+
+_tile_cache = None
+_marker_atlas = None
+_setup_lock = threading.Lock()
+
+def get_tile_cache():
+    """
+    @return: The cache of decoded tiles for this process, keyed by
+             (xtile, ytile, zoom)
+    @rtype: ImageCache
+    """
+    global _tile_cache
+    with _setup_lock:
+        if _tile_cache is None:
+            _tile_cache = ImageCache(
+                get_image_cache_size(),
+                TILE_MAX_AGE.days * 86400 + TILE_MAX_AGE.seconds)
+    return _tile_cache
+
+def get_marker_atlas():
+    """
+    @return: The marker atlas for this process, which is built on first use
+    @rtype: MarkerAtlas
+    """
+    global _marker_atlas
+    with _setup_lock:
+        if _marker_atlas is None:
+            _marker_atlas = MarkerAtlas(get_marker_dir())
+    return _marker_atlas
@@ -0,0 +1,200 @@
+"""
+Draws the markers put on generated maps. These are drawn with PIL rather than
+rendered from SVG, so they can be drawn in-process whenever one is needed.
+"""
+
+import math
+import os
+import os.path
+from multiprocessing import Pool, cpu_count
+
+import PIL.Image
+import PIL.ImageColor
+import PIL.ImageDraw
+import PIL.ImageFilter
+import PIL.ImageFont
+
+from django.conf import settings
+
+MARKER_COLORS = (
+    # name, fill, border, text
+    ('amber', '#ff7e00', '#824000', '#000000'),
+    ('blue', '#0000ff', '#000050', '#ffffff'),
+    ('green', '#00ff1e', '#005009', '#000000'),
+    ('purple', '#9146b8', '#3c1d4c', '#ffffff'),
+    ('red', '#ff0000', '#500000', '#ffffff'),
+    ('yellow', '#f0ff00', '#4b5000', '#000000'),
+)
+
+MARKER_RANGE = xrange(1, 100)
+
+# Markers are drawn this many times larger than they end up, and then scaled
+# down, to anti-alias them
+SCALE = 4
+
+def get_marker_font():
+    """
+    @return: The TrueType font to number markers with
+    """
+    return getattr(settings, 'MARKER_FONT', 'DejaVuSans-Bold.ttf')
+
+_font = None
+
+def _get_font():
+    global _font
+    if _font is None:
+        try:
+            _font = PIL.ImageFont.truetype(get_marker_font(), 10 * SCALE)
+        except IOError:
+            _font = PIL.ImageFont.load_default()
+    return _font
+
+def get_marker_names():
+    """
+    @return: The names of all the markers, e.g., 'red-12' and 'blue-star'
+    @rtype: [str]
+    """
+    names = []
+    for color in MARKER_COLORS:
+        names.extend('%s-%d' % (color[0], index) for index in MARKER_RANGE)
+        names.append('%s-star' % color[0])
+    return names
+
+def _scaled(points):
+    return [(x * SCALE, y * SCALE) for x, y in points]
+
+def _stroke(mask, fill, border, width):
+    """
+    Colours in a shape, with a border centred on its edge
+
+    @param mask: The shape, drawn at SCALE times its final size
+    @type mask: PIL.Image
+    @param width: The width of the border, in final pixels
+    @type width: float
+    @return: The coloured in shape, still at SCALE times its final size
+    @rtype: PIL.Image
+    """
+    # Grow and shrink the shape by half the border width each way
+    size = int(width * SCALE / 2) * 2 + 1
+    outer = mask.filter(PIL.ImageFilter.MaxFilter(size))
+    inner = mask.filter(PIL.ImageFilter.MinFilter(size))
+
+    # Start from a transparent version of the border colour, so there are no
+    # dark fringes once it is scaled down
+    image = PIL.Image.new('RGBA', mask.size,
+                          PIL.ImageColor.getrgb(border) + (0,))
+    image.paste(PIL.ImageColor.getrgb(border) + (255,), None, outer)
+    image.paste(PIL.ImageColor.getrgb(fill) + (255,), None, inner)
+    return image
+
+def draw_numbered_marker(fill, border, text, label):
+    """
+    @return: A 20x25 pin, with its point at the bottom middle, labelled with a
+             number
+    @rtype: PIL.Image
+    """
+    mask = PIL.Image.new('L', (20 * SCALE, 25 * SCALE))
+    draw = PIL.ImageDraw.Draw(mask)
+    draw.ellipse(_scaled([(0.9, 0.9), (19.1, 19.1)]), fill=255)
+    draw.polygon(_scaled([(2.9, 15.7), (10, 23.6), (17.1, 15.7)]), fill=255)
+    image = _stroke(mask, fill, border, 1.8)
+
+    # Centre the label in the head of the pin
+    label_mask = PIL.Image.new('L', image.size)
+    PIL.ImageDraw.Draw(label_mask).text((0, 0), label, fill=255,
+                                        font=_get_font())
+    box = label_mask.getbbox()
+    if box:
+        label_mask = label_mask.crop(box)
+        image.paste(PIL.ImageColor.getrgb(text) + (255,),
+                    (10 * SCALE - label_mask.size[0] // 2,
+                     10 * SCALE - label_mask.size[1] // 2,
+                     10 * SCALE - label_mask.size[0] // 2 + label_mask.size[0],
+                     10 * SCALE - label_mask.size[1] // 2 + label_mask.size[1]),
+                    label_mask)
+
+    return image.resize((20, 25), PIL.Image.ANTIALIAS)
+
+def draw_star_marker(fill, border):
+    """
+    @return: A 20x20 five-pointed star
+    @rtype: PIL.Image
+    """
+    points = []
+    for i in range(10):
+        radius = 9.6 if i % 2 == 0 else 4.8
+        angle = math.pi * (i / 5.0 - 0.5)
+        points.append((10 + radius * math.cos(angle),
+                       10.45 + radius * math.sin(angle)))
+    mask = PIL.Image.new('L', (20 * SCALE, 20 * SCALE))
+    PIL.ImageDraw.Draw(mask).polygon(_scaled(points), fill=255)
+    return _stroke(mask, fill, border, 1.7).resize((20, 20),
+                                                   PIL.Image.ANTIALIAS)
+
+def draw_marker(name):
+    """
+    @param name: The name of the marker, e.g., 'red-12' or 'blue-star'
+    @type name: str
+    @return: The marker
+    @rtype: PIL.Image
+    @raise ValueError: If there is no such marker
+    """
+    color_name, _, label = name.partition('-')
+    for color in MARKER_COLORS:
+        if color[0] == color_name:
+            break
+    else:
+        raise ValueError("No such marker colour: %r" % color_name)
+
+    if label == 'star':
+        return draw_star_marker(color[1], color[2])
+    elif label.isdigit() and int(label) in MARKER_RANGE:
+        return draw_numbered_marker(color[1], color[2], color[3], label)
+    else:
+        raise ValueError("No such marker: %r" % name)
+
+def save_marker(marker_dir, name, marker=None):
+    """
+    Draws a marker (unless it's given) and saves it to the marker directory
+    """
+    if marker is None:
+        marker = draw_marker(name)
+    filename = os.path.join(marker_dir, '%s.png' % name)
+    # Write to a temporary file first, so concurrent readers never see a
+    # partially written marker
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    marker.save(temp_filename, 'png')
+    os.rename(temp_filename, filename)
+
+def _save_markers(args):
+    marker_dir, names = args
+    for name in names:
+        save_marker(marker_dir, name)
+
+def generate_markers(marker_dir, processes=None):
+    """
+    Draws every marker in to the marker directory, spread over a pool of
+    processes
+
+    @param processes: The number of processes to use, defaulting to the
+                      number of CPUs, or 1 to draw the markers in this process
+    @type processes: int
+    """
+    if not os.path.exists(marker_dir):
+        os.makedirs(marker_dir)
+    names = get_marker_names()
+    if processes == 1:
+        _save_markers((marker_dir, names))
+        return
+
+    processes = processes or cpu_count()
+    pool = Pool(processes)
+    try:
+        # Hand out the markers in a few large chunks, as each only takes a
+        # millisecond or so to draw
+        chunks = processes * 4
+        pool.map(_save_markers, [(marker_dir, names[i::chunks])
+                                 for i in range(chunks)])
+    finally:
+        pool.close()
+        pool.join()
@@ -2,7 +2,8 @@ try:
     import cPickle as pickle
 except:
     import pickle
-import hashlib, os, urllib, simplejson, sys
+import glob, hashlib, os, urllib, simplejson, sys
+from time import mktime
 from datetime import datetime, timedelta
 from StringIO import StringIO
 
@@ -10,6 +11,12 @@ from django.db import models, IntegrityError
 from django.conf import settings
 
 from molly.apps.places.models import Entity
+from molly.maps.osm.fetch import get_tile_url, fetch_tiles
+from molly.maps.osm.tilestore import get_tile_store
+from molly.utils.artifacts import get_artifact_storage
+
+# How long a cached tile is used for before we go back to the tile server
+TILE_MAX_AGE = timedelta(1)
 
 # This used to be its own app, but has now been subsumed into the 'Maps' app,
 # but we use the old app_label on the models for backwards compatibility
@@ -19,6 +26,14 @@ def get_generated_map_dir():
                    'GENERATED_MAP_DIR',
                    os.path.join(settings.CACHE_DIR, 'generated_maps'))
 
+def get_generated_map_storage():
+    """
+    @return: Where the images of generated maps are kept, which is configured
+             by the ARTIFACT_STORAGE setting
+    @rtype: molly.utils.artifacts.ArtifactStorage
+    """
+    return get_artifact_storage('generated_maps', get_generated_map_dir())
+
 def get_marker_dir():
     return getattr(settings,
                    'MARKER_DIR',
@@ -40,6 +55,11 @@ class GeneratedMap(models.Model):
     _metadata = models.TextField(blank=True)
     faulty = models.BooleanField(default=False)
     
+    # A pending map has been planned, but won't be drawn until it's requested,
+    # using the arguments to get_map stored in render_args
+    pending = models.BooleanField(default=False)
+    _render_args = models.TextField(blank=True)
+    
     class Meta:
         app_label = 'maps'
         db_table = 'osm_generatedmap'
@@ -50,31 +70,53 @@ class GeneratedMap(models.Model):
         self._metadata = simplejson.dumps(value)
     metadata = property(_get_metadata, _set_metadata)
 
-    def get_filename(self):
-        generated_map_dir = get_generated_map_dir()
-        if not os.path.exists(generated_map_dir):
-            os.mkdir(generated_map_dir)
-        return os.path.join(generated_map_dir, self.hash)
+    def _get_render_args(self):
+        return simplejson.loads(self._render_args)
+    def _set_render_args(self, value):
+        self._render_args = simplejson.dumps(value)
+    render_args = property(_get_render_args, _set_render_args)
+
+    def get_artifact_name(self, encoding=None):
+        """
+        @param encoding: The encoding of the map, or None for the full colour
+                         PNG it was drawn as
+        @type encoding: str
+        @return: The name the image is kept under in the generated map storage.
+                 This includes when the map was generated, as a faulty map is
+                 drawn again under the same hash, and other nodes may still
+                 have a copy of the old image.
+        @rtype: str
+        """
+        name = '%s-%d' % (self.hash, mktime(self.generated.timetuple()))
+        if encoding:
+            return '%s.%s' % (name, encoding)
+        return name
+
+    def get_filename(self, encoding=None):
+        """
+        @param encoding: The encoding of the map, or None for the full colour
+                         PNG it was drawn as
+        @type encoding: str
+        """
+        return get_generated_map_storage().get_filename(
+            self.get_artifact_name(encoding))
 
     def delete(self, *args, **kwargs):
         """
-        When deleting from the db, also delete on disk
+        When deleting from the db, also delete on disk, along with any
+        re-encoded copies and the images of earlier generations
         """
-        try:
-            os.unlink(self.get_filename())
-        except:
-            pass
+        storage = get_generated_map_storage()
+        for filename in glob.glob(storage.get_filename(self.hash) + '*'):
+            storage.delete(os.path.basename(filename))
         return super(GeneratedMap, self).delete(*args, **kwargs)
 
-def get_tile_url(xtile, ytile, zoom):
-    """
-    Return a URL for a tile given some OSM tile co-ordinates
-    """
-    return "http://tile.openstreetmap.org/%d/%d/%d.png" % (zoom, xtile, ytile)
-
 class OSMTile(models.Model):
     """
-    In-database representation of a cached OSM tile on disk
+    In-database representation of a cached OSM tile on disk. This is only used
+    to store tiles by @C{molly.maps.osm.tilestore.FileTileStore}, but all
+    access to tiles should go through the static methods here, which use
+    whichever tile store is configured.
     """
     
     xtile = models.IntegerField()
@@ -93,48 +135,56 @@ class OSMTile(models.Model):
             os.mkdir(osm_tile_dir)
         return os.path.join(osm_tile_dir, "%d-%d-%d.png" % (self.xtile, self.ytile, self.zoom))
 
-    def refresh_data(self, retry=True):
-            
-        # Try to get the file from the OSM tile server
-        try:
-            response = urllib.urlopen(get_tile_url(self.xtile, self.ytile, self.zoom))
-        except IOError:
-            # If it fails... try again, but only once
-            if retry:
-                return self.refresh_data(retry=False)
+    def refresh_data(self):
+        data = fetch_tiles([(self.xtile, self.ytile, self.zoom)])[
+            self.xtile, self.ytile, self.zoom]
+        if data is None:
+            raise IOError("Unable to fetch tile %d/%d/%d" % (
+                self.zoom, self.xtile, self.ytile))
+        get_tile_store().put(self.xtile, self.ytile, self.zoom, data)
+        return StringIO(data)
+
+    @staticmethod
+    def get_tiles(refs, zoom):
+        """
+        Fetch a number of OSM tiles at once, going to the tile server in
+        parallel for any which aren't fresh in the cache.
+        
+        @param refs: The (xtile, ytile) co-ordinates of the tiles to fetch
+        @type refs: [(int, int)]
+        @param zoom: The zoom level of the tiles
+        @type zoom: int
+        @return: A dictionary mapping each (xtile, ytile) to a file-like object
+                 containing that tile, or None if it could not be fetched
+        @rtype: dict
+        """
+        tile_store, tiles, missing = get_tile_store(), {}, []
+        for xtile, ytile in refs:
+            tiles[xtile, ytile] = tile_store.get(xtile, ytile, zoom,
+                                                 max_age=TILE_MAX_AGE)
+            if tiles[xtile, ytile] is None:
+                missing.append((xtile, ytile, zoom))
+        
+        for (xtile, ytile, zoom), data in fetch_tiles(missing).items():
+            if data is None:
+                # Fall back to a stale tile if we have one
+                tiles[xtile, ytile] = tile_store.get(xtile, ytile, zoom)
             else:
-                raise
+                tile_store.put(xtile, ytile, zoom, data)
+                tiles[xtile, ytile] = data
         
-        s = StringIO()
-        s.write(response.read())
-        f = open(self.get_filename(), 'w')
-        f.write(s.getvalue())
-        f.close()
-        s.seek(0)
-        return s
+        return dict((ref, StringIO(data) if data is not None else None)
+                    for ref, data in tiles.items())
 
     @staticmethod
     def get_data(xtile, ytile, zoom):
         """
         Fetch an OSM tile from the OSM tile server, and cache it if necessary.
         """
-        try:
-            osm_tile = OSMTile.objects.get(xtile=xtile, ytile=ytile, zoom=zoom, last_fetched__gt = datetime.now() - timedelta(1))
-            if osm_tile.last_fetched < datetime.now() - timedelta(weeks=1):
-                try:
-                    return osm_tile.refresh_data()
-                except IOError:
-                    # Ignore IOErrors, because we already have some data, so
-                    # just use that
-                    pass
-            return open(osm_tile.get_filename())
-        except (OSMTile.DoesNotExist, IOError):
-            try:
-                osm_tile, created = OSMTile.objects.get_or_create(xtile=xtile, ytile=ytile, zoom=zoom)
-            except IntegrityError:
-                return OSMTile.get_data(xtile, ytile, zoom)
-            
-            return osm_tile.refresh_data()
+        data = OSMTile.get_tiles([(xtile, ytile)], zoom)[xtile, ytile]
+        if data is None:
+            raise IOError("Unable to fetch tile %d/%d/%d" % (zoom, xtile, ytile))
+        return data
     
 class OSMUpdate(models.Model):
     """
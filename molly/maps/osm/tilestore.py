@@ -0,0 +1,299 @@
+"""
+Storage for cached OSM tiles.
+
+Which store is used is configured by the OSM_TILE_STORE setting, which is the
+full path to a TileStore subclass. By default tiles are kept in a single
+MBTiles file.
+"""
+
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils.importlib import import_module
+
+def get_tile_store_class():
+    return getattr(settings,
+                   'OSM_TILE_STORE',
+                   'molly.maps.osm.tilestore.MBTilesTileStore')
+
+def get_mbtiles_filename():
+    return getattr(settings,
+                   'OSM_TILE_MBTILES',
+                   os.path.join(settings.CACHE_DIR, 'osm_tiles.mbtiles'))
+
+def get_tile_store_max_size():
+    """
+    @return: The number of bytes of tiles to keep before evicting the least
+             recently used ones, or None for no limit
+    """
+    return getattr(settings, 'OSM_TILE_STORE_MAX_SIZE', 512 * 1024 * 1024)
+
+_tile_store = None
+
+def get_tile_store():
+    """
+    @return: The configured tile store
+    @rtype: TileStore
+    """
+    global _tile_store
+    if _tile_store is None:
+        mod_name, cls_name = get_tile_store_class().rsplit('.', 1)
+        _tile_store = getattr(import_module(mod_name), cls_name)()
+    return _tile_store
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class TileStore(object):
+    """
+    The interface to a cache of OSM tiles
+    """
+
+    def get(self, xtile, ytile, zoom, max_age=None):
+        """
+        @param max_age: How old a cached tile can be and still be returned, or
+                        None if a tile of any age will do
+        @type max_age: timedelta or None
+        @return: The tile data, or None if the tile is not cached (or is not
+                 fresh enough)
+        @rtype: str or None
+        """
+        raise NotImplementedError
+
+    def put(self, xtile, ytile, zoom, data):
+        """
+        Adds a freshly fetched tile to the cache, replacing any older copy
+        """
+        raise NotImplementedError
+
+    def is_fresh(self, xtile, ytile, zoom, max_age):
+        """
+        @param max_age: How old a cached tile can be and still be fresh
+        @type max_age: timedelta
+        @return: Whether the tile is cached and no older than max_age
+        @rtype: bool
+        """
+        return self.get(xtile, ytile, zoom, max_age) is not None
+
+class FileTileStore(TileStore):
+    """
+    Keeps tiles as files in OSM_TILE_DIR, with an OSMTile row recording when
+    each was fetched.
+    """
+
+    def get(self, xtile, ytile, zoom, max_age=None):
+        from molly.maps.osm.models import OSMTile
+        osm_tiles = OSMTile.objects.filter(xtile=xtile, ytile=ytile, zoom=zoom)
+        if max_age is not None:
+            osm_tiles = osm_tiles.filter(
+                last_fetched__gt=datetime.now() - max_age)
+        try:
+            f = open(osm_tiles.get().get_filename(), 'rb')
+        except (OSMTile.DoesNotExist, IOError):
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def put(self, xtile, ytile, zoom, data):
+        from molly.maps.osm.models import OSMTile
+        try:
+            osm_tile, created = OSMTile.objects.get_or_create(
+                xtile=xtile, ytile=ytile, zoom=zoom)
+        except IntegrityError:
+            osm_tile, created = OSMTile.objects.get(
+                xtile=xtile, ytile=ytile, zoom=zoom), False
+
+        # Write to a temporary file first, so concurrent readers never see a
+        # partially written tile
+        filename = osm_tile.get_filename()
+        f = open(filename + '.tmp', 'wb')
+        f.write(data)
+        f.close()
+        os.rename(filename + '.tmp', filename)
+
+        if not created:
+            # Bump last_fetched
+            osm_tile.save()
+
+class MBTilesTileStore(TileStore):
+    """
+    Keeps tiles in a single MBTiles (SQLite) file, with when each tile was
+    fetched and last used stored alongside it. Once the store grows beyond
+    its maximum size, the least recently used tiles are evicted.
+    """
+
+    # Only record a tile being used if the last record is older than this
+    # many seconds, so most reads don't need to write
+    ACCESS_RESOLUTION = 3600
+
+    # When evicting, how far under the maximum size to go, so we don't evict
+    # on every subsequent write
+    EVICTION_HEADROOM = 0.9
+    EVICTION_BATCH = 256
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+        CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom_level INTEGER NOT NULL,
+            tile_column INTEGER NOT NULL,
+            tile_row INTEGER NOT NULL,
+            tile_data BLOB NOT NULL,
+            fetched REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+            ON tiles (zoom_level, tile_column, tile_row);
+        CREATE INDEX IF NOT EXISTS tile_accessed ON tiles (accessed);
+
+        CREATE TABLE IF NOT EXISTS molly_tile_store_size (bytes INTEGER NOT NULL);
+        INSERT INTO molly_tile_store_size (bytes)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM molly_tile_store_size);
+        CREATE TRIGGER IF NOT EXISTS tiles_size_insert AFTER INSERT ON tiles
+        BEGIN
+            UPDATE molly_tile_store_size
+                SET bytes = bytes + length(NEW.tile_data);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tiles_size_delete AFTER DELETE ON tiles
+        BEGIN
+            UPDATE molly_tile_store_size
+                SET bytes = bytes - length(OLD.tile_data);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tiles_size_update
+            AFTER UPDATE OF tile_data ON tiles
+        BEGIN
+            UPDATE molly_tile_store_size
+                SET bytes = bytes + length(NEW.tile_data)
+                                  - length(OLD.tile_data);
+        END;
+
+        INSERT OR IGNORE INTO metadata (name, value)
+            VALUES ('name', 'OpenStreetMap tile cache');
+        INSERT OR IGNORE INTO metadata (name, value) VALUES ('type', 'baselayer');
+        INSERT OR IGNORE INTO metadata (name, value) VALUES ('version', '1.0');
+        INSERT OR IGNORE INTO metadata (name, value)
+            VALUES ('description', 'Tiles cached by Molly');
+        INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png');
+    """
+
+    def __init__(self, filename=None, max_size=None):
+        """
+        @param filename: The MBTiles file to use, defaults to the
+                         OSM_TILE_MBTILES setting
+        @type filename: str
+        @param max_size: The maximum number of bytes of tile data to store,
+                         defaults to the OSM_TILE_STORE_MAX_SIZE setting
+        @type max_size: int
+        """
+        self.filename = filename or get_mbtiles_filename()
+        self.max_size = max_size if max_size is not None \
+                                 else get_tile_store_max_size()
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # SQLite connections can't be shared between threads, nor survive a
+        # fork, so keep one per thread per process
+        if getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(self.SCHEMA)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def _key(self, xtile, ytile, zoom):
+        # MBTiles uses TMS tile rows, which count from the bottom
+        return zoom, xtile, (2 ** zoom) - 1 - ytile
+
+    def get(self, xtile, ytile, zoom, max_age=None):
+        key = self._key(xtile, ytile, zoom)
+        row = self.connection.execute("""
+            SELECT tile_data, fetched, accessed FROM tiles
+             WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+            key).fetchone()
+        if row is None:
+            return None
+
+        data, fetched, accessed = row
+        now = time.time()
+        if max_age is not None and fetched < now - _seconds(max_age):
+            return None
+
+        if accessed < now - self.ACCESS_RESOLUTION:
+            with self.connection:
+                self.connection.execute("""
+                    UPDATE tiles SET accessed=?
+                     WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+                    (now,) + key)
+        return str(data)
+
+    def is_fresh(self, xtile, ytile, zoom, max_age):
+        # Don't read the tile itself, nor count this as the tile being used
+        row = self.connection.execute("""
+            SELECT fetched FROM tiles
+             WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+            self._key(xtile, ytile, zoom)).fetchone()
+        return row is not None and row[0] >= time.time() - _seconds(max_age)
+
+    def put(self, xtile, ytile, zoom, data):
+        key, now = self._key(xtile, ytile, zoom), time.time()
+        try:
+            with self.connection:
+                cursor = self.connection.execute("""
+                    UPDATE tiles SET tile_data=?, fetched=?, accessed=?
+                     WHERE zoom_level=? AND tile_column=? AND tile_row=?""",
+                    (buffer(data), now, now) + key)
+                if cursor.rowcount == 0:
+                    self.connection.execute("""
+                        INSERT INTO tiles (zoom_level, tile_column, tile_row,
+                                           tile_data, fetched, accessed)
+                             VALUES (?, ?, ?, ?, ?, ?)""",
+                        key + (buffer(data), now, now))
+        except sqlite3.IntegrityError:
+            # Someone else has just stored this tile, which is fine
+            pass
+
+        if self.max_size:
+            self.evict()
+
+    def size(self):
+        """
+        @return: The number of bytes of tile data in the store
+        """
+        return self.connection.execute(
+            "SELECT bytes FROM molly_tile_store_size").fetchone()[0]
+
+    def evict(self):
+        """
+        If the store is over its maximum size, remove the least recently used
+        tiles until it is comfortably below it.
+        """
+        if self.size() <= self.max_size:
+            return
+
+        with self.connection:
+            to_free = self.size() - self.max_size * self.EVICTION_HEADROOM
+            rowids = []
+            for rowid, length in self.connection.execute("""
+                    SELECT rowid, length(tile_data) FROM tiles
+                  ORDER BY accessed"""):
+                if to_free <= 0:
+                    break
+                rowids.append(rowid)
+                to_free -= length
+            for i in range(0, len(rowids), self.EVICTION_BATCH):
+                batch = rowids[i:i+self.EVICTION_BATCH]
+                self.connection.execute(
+                    "DELETE FROM tiles WHERE rowid IN (%s)" % ', '.join(
+                        '?' * len(batch)), batch)
@@ -1,11 +1,12 @@
 from django.conf.urls.defaults import *
 
-from .views import GeneratedMapView, GPXView, AboutView
+from .views import GeneratedMapView, ExportView, AboutView
 
 urlpatterns = patterns('',
     (r'^about/$', AboutView, {}, 'osm-about'),
     (r'^generated_map/(?P<hash>[a-f\d]{16})/$', GeneratedMapView, {}, 'osm-generated_map'),
-    (r'^gpx/(?P<ptype>[a-z_]+)/$', GPXView, {}, 'osm-gpx'),
+    (r'^gpx/(?P<ptype>[a-z_]+)/$', ExportView, {'format': 'gpx'}, 'osm-gpx'),
+    (r'^export/(?P<ptype>[a-z_]+)\.(?P<format>gpx|kml|geojson)$', ExportView, {}, 'osm-export'),
 
 )
 
@@ -1,31 +1,89 @@
-from email.utils import formatdate
-from datetime import datetime, timedelta
 from time import mktime
-import simplejson, urllib2, base64
+import simplejson, urllib2, base64, hashlib
 from xml.etree import ElementTree as ET
 from xml.sax.saxutils import escape
 
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse, Http404
+from django.utils.cache import patch_vary_headers
 
 from molly.utils.views import BaseView
 from molly.utils.breadcrumbs import *
 from molly.utils.misc import AnyMethodRequest
+from molly.utils.http import not_modified, file_response, set_cache_headers
 
-from molly.apps.places.models import Entity
+from molly.apps.places.models import Entity, EntityType
 
-from .models import GeneratedMap
+from . import render_pending_map, get_tile_proxy_enabled, get_max_tile_zoom
+from .encoding import get_map_encodings, get_encoded_map
+from .export import EXPORT_FORMATS, buffered, iter_locations
+from .models import GeneratedMap, OSMTile, get_generated_map_storage
 
 class GeneratedMapView(BaseView):
     breadcrumb = NullBreadcrumb
 
+    # Maps drawn with fallback tiles are drawn again once the tiles can be
+    # fetched, under the same URL, so clients must check back for them
+    FAULTY_MAP_MAX_AGE = 0
+
     def handle_GET(self, request, context, hash):
         gm = get_object_or_404(GeneratedMap, hash=hash)
-        response = HttpResponse(open(gm.get_filename(), 'r').read(), mimetype='image/png')
+        
+        # The encoding served depends on which encodings the device supports,
+        # and a map is only ever regenerated under a new timestamp, so the
+        # client's copy can be validated without touching the disk
+        encodings = get_map_encodings(request.device)
+        etag = '%s-%s-%d' % (hash, '+'.join(encodings),
+                             mktime(gm.generated.timetuple()))
+        response = not_modified(request, etag, gm.generated,
+                                **self.get_cache_options(gm))
+        if response is None:
+            if gm.pending or \
+               not get_generated_map_storage().exists(gm.get_artifact_name()):
+                # This map has only been planned so far, or another node drew
+                # it and its image can't be found, so draw it now
+                try:
+                    gm = render_pending_map(gm)
+                except GeneratedMap.DoesNotExist:
+                    raise Http404
+                etag = '%s-%s-%d' % (hash, '+'.join(encodings),
+                                     mktime(gm.generated.timetuple()))
+            
+            # Serve the map in the smallest encoding this device can display
+            filename, content_type, encoding = get_encoded_map(gm, encodings)
+            response = file_response(filename, content_type, etag,
+                                     gm.generated, **self.get_cache_options(gm))
+        patch_vary_headers(response, ('User-Agent',))
+        return response
+
+    def get_cache_options(self, gm):
+        if gm.faulty:
+            return {'max_age': self.FAULTY_MAP_MAX_AGE}
+        return {}
+
+class TileView(BaseView):
+    """
+    Serves OSM tiles to slippy maps from the same tile cache that generated
+    maps are drawn from, fetching any that aren't cached.
+    """
+    breadcrumb = NullBreadcrumb
 
-        response['Expires'] = formatdate(mktime((datetime.now() + timedelta(days=7)).timetuple()))
-        response['Last-Modified'] = formatdate(mktime(gm.generated.timetuple()))
-        response['ETag'] = hash
+    def handle_GET(self, request, context, zoom, xtile, ytile):
+        zoom, xtile, ytile = int(zoom), int(xtile), int(ytile)
+        if not get_tile_proxy_enabled() or zoom > get_max_tile_zoom() \
+          or xtile >= 2 ** zoom or ytile >= 2 ** zoom:
+            raise Http404
+        
+        tile = OSMTile.get_tiles([(xtile, ytile)], zoom)[xtile, ytile]
+        if tile is None:
+            raise Http404
+        data = tile.getvalue()
+        
+        etag = hashlib.md5(data).hexdigest()
+        response = not_modified(request, etag)
+        if response is None:
+            response = HttpResponse(data, mimetype='image/png')
+            set_cache_headers(response, etag)
         return response
 
 class AboutView(BaseView):
@@ -42,24 +100,24 @@ class AboutView(BaseView):
     def handle_GET(self, request, context):
         return self.render(request, context, 'maps/osm/about')
 
-class GPXView(BaseView):
+class ExportView(BaseView):
+    """
+    Exports every entity of a type from OpenStreetMap, streaming the document
+    as it is read from the database.
+    """
     breadcrumb = NullBreadcrumb
 
-    def handle_GET(self, request, context, ptype):
-        out = []
-        out.append('<?xml version="1.0"?>\n')
-        out.append('<gpx version="1.0"')
-        out.append(' creator="Molly Project &lt;http://mollyproject.org/&gt;"')
-        out.append(' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"')
-        out.append(' xmlns="http://www.topografix.com/GPX/1/0"')
-        out.append(' xsi:schemaLocation="http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd">\n')
-
-        for entity in Entity.objects.filter(primary_type__slug=ptype, source__module_name='molly.providers.apps.maps.osm'):
-          out.append('  <wpt lat="%(lat)f" lon="%(lon)f">\n' % {'lat':entity.location[1], 'lon':entity.location[0]})
-          out.append('    <name>%s</name>\n' % entity.title)
-          out.append('  </wpt>\n')
-
-        out.append('</gpx>')
-
-        return HttpResponse(out, mimetype="application/gpx+xml")
-
+    def handle_GET(self, request, context, ptype, format):
+        entity_type = get_object_or_404(EntityType, slug=ptype)
+        content_type, writer = EXPORT_FORMATS[format]
+        entities = Entity.objects.filter(
+            primary_type=entity_type,
+            source__module_name='molly.providers.apps.maps.osm')
+
+        response = HttpResponse(
+            buffered(writer(iter_locations(entities),
+                            entity_type.verbose_name_plural)),
+            mimetype=content_type)
+        response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            ptype, format)
+        return response
@@ -0,0 +1,4 @@
+class BaseMapsProvider(object):
+    pass
+
+from generated_maps import GeneratedMapsProvider
@@ -0,0 +1,116 @@
+import logging, os, os.path, random, time
+from datetime import datetime, timedelta
+
+from molly.conf.settings import batch
+
+from molly.maps.providers import BaseMapsProvider
+
+__all__ = ['GeneratedMapsProvider']
+
+logger = logging.getLogger('molly.maps.providers.generated_maps')
+
+class GeneratedMapsProvider(BaseMapsProvider):
+    """
+    Keeps the generated map cache within a quota, by evicting the least
+    recently used maps.
+    """
+
+    # Files in the generated map directory without a GeneratedMap are only
+    # removed once they are this old (in seconds), as they may be maps which
+    # are still being generated
+    ORPHAN_AGE = 3600
+
+    # How many maps to delete from the database at once
+    DELETE_BATCH = 500
+
+    def __init__(self, max_size=512*1024*1024, max_maps=20000,
+                 max_age=timedelta(weeks=1)):
+        """
+        @param max_size: The maximum number of bytes of generated maps to keep
+        @type max_size: int
+        @param max_maps: The maximum number of generated maps to keep
+        @type max_maps: int
+        @param max_age: How long to keep a map for, however much it is used,
+                        so that it is eventually regenerated with fresh tiles
+        @type max_age: timedelta
+        """
+        self.max_size, self.max_maps = max_size, max_maps
+        self.max_age = max_age
+
+    @batch('%d * * * *' % random.randint(0, 59))
+    def evict_maps(self, metadata, output):
+        "Evicts least recently used generated maps"
+
+        from molly.maps.osm.models import GeneratedMap, get_generated_map_dir
+
+        generated_map_dir = get_generated_map_dir()
+        if not os.path.exists(generated_map_dir):
+            return metadata
+
+        # Find the files for each generation of each map, and how much space
+        # they take up. A map may have more than one file, named after its
+        # hash and when it was generated, with differing extensions.
+        files, sizes, mtimes = {}, {}, {}
+        for filename in os.listdir(generated_map_dir):
+            path = os.path.join(generated_map_dir, filename)
+            if not os.path.isfile(path):
+                continue
+            name, stat = filename.split('.')[0], os.stat(path)
+            files.setdefault(name, []).append(path)
+            sizes[name] = sizes.get(name, 0) + stat.st_size
+            mtimes[name] = max(mtimes.get(name, 0), stat.st_mtime)
+
+        # Keep the most recently used maps until we reach the quota, and evict
+        # everything less recently used than that, as well as any maps which
+        # are too old
+        kept, kept_size, evicted, over_quota = set(), 0, [], False
+        oldest = datetime.utcnow() - self.max_age
+        maps = GeneratedMap.objects.order_by('-last_accessed').values_list(
+            'hash', 'generated')
+        for hash, generated in maps.iterator():
+            name = GeneratedMap(hash=hash, generated=generated) \
+                       .get_artifact_name()
+            size = sizes.get(name, 0)
+            if not over_quota and generated >= oldest \
+                              and len(kept) < self.max_maps \
+                              and kept_size + size <= self.max_size:
+                kept.add(name)
+                kept_size += size
+            else:
+                over_quota = over_quota or generated >= oldest
+                evicted.append(hash)
+
+        for i in range(0, len(evicted), self.DELETE_BATCH):
+            GeneratedMap.objects.filter(
+                hash__in=evicted[i:i+self.DELETE_BATCH]).delete()
+
+        # Every generation of an evicted map goes. Other files without a
+        # GeneratedMap are left over from failed generations, are earlier
+        # generations of maps which have since been drawn again (which may
+        # have been fetched from another node), or were deleted while we were
+        # looking at the directory.
+        evicted_hashes, evicted_names, orphans = set(evicted), [], []
+        for name in files:
+            if name in kept:
+                continue
+            elif name.split('-')[0] in evicted_hashes:
+                evicted_names.append(name)
+            elif mtimes[name] < time.time() - self.ORPHAN_AGE:
+                orphans.append(name)
+
+        evicted_size = 0
+        for name in evicted_names + orphans:
+            evicted_size += sizes[name]
+            for path in files[name]:
+                try:
+                    # Leave the file alone if the map has been regenerated
+                    # since we looked at it
+                    if os.stat(path).st_mtime <= mtimes[name]:
+                        os.unlink(path)
+                except OSError:
+                    pass
+
+        output.write("Evicted %d maps and %d orphaned files (%d bytes), "
+                     "keeping %d maps (%d bytes)\n" % (
+            len(evicted), len(orphans), evicted_size, len(kept), kept_size))
+        return metadata
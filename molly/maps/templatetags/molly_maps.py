@@ -1,10 +1,26 @@
+import simplejson
+
 from django import template
 from django.template.loader import get_template
 
-from molly.maps import map_from_point
+from molly.maps import map_from_point, get_tile_url, get_marker_url
 
 register = template.Library()
 
+def map_context(context, map):
+    """
+    @return: The context to render a map with. Smart devices with JavaScript
+             are given the map to draw themselves, rather than an image.
+    @rtype: dict
+    """
+    map_context = {'map': map}
+    if context.get('style_group') == 'smart' and context.get('use_javascript'):
+        overlay = map.get_vector_overlay(get_tile_url(), get_marker_url())
+        # This goes in a script element, which must not be closed early
+        map_context['map_overlay'] = \
+            simplejson.dumps(overlay).replace('</', '<\\/')
+    return map_context
+
 class MapDisplayNode(template.Node):
     """
     Node to display a more complex map from a @C{molly.maps.Map} object
@@ -23,9 +39,8 @@ class MapDisplayNode(template.Node):
         
         @type context: dict
         """
-        context.update({
-            'map': template.Variable(self.map).resolve(context)
-            })
+        context.update(map_context(context,
+                                   template.Variable(self.map).resolve(context)))
         return get_template('maps/embed.html').render(context)
 
 @register.tag
@@ -60,12 +75,11 @@ class LocationDisplayNode(template.Node):
         
         @type context: dict
         """
-        context.update({
-           'map': map_from_point(template.Variable(self.place).resolve(context),
-                                 context['request'].map_width,
-                                 context['request'].map_height,
-                                 zoom=context.get('zoom', 16))
-           })
+        context.update(map_context(context, map_from_point(
+            template.Variable(self.place).resolve(context),
+            context['request'].map_width,
+            context['request'].map_height,
+            zoom=context.get('zoom', 16))))
         return get_template('maps/embed.html').render(context)
 
 @register.tag
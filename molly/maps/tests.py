@@ -0,0 +1,634 @@
+import unittest, random, os.path, shutil, tempfile, threading
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from StringIO import StringIO
+
+import simplejson
+import PIL.Image
+from xml.etree import ElementTree as ET
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from molly.maps import Map
+from molly.maps.models import GeneratedMap
+from molly.maps.osm.models import get_generated_map_storage
+from molly.maps.osm import snap_map_size, tilestore
+from molly.maps.osm.imagecache import MarkerAtlas
+from molly.maps.osm.markers import draw_marker, get_marker_names
+from molly.maps.management.commands.benchmark_maps import synthetic_tile
+from molly.maps.management.commands.seed_osm_tiles import count_tile_pyramid
+from molly.maps.osm.encoding import MAP_ENCODINGS, get_map_encodings
+from molly.maps.osm import draw
+from molly.maps.osm.draw import fit_map, get_tile_ref
+from molly.maps.osm.export import EXPORT_FORMATS, buffered
+from molly.maps.providers import GeneratedMapsProvider
+from molly.utils.artifacts import PeerFetchStorage
+from molly.utils.misc import SimpleOrderedDict
+from molly.utils.simplify import simplify_value
+
+class PointSet(set):
+    """
+    The point set used to fit maps before fit_points, kept so we can check
+    that fitting still gives the same answers
+    """
+
+    def __init__(self, initial=None):
+        super(PointSet, self).__init__(initial)
+        self._min = (float('inf'), float('inf'))
+        self._max = (float('-inf'), float('-inf'))
+        self.ordered = []
+        for p in initial:
+            self.update(p)
+
+    def add(self, point):
+        super(PointSet, self).add(point)
+        self.update(point)
+
+    def remove(self, point):
+        self.ordered.remove(point)
+        super(PointSet, self).remove(point)
+        if any((point[i] in (self._min[i], self._max[i])) for i in range(2)):
+            self._min = (float('inf'), float('inf'))
+            self._max = (float('-inf'), float('-inf'))
+            for point in self:
+                self._min = (min(self._min[0], point[0]),
+                             min(self._min[1], point[1]))
+                self._max = (max(self._max[0], point[0]),
+                             max(self._max[1], point[1]))
+
+    def update(self, point):
+        self.ordered.append(point)
+        self._min = min(self._min[0], point[0]), min(self._min[1], point[1])
+        self._max = max(self._max[0], point[0]), max(self._max[1], point[1])
+
+    def extent(self, zoom):
+        top_left = get_tile_ref(self._min[0], self._min[1], zoom)
+        bottom_right = get_tile_ref(self._max[0], self._max[1], zoom)
+        return (bottom_right[0]-top_left[0])*256, (top_left[1]-bottom_right[1])*256
+
+    def contained_within(self, box, zoom):
+        extent = self.extent(zoom)
+        return extent[0] <= box[0] and extent[1] <= box[1]
+
+def point_set_fit_map(centre_point, points, min_points, zoom, width, height):
+    if not zoom:
+        zoom = 18
+
+    box = max(64, width - 20), max(64, height-35)
+
+    new_points = []
+    for i, point in enumerate(points):
+        if i>1 and point == new_points[-1][0]:
+            new_points[-1][1].append(i)
+        else:
+            new_points.append( (point, [i]) )
+
+    points = [p[0] for p in new_points]
+
+    if centre_point:
+        points = [centre_point] + list(points)
+
+    point_set, points = PointSet(points[:min_points+1]), points[min_points+1:]
+
+    while not point_set.contained_within(box, zoom):
+        zoom -= 1
+
+    while point_set.contained_within(box, zoom):
+        if not points:
+            break
+        new_point, points = points[0], points[1:]
+        point_set.add(new_point)
+    else:
+        point_set.remove(new_point)
+
+    if centre_point:
+        used_points = point_set.ordered[1:]
+        points = [(centre_point[0], centre_point[1], centre_point[2], None)]
+    else:
+        used_points = point_set.ordered[:]
+        points = []
+
+    for i, point in enumerate(used_points):
+        points.append(
+            (point[0], point[1], point[2], i+1)
+        )
+
+    if centre_point:
+        new_points = new_points[:len(point_set)-1]
+    else:
+        new_points = new_points[:len(point_set)]
+
+    return points, new_points, zoom
+
+class FitMapTestCase(unittest.TestCase):
+
+    def random_point(self, rand, spread, title=None):
+        return (-1.26 + rand.gauss(0, spread), 51.75 + rand.gauss(0, spread),
+                rand.choice(('red', 'green')), title or str(rand.random()))
+
+    def assertFitsAsBefore(self, centre_point, points, min_points, zoom,
+                           width, height):
+        self.assertEqual(
+            fit_map(centre_point, points, min_points, zoom, width, height),
+            point_set_fit_map(centre_point, points, min_points, zoom,
+                              width, height))
+
+    def testRandomPoints(self):
+        rand = random.Random(0)
+        for i in range(200):
+            spread = rand.choice((0.0001, 0.001, 0.01, 0.1, 1))
+            points = [self.random_point(rand, spread)
+                      for j in range(rand.randint(1, 120))]
+            if rand.random() < 0.5:
+                centre_point = self.random_point(rand, spread)
+            else:
+                centre_point = None
+            self.assertFitsAsBefore(centre_point, points,
+                                    rand.randint(0, 10),
+                                    rand.choice((None, 10, 16, 18)),
+                                    rand.choice((100, 240, 320)),
+                                    rand.choice((100, 240, 320)))
+
+    def testRepeatedPoints(self):
+        rand = random.Random(1)
+        for i in range(50):
+            points = []
+            for j in range(rand.randint(1, 40)):
+                if points and rand.random() < 0.3:
+                    points.append(rand.choice(points))
+                else:
+                    points.append(self.random_point(rand, 0.01))
+            self.assertFitsAsBefore(points[0], points, rand.randint(0, 5),
+                                    16, 320, 320)
+
+    def testSinglePoint(self):
+        self.assertFitsAsBefore((-1.26, 51.75, 'green', 'Here'), [], 1, 16,
+                                320, 320)
+
+class SnapMapSizeTestCase(unittest.TestCase):
+
+    buckets = (120, 160, 200, 240, 280, 320)
+
+    def testSnapsDown(self):
+        self.assertEqual(snap_map_size(310, self.buckets), 280)
+        self.assertEqual(snap_map_size(230, self.buckets), 200)
+        self.assertEqual(snap_map_size(240, self.buckets), 240)
+        self.assertEqual(snap_map_size(320, self.buckets), 320)
+
+    def testSmallerThanAllBuckets(self):
+        self.assertEqual(snap_map_size(100, self.buckets), 120)
+
+    def testNoBuckets(self):
+        self.assertEqual(snap_map_size(310, ()), 310)
+
+class Device(object):
+    """
+    Just enough of a WURFL device for choosing map encodings
+    """
+    
+    def __init__(self, **capabilities):
+        self.__dict__.update(capabilities)
+
+class MapEncodingTestCase(unittest.TestCase):
+
+    def testFewColoursGetsPalettePNG(self):
+        self.assertEqual(get_map_encodings(Device(jpg=True, png=True,
+                                                  colors=256)), ['png8'])
+
+    def testColourDeviceGetsJPEG(self):
+        self.assertEqual(get_map_encodings(Device(jpg=True, png=True,
+                                                  colors=65536)),
+                         ['jpeg', 'png8'])
+
+    def testNoPNGSupportGetsDefault(self):
+        self.assertEqual(get_map_encodings(Device(jpg=False, png=False,
+                                                  colors=256)), ['png'])
+
+    def testEncodersProduceImages(self):
+        image = PIL.Image.new('RGBA', (64, 64), (242, 239, 233, 255))
+        for encoding in ('png', 'png8', 'jpeg'):
+            f = StringIO()
+            MAP_ENCODINGS[encoding][1](image, f)
+            f.seek(0)
+            self.assertEqual(PIL.Image.open(f).size, (64, 64))
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves made up tiles, as a stand-in for an OSM tile server
+    """
+    
+    def do_GET(self):
+        zoom, xtile, ytile = map(int, self.path[1:-len('.png')].split('/'))
+        self.server.requests.append((xtile, ytile, zoom))
+        data = synthetic_tile(xtile, ytile, zoom)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, *args):
+        pass
+
+class SeedOSMTilesTestCase(unittest.TestCase):
+    
+    bbox = (-1.27, 51.745, -1.25, 51.76)
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.old_tile_store = tilestore._tile_store
+        tilestore._tile_store = tilestore.MBTilesTileStore(
+            os.path.join(self.work_dir, 'tiles.mbtiles'), max_size=0)
+        
+        self.server = HTTPServer(('127.0.0.1', 0), TileRequestHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.checkpoint = os.path.join(self.work_dir, 'checkpoint.json')
+    
+    def tearDown(self):
+        self.server.shutdown()
+        tilestore._tile_store = self.old_tile_store
+        shutil.rmtree(self.work_dir)
+    
+    def seed(self, **options):
+        call_command('seed_osm_tiles',
+                     bbox=','.join(map(str, self.bbox)),
+                     min_zoom=14, max_zoom=15, batch=5,
+                     tile_url='http://127.0.0.1:%d/%%(zoom)d/%%(xtile)d/'
+                              '%%(ytile)d.png' % self.server.server_port,
+                     checkpoint=self.checkpoint, stdout=StringIO(),
+                     **options)
+    
+    def testSeedsEveryTileOnce(self):
+        self.seed()
+        total = count_tile_pyramid(self.bbox, 14, 15)
+        self.assertEqual(len(self.server.requests), total)
+        self.assertEqual(len(set(self.server.requests)), total)
+        for xtile, ytile, zoom in self.server.requests:
+            self.assertEqual(tilestore.get_tile_store().get(xtile, ytile, zoom),
+                             synthetic_tile(xtile, ytile, zoom))
+        self.assertFalse(os.path.exists(self.checkpoint))
+        
+        # Everything is now fresh, so seeding again fetches nothing
+        self.seed()
+        self.assertEqual(len(self.server.requests), total)
+    
+    def testResumesFromCheckpoint(self):
+        f = open(self.checkpoint, 'w')
+        f.write('{"job": {"bbox": [%s], "min_zoom": 14, "max_zoom": 15}, '
+                '"position": 4}' % ', '.join(map(str, self.bbox)))
+        f.close()
+        self.seed()
+        self.assertEqual(len(self.server.requests),
+                         count_tile_pyramid(self.bbox, 14, 15) - 4)
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves artifacts from a directory, as a peer's web server would
+    """
+    
+    def do_GET(self):
+        filename = os.path.join(self.server.root, *self.path[1:].split('/'))
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+        data = open(filename, 'rb').read()
+        if self.server.truncate:
+            # Go away partway through sending it
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write('%x\r\n%s' % (len(data), data[:len(data)//2]))
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, *args):
+        pass
+
+class PeerFetchStorageTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), ArtifactRequestHandler)
+        self.server.root = os.path.join(self.work_dir, 'a')
+        self.server.truncate = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        
+        peer = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.node_a = PeerFetchStorage(
+            'generated_maps', os.path.join(self.work_dir, 'a', 'generated_maps'),
+            peers=[])
+        self.node_b = PeerFetchStorage(
+            'generated_maps', os.path.join(self.work_dir, 'b', 'generated_maps'),
+            peers=['http://127.0.0.1:1/', peer])
+    
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.work_dir)
+    
+    def put(self, storage, name, data):
+        temp_filename = storage.get_temp_filename(name)
+        open(temp_filename, 'wb').write(data)
+        storage.put(name, temp_filename)
+    
+    def testFetchesFromPeer(self):
+        self.put(self.node_a, 'abc', 'map data')
+        self.assertTrue(self.node_b.exists('abc'))
+        self.assertEqual(open(self.node_b.get_filename('abc'), 'rb').read(),
+                         'map data')
+        # It is now kept locally
+        self.assertEqual(os.listdir(self.node_b.directory), ['abc'])
+    
+    def testMissingEverywhere(self):
+        self.assertFalse(self.node_b.exists('abc'))
+        self.assertFalse(self.node_a.exists('abc'))
+        self.assertEqual(os.listdir(self.node_b.directory), [])
+    
+    def testPartialFetch(self):
+        self.put(self.node_a, 'abc', 'map data')
+        self.server.truncate = True
+        self.assertFalse(self.node_b.exists('abc'))
+        self.assertEqual(os.listdir(self.node_b.directory), [])
+
+    def testExistsLocally(self):
+        self.put(self.node_a, 'abc', 'map data')
+        # Peers aren't asked
+        self.assertFalse(self.node_b.exists_locally('abc'))
+        self.assertEqual(os.listdir(self.node_b.directory), [])
+        self.assertTrue(self.node_a.exists_locally('abc'))
+
+    def testDelete(self):
+        self.put(self.node_b, 'abc', 'map data')
+        self.node_b.delete('abc')
+        self.node_b.delete('abc')
+        self.assertFalse(os.path.exists(self.node_b.get_filename('abc')))
+
+class SimpleOrderedDictTestCase(unittest.TestCase):
+    def testLeastRecentlyUsed(self):
+        d = SimpleOrderedDict()
+        for i in range(100):
+            d[i % 10] = d.pop(i % 10, 0) + 1
+        d[3] = d.pop(3)
+        self.assertEqual(d.popitem(last=False), (0, 10))
+        self.assertEqual(d.popitem(), (3, 10))
+        self.assertEqual(len(d), 8)
+        self.assertFalse(3 in d)
+        # Stale entries are tidied up
+        self.assertTrue(len(d._order) <= 2 * len(d) + 16)
+        d.clear()
+        self.assertRaises(KeyError, d.popitem)
+
+class MarkerTestCase(unittest.TestCase):
+
+    def testDrawsEveryMarker(self):
+        for name in get_marker_names():
+            marker = draw_marker(name)
+            self.assertEqual(marker.mode, 'RGBA')
+            if name.endswith('-star'):
+                self.assertEqual(marker.size, (20, 20))
+            else:
+                self.assertEqual(marker.size, (20, 25))
+
+    def testUnknownMarker(self):
+        self.assertRaises(ValueError, draw_marker, 'pink-1')
+        self.assertRaises(ValueError, draw_marker, 'red-100')
+
+    def testAtlasDrawsMissingMarkers(self):
+        marker_dir = tempfile.mkdtemp()
+        try:
+            atlas = MarkerAtlas(os.path.join(marker_dir, 'markers'))
+            self.assertEqual(atlas.get('red-12').size, (20, 25))
+            self.assertTrue(os.path.exists(
+                os.path.join(marker_dir, 'markers', 'red-12.png')))
+            self.assertRaises(IOError, atlas.get, 'pink-1')
+        finally:
+            shutil.rmtree(marker_dir)
+
+class GeneratedMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = get_generated_map_storage()
+        self.generated_map = GeneratedMap.objects.create(
+            hash='0123456789abcdef', generated=datetime(2011, 1, 1),
+            last_accessed=datetime.utcnow(), faulty=False)
+
+    def tearDown(self):
+        if self.generated_map.pk is not None:
+            self.generated_map.delete()
+
+    def put(self, name):
+        temp_filename = self.storage.get_temp_filename(name)
+        PIL.Image.new('RGB', (10, 10)).save(temp_filename, 'png')
+        self.storage.put(name, temp_filename)
+
+    def testNamedByGeneration(self):
+        old_name = self.generated_map.get_artifact_name()
+        self.generated_map.generated = datetime(2011, 1, 2)
+        self.assertNotEqual(self.generated_map.get_artifact_name(), old_name)
+        self.assertEqual(self.generated_map.get_artifact_name('gif'),
+                         self.generated_map.get_artifact_name() + '.gif')
+
+    def testDeletesEveryGeneration(self):
+        self.put(self.generated_map.get_artifact_name())
+        self.put(self.generated_map.get_artifact_name('gif'))
+        self.generated_map.generated = datetime(2011, 1, 2)
+        self.generated_map.save()
+        self.put(self.generated_map.get_artifact_name())
+        hash = self.generated_map.hash
+        self.generated_map.delete()
+        self.assertFalse([filename
+                          for filename in os.listdir(self.storage.directory)
+                          if filename.startswith(hash)])
+
+    def testEvictsEarlierGenerations(self):
+        old_names = [self.generated_map.get_artifact_name(),
+                     self.generated_map.get_artifact_name('gif')]
+        for name in old_names:
+            self.put(name)
+        self.generated_map.generated = datetime.utcnow()
+        self.generated_map.save()
+        self.put(self.generated_map.get_artifact_name())
+        provider = GeneratedMapsProvider()
+        provider.ORPHAN_AGE = -60
+        provider.evict_maps({}, StringIO())
+        self.assertTrue(self.storage.exists_locally(
+            self.generated_map.get_artifact_name()))
+        for name in old_names:
+            self.assertFalse(self.storage.exists_locally(name))
+
+class GeneratedMapViewTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = get_generated_map_storage()
+        self.generated_map = GeneratedMap.objects.create(
+            hash='0123456789abcdef', generated=datetime.utcnow(),
+            last_accessed=datetime.utcnow(), faulty=False)
+        name = self.generated_map.get_artifact_name()
+        temp_filename = self.storage.get_temp_filename(name)
+        PIL.Image.new('RGB', (10, 10)).save(temp_filename, 'png')
+        self.storage.put(name, temp_filename)
+
+    def tearDown(self):
+        self.generated_map.delete()
+
+    def get(self):
+        return Client().get(reverse('maps:osm-generated_map',
+                                    args=[self.generated_map.hash]))
+
+    def testCachedForAWeek(self):
+        self.assertEqual(self.get()['Cache-Control'], 'public, max-age=604800')
+
+    def testFaultyMapsAreNotCached(self):
+        self.generated_map.faulty = True
+        self.generated_map.save()
+        self.assertEqual(self.get()['Cache-Control'], 'public, max-age=0')
+
+class ExportTestCase(unittest.TestCase):
+    
+    locations = [(u'Caf\xe9 <Nero> & Co', -1.2578, 51.7522),
+                 (u'Carfax Tower', -1.2579, 51.752)]
+    
+    def export(self, format, locations=None):
+        content_type, writer = EXPORT_FORMATS[format]
+        if locations is None:
+            locations = self.locations
+        return ''.join(buffered(writer(iter(locations), u'Caf\xe9s'),
+                                size=10))
+    
+    def testGPX(self):
+        gpx = ET.fromstring(self.export('gpx'))
+        ns = '{http://www.topografix.com/GPX/1/0}'
+        waypoints = gpx.findall(ns + 'wpt')
+        self.assertEqual([w.find(ns + 'name').text for w in waypoints],
+                         [title for title, lon, lat in self.locations])
+        self.assertEqual(float(waypoints[0].get('lon')), -1.2578)
+        self.assertEqual(float(waypoints[0].get('lat')), 51.7522)
+    
+    def testKML(self):
+        kml = ET.fromstring(self.export('kml'))
+        ns = '{http://www.opengis.net/kml/2.2}'
+        placemarks = kml.findall('%sDocument/%sPlacemark' % (ns, ns))
+        self.assertEqual(placemarks[0].find(ns + 'name').text,
+                         self.locations[0][0])
+        self.assertEqual(
+            placemarks[1].find('%sPoint/%scoordinates' % (ns, ns)).text,
+            '-1.257900,51.752000')
+    
+    def testGeoJSON(self):
+        collection = simplejson.loads(self.export('geojson'))
+        self.assertEqual(collection['name'], u'Caf\xe9s')
+        self.assertEqual(
+            [(f['properties']['title'],) + tuple(f['geometry']['coordinates'])
+             for f in collection['features']],
+            self.locations)
+        self.assertEqual(
+            simplejson.loads(self.export('geojson', []))['features'], [])
+
+class BenchmarkMapsTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.work_dir, 'benchmark.json')
+    
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+    
+    def benchmark(self, stdout=None, **options):
+        call_command('benchmark_maps', renders=2, points='1,10',
+                     sizes='120x120', functions=['get_map', 'fit_map'],
+                     output=self.output, stdout=stdout or StringIO(),
+                     **options)
+        return simplejson.load(open(self.output))['results']
+    
+    def testWritesResults(self):
+        old_tile_store = tilestore._tile_store
+        results = self.benchmark()
+        self.assertTrue(tilestore._tile_store is old_tile_store)
+        
+        drawn = [r for r in results if r['function'] == 'get_map']
+        self.assertEqual(sorted((r['points'], r['cache']) for r in drawn),
+                         [(1, 'cold'), (1, 'warm'), (10, 'cold'), (10, 'warm')])
+        for result in drawn:
+            self.assertEqual(result['renders'], 2)
+            self.assertTrue(result['peak_rss_kb'] > 0)
+            # Warm caches mean nothing needs decoding
+            if result['cache'] == 'warm':
+                self.assertEqual(result['decodes_per_render'], 0)
+            else:
+                self.assertTrue(result['decodes_per_render'] > 0)
+        
+        self.assertEqual(len([r for r in results if r['function'] == 'fit_map']),
+                         4)
+    
+    def testCompares(self):
+        self.benchmark()
+        stdout = StringIO()
+        self.benchmark(stdout=stdout, compare=self.output)
+        self.assertTrue('get_map, 10 points, 120x120, cold caches: ' in
+                        stdout.getvalue().split('Compared')[1])
+
+class VectorOverlayTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.centre_point = (-1.26, 51.75, 'green', u'Here')
+        self.points = [(-1.26 + i * 0.001, 51.75 + i * 0.001, 'red', u'P%d' % i)
+                       for i in range(5)]
+    
+    def testStaticMapIsLazy(self):
+        GeneratedMap.objects.all().delete()
+        map = Map(self.centre_point, self.points, 5, None, 200, 200)
+        map.get_vector_overlay()
+        self.assertEqual(GeneratedMap.objects.count(), 0)
+        self.assertTrue(map.static_map_hash)
+        self.assertEqual(GeneratedMap.objects.count(), 1)
+        map.static_map_hash
+        self.assertEqual(GeneratedMap.objects.count(), 1)
+        GeneratedMap.objects.all().delete()
+    
+    def testFittedOnce(self):
+        fits = []
+        def counting_fit_map(*args):
+            fits.append(args)
+            return fit_map(*args)
+        draw.fit_map = counting_fit_map
+        try:
+            map = Map(self.centre_point, self.points, 5, None, 200, 200,
+                      lazy=True)
+            map.get_vector_overlay()
+            map.static_map_hash
+        finally:
+            draw.fit_map = fit_map
+            GeneratedMap.objects.all().delete()
+        self.assertEqual(len(fits), 1)
+    
+    def testNotInAPIOutput(self):
+        map = Map(self.centre_point, self.points, 5, None, 200, 200)
+        self.assertEqual(simplify_value({'map': map, 'title': 'Near'}),
+                         {'title': 'Near'})
+    
+    def testOverlay(self):
+        map = Map(self.centre_point, self.points, 5, None, 200, 200)
+        overlay = map.get_vector_overlay('/tiles', '/markers/')
+        self.assertEqual(overlay['tile_url'], '/tiles')
+        self.assertEqual(overlay['marker_url'], '/markers/')
+        self.assertEqual(overlay['zoom'], map.zoom)
+        
+        markers = overlay['markers']
+        self.assertEqual(markers[0]['marker'], 'green-star')
+        self.assertEqual(sorted(m['marker'] for m in markers[1:]),
+                         ['red-%d' % (i + 1) for i in range(5)])
+        
+        # Every marker is on the map
+        west, south, east, north = overlay['bounds']
+        for marker in markers:
+            self.assertTrue(west <= marker['lon'] <= east)
+            self.assertTrue(south <= marker['lat'] <= north)
+        simplejson.dumps(overlay)
@@ -1,6 +1,7 @@
 from django.conf.urls.defaults import *
 
 import molly.maps.osm.urls
+from molly.maps.osm.views import TileView
 
 from views import IndexView, TouchMapLiteView
 
@@ -8,4 +9,6 @@ urlpatterns = patterns('',
         (r'^$', IndexView, {}, 'index'),
         (r'^touchmaplite/$', TouchMapLiteView, {}, 'touchmaplite'),
         (r'^osm/', include(molly.maps.osm.urls.urlpatterns)),
+        (r'^tiles/(?P<zoom>\d+)/(?P<xtile>\d+)/(?P<ytile>\d+)\.png$',
+         TileView, {}, 'tile'),
     )
\ No newline at end of file
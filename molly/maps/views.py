@@ -2,6 +2,8 @@ from django.http import Http404
 
 from molly.utils.views import BaseView
 from molly.utils.breadcrumbs import *
+from molly.maps import get_tile_url
+from molly.maps.osm import get_tile_proxy_enabled
 
 class IndexView(BaseView):
     @BreadcrumbFactory
@@ -30,4 +32,6 @@ class TouchMapLiteView(BaseView):
         context.update({
             'zoom_controls': True,
         })
+        if get_tile_proxy_enabled():
+            context['tile_url'] = get_tile_url()
         return self.render(request, context, 'maps/touchmaplite/map')
\ No newline at end of file
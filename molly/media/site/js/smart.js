@@ -612,4 +612,55 @@ var geo_position_js=function() {
 
 
         return pub;
-}();
\ No newline at end of file
+}();
+// Maps drawn on the device, rather than by the server. vectorMaps holds the
+// description of each map (as given by molly.maps.Map.get_vector_overlay) in
+// the same order as the .vector-map elements they are drawn in.
+function mapPixel(lon, lat, zoom) {
+  var n = Math.pow(2, zoom) * 256;
+  var lat_rad = lat * Math.PI / 180;
+  return [(lon + 180) / 360 * n,
+          (1 - Math.log(Math.tan(lat_rad) + 1 / Math.cos(lat_rad)) / Math.PI) / 2 * n];
+}
+
+function drawVectorMap(element, map) {
+  var width = $(element).width(), height = map.height;
+  var centre = mapPixel(map.centre[0], map.centre[1], map.zoom);
+  var left = Math.round(centre[0] - width / 2), top = Math.round(centre[1] - height / 2);
+  var last = Math.pow(2, map.zoom) - 1;
+
+  for (var x = Math.floor(left / 256); x <= Math.floor((left + width) / 256); x++) {
+    for (var y = Math.floor(top / 256); y <= Math.floor((top + height) / 256); y++) {
+      if (x < 0 || y < 0 || x > last || y > last) continue;
+      $(element).prepend('<img class="tile" alt="" width="256" height="256" src="'
+        + map.tile_url + '/' + map.zoom + '/' + x + '/' + y + '.png" style="left:'
+        + (x * 256 - left) + 'px; top:' + (y * 256 - top) + 'px"/>');
+    }
+  }
+
+  // Draw markers from north to south, so that those further south overlap
+  // those behind them
+  var markers = map.markers.slice(0);
+  markers.sort(function(a, b) { return b.lat - a.lat; });
+  for (var i = 0; i < markers.length; i++) {
+    var marker = markers[i];
+    var pixel = mapPixel(marker.lon, marker.lat, map.zoom);
+    var img = $('<img class="marker"/>').attr({
+      src: map.marker_url + marker.marker + '.png',
+      alt: marker.title,
+      title: marker.title
+    }).css({
+      left: Math.round(pixel[0] - left - marker.anchor[0]) + 'px',
+      top: Math.round(pixel[1] - top - marker.anchor[1]) + 'px'
+    });
+    $(element).find('img.tile:last').after(img);
+  }
+}
+
+$(function(){
+  if (typeof(vectorMaps) != 'undefined') {
+    $('.vector-map').each(function(i){
+      drawVectorMap(this, vectorMaps[i]);
+    });
+  }
+});
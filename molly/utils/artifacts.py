@@ -0,0 +1,207 @@
+"""
+Storage for artifacts, such as generated maps and resized images, which are
+made by one request and served by later ones.
+
+The database rows describing artifacts are shared by every node of a
+deployment, but the files themselves are written to disk, so on a site served
+by more than one node the storage has to make sure that a file made on one
+node can be served by the others. Which storage is used is configured by the
+ARTIFACT_STORAGE setting, which is the full path to an ArtifactStorage
+subclass:
+
+ * @C{SharedFilesystemStorage} (the default) keeps artifacts in a directory,
+   which should be on a filesystem shared by every node (such as NFS) when
+   there is more than one
+ * @C{PeerFetchStorage} keeps artifacts on the node which made them, and
+   fetches those it doesn't have from the other nodes, listed in the
+   ARTIFACT_PEERS setting, the first time they are asked for
+
+Each kind of artifact is kept in its own namespace, which has its own
+directory.
+"""
+
+import logging
+import os
+import os.path
+import urllib2
+import httplib
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('molly.utils.artifacts')
+
+def get_artifact_storage_class():
+    return getattr(settings,
+                   'ARTIFACT_STORAGE',
+                   'molly.utils.artifacts.SharedFilesystemStorage')
+
+def get_artifact_peers():
+    """
+    @return: The base URLs which the other nodes serve their artifacts from,
+             with the namespace and name of an artifact appended to them
+    @rtype: [str]
+    """
+    return getattr(settings, 'ARTIFACT_PEERS', ())
+
+def get_artifact_fetch_timeout():
+    """
+    @return: How long to wait for a peer to send an artifact, in seconds
+    """
+    return getattr(settings, 'ARTIFACT_FETCH_TIMEOUT', 5)
+
+_storages = {}
+
+def get_artifact_storage(namespace, directory):
+    """
+    @param namespace: The kind of artifact, such as 'generated_maps'
+    @type namespace: str
+    @param directory: The directory artifacts of this kind are kept in
+    @type directory: str
+    @return: The configured storage for a kind of artifact
+    @rtype: ArtifactStorage
+    """
+    key = namespace, directory
+    if key not in _storages:
+        mod_name, cls_name = get_artifact_storage_class().rsplit('.', 1)
+        _storages[key] = getattr(import_module(mod_name), cls_name)(
+            namespace, directory)
+    return _storages[key]
+
+class ArtifactStorage(object):
+    """
+    The interface to the storage of one kind of artifact. Artifacts are
+    always read from and written to local files, so that they can be served
+    by the web server (see SENDFILE_HEADER), but the storage decides where
+    those files come from.
+    """
+
+    def __init__(self, namespace, directory):
+        self.namespace, self.directory = namespace, directory
+
+    def get_filename(self, name):
+        """
+        @return: The name of the local file the artifact is read from
+        @rtype: str
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Someone else has just created it
+                pass
+        return os.path.join(self.directory, name)
+
+    def get_temp_filename(self, name):
+        """
+        @return: The name of a file to write the artifact to, before passing
+                 it to @C{put}, so that no request ever sees a partially
+                 written artifact
+        @rtype: str
+        """
+        return '%s.%d.tmp' % (self.get_filename(name), os.getpid())
+
+    def put(self, name, temp_filename):
+        """
+        Stores an artifact which has been written to a temporary file
+        """
+        os.rename(temp_filename, self.get_filename(name))
+
+    def exists(self, name):
+        """
+        @return: Whether the artifact can be read from @C{get_filename}, which
+                 may mean getting it from elsewhere
+        @rtype: bool
+        """
+        raise NotImplementedError
+
+    def exists_locally(self, name):
+        """
+        @return: Whether the artifact can be read from @C{get_filename} right
+                 away. Artifacts which can be made again from one which is
+                 here (such as other encodings of a map) should be checked
+                 for with this, as making them is quicker than asking
+                 elsewhere for them.
+        @rtype: bool
+        """
+        return os.path.exists(self.get_filename(name))
+
+    def delete(self, name):
+        """
+        Deletes an artifact, if it is stored
+        """
+        try:
+            os.unlink(self.get_filename(name))
+        except OSError:
+            # It has already been deleted
+            pass
+
+class SharedFilesystemStorage(ArtifactStorage):
+    """
+    Keeps artifacts in a directory which every node can see. As artifacts are
+    written to a temporary file and renamed in to place, other nodes never
+    see one half written.
+    """
+
+    def exists(self, name):
+        return os.path.exists(self.get_filename(name))
+
+class PeerFetchStorage(ArtifactStorage):
+    """
+    Keeps artifacts on the node which made them. Those which aren't on this
+    node are fetched from the first peer which has them, and kept here from
+    then on.
+
+    Peers must serve their artifact directories at
+    C{<peer>/<namespace>/<name>}, which is best done by the web server itself,
+    and only to the other nodes. Peers are never asked to fetch an artifact
+    themselves, so a missing artifact can't be passed around in circles.
+    """
+
+    def __init__(self, namespace, directory, peers=None):
+        super(PeerFetchStorage, self).__init__(namespace, directory)
+        self.peers = get_artifact_peers() if peers is None else peers
+
+    def exists(self, name):
+        if os.path.exists(self.get_filename(name)):
+            return True
+        for peer in self.peers:
+            if self.fetch(peer, name):
+                return True
+        return False
+
+    def fetch(self, peer, name):
+        """
+        Copies an artifact from a peer to this node
+
+        @return: Whether the peer had the artifact
+        @rtype: bool
+        """
+        url = '%s/%s/%s' % (peer.rstrip('/'), self.namespace, name)
+        temp_filename = self.get_temp_filename(name)
+        try:
+            response = urllib2.urlopen(url,
+                                       timeout=get_artifact_fetch_timeout())
+            f = open(temp_filename, 'wb')
+            try:
+                while True:
+                    data = response.read(65536)
+                    if not data:
+                        break
+                    f.write(data)
+            finally:
+                f.close()
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                logger.warning("Unable to fetch %s: %s", url, e)
+        except (urllib2.URLError, httplib.HTTPException, IOError), e:
+            logger.warning("Unable to fetch %s: %s", url, e)
+        else:
+            self.put(name, temp_filename)
+            return True
+        finally:
+            # Whatever went wrong, don't leave a partially fetched artifact
+            # behind
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+        return False
@@ -1,6 +1,9 @@
-import urlparse, urllib, re
+import urlparse, urllib, re, os.path, calendar, time
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified
 
 
 # parse_qs was copied from cgi to urlparse in Python 2.6
@@ -14,6 +17,98 @@ if not hasattr(urlparse, 'parse_qs'):
 class HttpResponseSeeOther(HttpResponseRedirect):
     status_code = 303
 
+def get_sendfile_header():
+    """
+    Returns the header used to hand serving files off to the web server, which
+    is either 'X-Sendfile' (Apache mod_xsendfile, lighttpd) or
+    'X-Accel-Redirect' (nginx), or None to serve files from Django.
+    """
+    return getattr(settings, 'SENDFILE_HEADER', None)
+
+def get_sendfile_root():
+    """
+    Returns the directory which is served by nginx from SENDFILE_URL, when
+    using X-Accel-Redirect.
+    """
+    return getattr(settings, 'SENDFILE_ROOT', settings.CACHE_DIR)
+
+def get_sendfile_url():
+    """
+    Returns the internal nginx location which serves SENDFILE_ROOT, when using
+    X-Accel-Redirect.
+    """
+    return getattr(settings, 'SENDFILE_URL', '/protected/')
+
+def set_cache_headers(response, etag, last_modified=None, max_age=7*86400):
+    """
+    Makes a response cacheable by clients and proxies for max_age seconds,
+    with a strong ETag (which must change whenever the content does).
+    """
+    response['ETag'] = '"%s"' % etag
+    response['Cache-Control'] = 'public, max-age=%d' % max_age
+    response['Expires'] = formatdate(time.time() + max_age, usegmt=True)
+    if last_modified:
+        response['Last-Modified'] = formatdate(
+            calendar.timegm(last_modified.utctimetuple()), usegmt=True)
+
+def not_modified(request, etag, last_modified=None, max_age=7*86400):
+    """
+    Checks a conditional GET against a file's validators, before anything has
+    been read from disk.
+    
+    Returns a 304 response if the client's copy is still current, or None if
+    the file needs to be sent. If-None-Match takes precedence over
+    If-Modified-Since, as in RFC 2616.
+    
+    last_modified is a naive datetime in UTC.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = [e.strip() for e in if_none_match.split(',')]
+        current = '*' in etags or '"%s"' % etag in etags
+    else:
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is None or last_modified is None:
+            return None
+        if_modified_since = parsedate_tz(if_modified_since.split(';')[0])
+        if if_modified_since is None:
+            return None
+        current = mktime_tz(if_modified_since) >= \
+                  calendar.timegm(last_modified.utctimetuple())
+    
+    if not current:
+        return None
+    response = HttpResponseNotModified()
+    set_cache_headers(response, etag, last_modified, max_age)
+    return response
+
+def file_response(filename, content_type, etag, last_modified=None,
+                  max_age=7*86400):
+    """
+    Returns a response serving a file from disk without reading it in to
+    memory, either by handing it off to the web server (see SENDFILE_HEADER),
+    or by streaming it in chunks.
+    
+    The response has a strong ETag (etag must change whenever the file does)
+    and is cacheable for max_age seconds. Call not_modified first to answer
+    conditional GETs.
+    """
+    header = get_sendfile_header()
+    if header == 'X-Sendfile':
+        response = HttpResponse('', mimetype=content_type)
+        response['X-Sendfile'] = filename
+    elif header == 'X-Accel-Redirect':
+        response = HttpResponse('', mimetype=content_type)
+        path = os.path.relpath(filename, get_sendfile_root())
+        response['X-Accel-Redirect'] = get_sendfile_url() + \
+            urllib.quote(path.replace(os.path.sep, '/'))
+    else:
+        f = open(filename, 'rb')
+        response = HttpResponse(FileWrapper(f, 8192), mimetype=content_type)
+        response['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    set_cache_headers(response, etag, last_modified, max_age)
+    return response
+
 def update_url(url, query_update, fragment = ''):
     """
     Replaces query parameters with those given in query_update, and updates the fragment.
@@ -1,4 +1,5 @@
 import urllib2, sys, os.path, imp
+from collections import deque
 
 class AnyMethodRequest(urllib2.Request):
     def __init__(self, url, data=None, headers={}, origin_req_host=None, unverifiable=None, method=None):
@@ -36,4 +37,67 @@ def get_norm_sys_path():
     # issue when n is small.
     sys_path = [p for i,p in enumerate(sys_path) if p not in sys_path[:i]]
 
-    return sys_path
\ No newline at end of file
+    return sys_path
+
+class SimpleOrderedDict(object):
+    """
+    The parts of an ordered dictionary which the least-recently-used caches
+    use, for Python 2.6, which doesn't have collections.OrderedDict. Keys are
+    kept in a queue in the order they were set; a key which is set again
+    moves to the back (the caches always pop it first anyway), leaving a
+    stale entry behind, which is skipped when it comes to the front.
+    """
+
+    def __init__(self):
+        self._values, self._stamps = {}, {}
+        self._order, self._stamp = deque(), 0
+
+    def __setitem__(self, key, value):
+        self._stamp += 1
+        self._values[key], self._stamps[key] = value, self._stamp
+        self._order.append((self._stamp, key))
+        if len(self._order) > 2 * len(self._values) + 16:
+            # Too many stale entries
+            self._order = deque(sorted((stamp, key) for key, stamp
+                                       in self._stamps.items()))
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __delitem__(self, key):
+        del self._values[key]
+        del self._stamps[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def pop(self, key, *default):
+        if key not in self._values:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self._stamps[key]
+        return self._values.pop(key)
+
+    def popitem(self, last=True):
+        while self._order:
+            stamp, key = self._order.pop() if last else self._order.popleft()
+            if self._stamps.get(key) == stamp:
+                return key, self.pop(key)
+        raise KeyError('dictionary is empty')
+
+    def clear(self):
+        self._values.clear()
+        self._stamps.clear()
+        self._order.clear()
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = SimpleOrderedDict
@@ -459,6 +459,9 @@ APPLICATIONS = [
     # Maps - always
     config += """
     Application('molly.maps', 'maps', 'Maps',
+        providers = [
+            Provider('molly.maps.providers.GeneratedMapsProvider'),
+        ],
         display_to_user = False,
     ),
     """